@@ -0,0 +1,110 @@
+'''
+Control history
+
+Bounded, time-indexed history of the twists sent to the robot. Each twist is
+held from its stamp until the stamp of the next one, so the controls between
+two times are a list of piecewise-constant intervals (see segments). The
+filter uses it to move the particles to exactly the stamp of each scan,
+through every twist in between, in one sample_motion_path call, instead of
+integrating whatever twist is current at the moment a callback runs.
+
+The history keeps the capacity most recent twists, sorted by stamp (a late
+twist is inserted in its place). Asking for the controls over a time whose
+twists were already forgotten because the history was full logs a warning and
+counts it (see ControlHistory.missing), since that odometry is lost.
+'''
+
+# pylint: disable=invalid-name
+
+import numpy as np
+import rospy
+
+class ControlHistory(object):
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.stamps = np.zeros(0)
+        self.v = np.zeros(0)
+        self.w = np.zeros(0)
+        # the twists before this time were forgotten because the history was
+        #   full, and the requests for controls that reached back past it
+        self.forgotten_until = None
+        self.missing = 0
+
+    def __len__(self):
+        return len(self.stamps)
+
+    def add(self, stamp, v, w):
+        '''
+        Record a twist. The oldest twist is forgotten when the history is
+        full.
+        Input:
+            float stamp (seconds)
+            float v (linear.x), w (angular.z)
+        Output:
+            None
+        '''
+        at = int(np.searchsorted(self.stamps, stamp, side='right'))
+        self.stamps = np.insert(self.stamps, at, stamp)
+        self.v = np.insert(self.v, at, v)
+        self.w = np.insert(self.w, at, w)
+        if len(self.stamps) > self.capacity:
+            self.forget(len(self.stamps) - self.capacity)
+            self.forgotten_until = self.stamps[0]
+
+    def add_twist(self, stamp, twist):
+        '''
+        add for a Twist message
+        '''
+        self.add(stamp, twist.linear.x, twist.angular.z)
+
+    def forget(self, count):
+        '''
+        Drop the count oldest twists
+        '''
+        self.stamps = self.stamps[count:]
+        self.v = self.v[count:]
+        self.w = self.w[count:]
+
+    def prune(self, stamp):
+        '''
+        Drop the twists that ended before the given time. The twist in effect
+        at that time is kept.
+        Input:
+            float stamp
+        Output:
+            None
+        '''
+        active = int(np.searchsorted(self.stamps, stamp, side='right')) - 1
+        if active > 0:
+            self.forget(active)
+
+    def segments(self, start, end):
+        '''
+        The controls in effect between two times, as consecutive intervals.
+        Before the first recorded twist the robot is taken to be standing
+        still. That includes the time of twists forgotten because the history
+        was full, which is logged and counted (see missing).
+        Input:
+            float start, end (seconds)
+        Output:
+            (np.ndarray v, np.ndarray w, np.ndarray dt) (K,) each, empty if
+                end <= start
+        '''
+        if end <= start:
+            return (np.zeros(0), np.zeros(0), np.zeros(0),)
+        if self.forgotten_until is not None and start < self.forgotten_until:
+            self.missing += 1
+            rospy.logwarn('control history: twists before %f were forgotten, '
+                'taking the robot as standing still (%d so far)' %
+                (self.forgotten_until, self.missing,))
+        if len(self.stamps) == 0:
+            return (np.zeros(1), np.zeros(1), np.array([end - start]),)
+        first = int(np.searchsorted(self.stamps, start, side='right'))
+        last = int(np.searchsorted(self.stamps, end, side='left'))
+        boundaries = np.concatenate(([start], self.stamps[first:last], [end]))
+        # the twist in effect at the start of each interval
+        active = np.arange(first - 1, last)
+        known = active >= 0
+        v = np.where(known, self.v[np.maximum(active, 0)], 0.0)
+        w = np.where(known, self.w[np.maximum(active, 0)], 0.0)
+        return (v, w, np.diff(boundaries),)
@@ -0,0 +1,351 @@
+'''
+Correspondence kernel
+
+Batched version of FilterParticle.log_probability_of_match. For one particle
+pose it computes the full blobs x features log likelihood matrix at once with
+numpy, using closed-form 2-D (position) and 3-D (color) Gaussian densities
+instead of one scipy pdf call per pair. The inverses and log determinants of
+the covariances (covariance_terms) are cached by the landmark maps next to
+the packed means.
+
+The gates are the same as the per-pair code:
+    - observed bearing more than 0.5 rad from the expected bearing
+    - squared RGB distance over 300
+    - feature more than pi/2 away from the observed bearing line
+and gated pairs get a log likelihood of -inf.
+
+best_matches (Version 1) picks the best feature for every blob on its own, so
+several blobs can claim the same feature. unique_matches (Version 2) solves the
+one-to-one assignment instead. The gates split the blobs and features into
+small independent groups, and each group is solved on its own.
+
+stable_matches tells whether a blob's match could change if the pose moved a
+little, which lets nearby particles with the same map share one association.
+'''
+
+# pylint: disable=invalid-name
+
+import math
+import numpy as np
+
+from scipy.optimize import linear_sum_assignment
+
+BEARING_GATE = 0.5
+COLOR_GATE = 300.0
+LINE_GATE = math.pi/2
+
+LOG_2PI = math.log(2.0*math.pi)
+
+# assignment cost of a gated pair, far above any real -log likelihood
+GATED_COST = 1e9
+
+def inverse_2d(covars):
+    '''
+    Closed-form inverses and log determinants of 2x2 covariances
+    Input:
+        np.ndarray covars (N, 2, 2)
+    Output:
+        (np.ndarray inverses (N, 2, 2), np.ndarray log_dets (N,)) (inf and a
+            zero inverse where the covariance is not positive definite)
+    '''
+    a = covars[:, 0, 0]
+    b = covars[:, 0, 1]
+    d = covars[:, 1, 1]
+    det = a*d - b*b
+    valid = (det > 0.0) & (a > 0.0)
+    scale = np.where(valid, 1.0 / np.where(valid, det, 1.0), 0.0)
+    inverses = np.empty((len(covars), 2, 2))
+    inverses[:, 0, 0] = d*scale
+    inverses[:, 0, 1] = inverses[:, 1, 0] = -b*scale
+    inverses[:, 1, 1] = a*scale
+    log_dets = np.where(valid, np.log(np.where(valid, det, 1.0)), np.inf)
+    return (inverses, log_dets)
+
+def inverse_3d(covars):
+    '''
+    Closed-form (adjugate) inverses and log determinants of symmetric 3x3
+    covariances
+    Input:
+        np.ndarray covars (N, 3, 3)
+    Output:
+        (np.ndarray inverses (N, 3, 3), np.ndarray log_dets (N,)) (inf and a
+            zero inverse where the covariance is not positive definite)
+    '''
+    a = covars[:, 0, 0]
+    b = covars[:, 0, 1]
+    c = covars[:, 0, 2]
+    d = covars[:, 1, 1]
+    e = covars[:, 1, 2]
+    f = covars[:, 2, 2]
+
+    # cofactors
+    A = d*f - e*e
+    B = c*e - b*f
+    C = b*e - c*d
+    D = a*f - c*c
+    E = b*c - a*e
+    F = a*d - b*b
+    det = a*A + b*B + c*C
+    valid = (det > 0.0) & (a > 0.0) & (F > 0.0)
+    scale = np.where(valid, 1.0 / np.where(valid, det, 1.0), 0.0)
+    inverses = np.empty((len(covars), 3, 3))
+    inverses[:, 0, 0] = A*scale
+    inverses[:, 1, 1] = D*scale
+    inverses[:, 2, 2] = F*scale
+    inverses[:, 0, 1] = inverses[:, 1, 0] = B*scale
+    inverses[:, 0, 2] = inverses[:, 2, 0] = C*scale
+    inverses[:, 1, 2] = inverses[:, 2, 1] = E*scale
+    log_dets = np.where(valid, np.log(np.where(valid, det, 1.0)), np.inf)
+    return (inverses, log_dets)
+
+def covariance_terms(covars):
+    '''
+    The parts of a feature's match likelihood that only depend on its
+    covariance: the inverses and log determinants of the position (x, y) and
+    color (r, g, b) blocks. The landmark maps cache these with the features
+    (see LandmarkMap.arrays) so that log_match_matrix doesn't derive them
+    again for every scan.
+    Input:
+        np.ndarray covars (N, 5, 5)
+    Output:
+        (np.ndarray inverses (N, 5, 5) (block diagonal),
+            np.ndarray log_dets (N, 2) (position, color))
+    '''
+    covars = np.asarray(covars, dtype=float)
+    position, position_log_det = inverse_2d(covars[:, 0:2, 0:2])
+    color, color_log_det = inverse_3d(covars[:, 2:5, 2:5])
+    inverses = np.zeros((len(covars), 5, 5))
+    inverses[:, 0:2, 0:2] = position
+    inverses[:, 2:5, 2:5] = color
+    return (inverses, np.column_stack((position_log_det, color_log_det)))
+
+def log_density_2d(dx, dy, inverses, log_dets):
+    '''
+    Log density of 2-D offsets from the mean, given the inverse and log
+    determinant of each covariance (see inverse_2d)
+    Input:
+        np.ndarray dx, dy (..., N)
+        np.ndarray inverses (N, 2, 2)
+        np.ndarray log_dets (N,)
+    Output:
+        np.ndarray (..., N)
+    '''
+    maha = (inverses[:, 0, 0]*dx*dx + 2.0*inverses[:, 0, 1]*dx*dy +
+        inverses[:, 1, 1]*dy*dy)
+    return -0.5*maha - LOG_2PI - 0.5*log_dets
+
+def log_density_3d(delta, inverses, log_dets):
+    '''
+    Log density of 3-D offsets from the mean, given the inverse and log
+    determinant of each covariance (see inverse_3d)
+    Input:
+        np.ndarray delta (..., N, 3)
+        np.ndarray inverses (N, 3, 3)
+        np.ndarray log_dets (N,)
+    Output:
+        np.ndarray (..., N)
+    '''
+    v0 = delta[..., 0]
+    v1 = delta[..., 1]
+    v2 = delta[..., 2]
+    maha = (inverses[:, 0, 0]*v0*v0 + inverses[:, 1, 1]*v1*v1 +
+        inverses[:, 2, 2]*v2*v2 + 2.0*(inverses[:, 0, 1]*v0*v1 +
+        inverses[:, 0, 2]*v0*v2 + inverses[:, 1, 2]*v1*v2))
+    return -0.5*maha - 1.5*LOG_2PI - 0.5*log_dets
+
+def log_gaussian_2d(dx, dy, covars):
+    '''
+    Log density of 2-D offsets from the mean under each covariance
+    Input:
+        np.ndarray dx, dy (..., N)
+        np.ndarray covars (N, 2, 2)
+    Output:
+        np.ndarray (..., N) (-inf where the covariance is not positive definite)
+    '''
+    return log_density_2d(dx, dy, *inverse_2d(covars))
+
+def log_gaussian_3d(delta, covars):
+    '''
+    Log density of 3-D offsets from the mean under each covariance
+    Input:
+        np.ndarray delta (..., N, 3)
+        np.ndarray covars (N, 3, 3)
+    Output:
+        np.ndarray (..., N) (-inf where the covariance is not positive definite)
+    '''
+    return log_density_3d(delta, *inverse_3d(covars))
+
+def log_match_matrix(pose, blobs, means, covars, terms=None):
+    '''
+    Log likelihood of every blob matching every feature from the given pose
+    Input:
+        Pose2D pose
+        np.ndarray blobs (B, 4) [bearing, r, g, b]
+        np.ndarray means (N, 5) [x, y, r, g, b]
+        np.ndarray covars (N, 5, 5)
+        (np.ndarray inverses, np.ndarray log_dets) terms (the features'
+            covariance_terms, computed from covars if not given)
+    Output:
+        np.ndarray (B, N)
+    '''
+    s_x, s_y, s_heading = pose
+    num_blobs = blobs.shape[0]
+    num_features = means.shape[0]
+    if num_blobs == 0 or num_features == 0:
+        return np.full((num_blobs, num_features), -np.inf)
+
+    bearing = blobs[:, 0:1] # (B, 1)
+
+    to_x = means[:, 0] - s_x # (N,)
+    to_y = means[:, 1] - s_y
+    world_bearing = np.arctan2(to_y, to_x)
+
+    del_bearing = bearing - (world_bearing - s_heading) # (B, N)
+
+    del_color = blobs[:, np.newaxis, 1:4] - means[np.newaxis, :, 2:5] # (B, N, 3)
+    color_distance = np.sum(del_color*del_color, axis=2)
+
+    # closest point to the feature on the line from the state along the
+    #   (unrotated) observed bearing, see FilterParticle.closest_point
+    line_x = np.cos(bearing)
+    line_y = np.sin(bearing)
+    along = to_x*line_x + to_y*line_y # (B, N)
+    along = np.maximum(along, 0.0)
+    near_dx = along*line_x - to_x
+    near_dy = along*line_y - to_y
+
+    if terms is None:
+        terms = covariance_terms(covars)
+    inverses, log_dets = terms
+    position = log_density_2d(near_dx, near_dy, inverses[:, 0:2, 0:2],
+        log_dets[:, 0])
+    color = log_density_3d(del_color, inverses[:, 2:5, 2:5], log_dets[:, 1])
+
+    result = position + color
+    gated = ((np.abs(del_bearing) > BEARING_GATE) |
+        (np.abs(color_distance) > COLOR_GATE) |
+        (np.abs(world_bearing - bearing) > LINE_GATE))
+    result[gated] = -np.inf
+    return result
+
+def stable_matches(pose, blobs, means, log_matrix, slack_angle, slack_distance,
+    margin):
+    '''
+    Whether each blob's match would stay the same for every pose within the
+    slack of this one. A match is unstable if a color-compatible feature is
+    within the slack of the bearing gate, the line gate, or the +-pi wrap of
+    the bearing, or if the runner-up is within margin of the best log
+    likelihood.
+    Input:
+        Pose2D pose
+        np.ndarray blobs (B, 4)
+        np.ndarray means (N, 5)
+        np.ndarray log_matrix (B, N) (from log_match_matrix at this pose)
+        float slack_angle (heading difference)
+        float slack_distance (position difference)
+        float margin (log likelihood)
+    Output:
+        np.ndarray bool (B,)
+    '''
+    s_x, s_y, s_heading = pose
+    num_blobs = blobs.shape[0]
+    if num_blobs == 0 or means.shape[0] == 0:
+        return np.ones(num_blobs, dtype=bool)
+
+    bearing = blobs[:, 0:1]
+    to_x = means[:, 0] - s_x
+    to_y = means[:, 1] - s_y
+    distance = np.sqrt(to_x*to_x + to_y*to_y)
+    # how far the bearing to each feature can turn within the slack
+    slack = slack_angle + np.arcsin(np.minimum(
+        slack_distance / np.maximum(distance, 1e-9), 1.0))
+    world_bearing = np.arctan2(to_y, to_x)
+
+    del_bearing = bearing - (world_bearing - s_heading)
+    del_color = blobs[:, np.newaxis, 1:4] - means[np.newaxis, :, 2:5]
+    color_ok = np.sum(del_color*del_color, axis=2) <= COLOR_GATE
+
+    near = ((np.abs(np.abs(del_bearing) - BEARING_GATE) <= slack) |
+        (np.abs(np.abs(world_bearing - bearing) - LINE_GATE) <= slack) |
+        (np.abs(world_bearing) >= math.pi - slack))
+    unstable = np.any(near & color_ok, axis=1)
+
+    if log_matrix.shape[1] >= 2:
+        ordered = np.sort(log_matrix, axis=1)
+        best = ordered[:, -1]
+        second = ordered[:, -2]
+        # best - second is nan where both are -inf, those rows are stable
+        with np.errstate(invalid='ignore'):
+            close = best - second < margin
+        unstable |= np.isfinite(second) & close
+    return ~unstable
+
+def best_matches(log_matrix, ids):
+    '''
+    Independent best match (Version 1) for every blob
+    Input:
+        np.ndarray log_matrix (B, N)
+        list of int ids (N,) feature id for each column
+    Output:
+        list of int (B,) (0 for no match)
+    '''
+    if log_matrix.shape[1] == 0:
+        return [0]*log_matrix.shape[0]
+    best = np.argmax(log_matrix, axis=1)
+    matched = np.isfinite(log_matrix[np.arange(0, len(best)), best])
+    return [ids[column] if ok else 0 for column, ok in zip(best, matched)]
+
+def gated_components(log_matrix):
+    '''
+    Split the blobs and features into groups that share no possible (finite)
+    match with any other group
+    Input:
+        np.ndarray log_matrix (B, N)
+    Output:
+        list of (np.ndarray rows, np.ndarray columns)
+    '''
+    possible = np.isfinite(log_matrix)
+    unvisited = np.any(possible, axis=1)
+    components = []
+    while np.any(unvisited):
+        rows = np.zeros(len(unvisited), dtype=bool)
+        rows[np.argmax(unvisited)] = True
+        columns = np.zeros(log_matrix.shape[1], dtype=bool)
+        while True:
+            new_columns = np.any(possible[rows], axis=0)
+            new_rows = np.any(possible[:, new_columns], axis=1)
+            if (np.array_equal(new_columns, columns) and
+                    np.array_equal(new_rows, rows)):
+                break
+            rows, columns = new_rows, new_columns
+        unvisited &= ~rows
+        components.append((np.nonzero(rows)[0], np.nonzero(columns)[0]))
+    return components
+
+def unique_matches(log_matrix, ids):
+    '''
+    One-to-one match (Version 2): the assignment of blobs to features with the
+    most matches and then the highest total log likelihood, with each feature
+    matched at most once. Each gated component is solved separately with the
+    Hungarian method.
+    Input:
+        np.ndarray log_matrix (B, N)
+        list of int ids (N,) feature id for each column
+    Output:
+        list of int (B,) (0 for no match)
+    '''
+    result = [0]*log_matrix.shape[0]
+    for rows, columns in gated_components(log_matrix):
+        block = log_matrix[np.ix_(rows, columns)]
+        if len(rows) == 1:
+            result[rows[0]] = ids[columns[np.argmax(block[0])]]
+            continue
+        if len(columns) == 1:
+            result[rows[np.argmax(block[:, 0])]] = ids[columns[0]]
+            continue
+        cost = np.where(np.isfinite(block), -block, GATED_COST)
+        assigned_rows, assigned_columns = linear_sum_assignment(cost)
+        for row, column in zip(assigned_rows, assigned_columns):
+            if np.isfinite(block[row, column]):
+                result[rows[row]] = ids[columns[column]]
+    return result
@@ -0,0 +1,136 @@
+'''
+Co-visibility graph
+
+Graph of the features that have been seen together in a scan. Each edge counts
+how many scans matched both of its features. The Version 3 matcher (see
+FilterParticle.match_features_to_scan) starts from the features matched in the
+previous scan and searches outward along the strongest edges, since features
+seen together recently are the ones most likely to be seen next.
+
+Like LandmarkMap, a graph can be forked for resampled particles. Forks share
+the adjacency dicts, and a graph copies a node's dict the first time it
+changes that node.
+'''
+
+# pylint: disable=invalid-name
+
+class CovisibilityGraph(object):
+    def __init__(self):
+        # id -> {neighbor id -> number of scans that saw both}
+        self._edges = {}
+        # ids whose neighbor dicts only this graph references
+        self._owned = set()
+        # True when the outer dict may be shared with a fork
+        self._shared = False
+
+    def __len__(self):
+        return len(self._edges)
+
+    def __contains__(self, id_):
+        return id_ in self._edges
+
+    def fork(self):
+        '''
+        Create a graph with the same edges that shares its dicts with this one
+        until either changes
+        Output:
+            CovisibilityGraph
+        '''
+        child = CovisibilityGraph()
+        child._edges = self._edges
+        child._shared = True
+        self._shared = True
+        self._owned = set()
+        return child
+
+    def _own_edges(self):
+        '''
+        Make the outer dict private to this graph before changing it
+        '''
+        if self._shared:
+            self._edges = dict(self._edges)
+            self._shared = False
+
+    def _node(self, id_):
+        '''
+        Neighbor dict of id_ that is safe to modify
+        '''
+        self._own_edges()
+        if id_ not in self._owned:
+            self._edges[id_] = dict(self._edges.get(id_, {}))
+            self._owned.add(id_)
+        return self._edges[id_]
+
+    def neighbors(self, id_):
+        '''
+        Input:
+            id_
+        Output:
+            dict {neighbor id: co-observation count} (don't modify it)
+        '''
+        return self._edges.get(id_, {})
+
+    def weight(self, id_, other):
+        '''
+        Number of scans that saw both features
+        Output:
+            int
+        '''
+        return self._edges.get(id_, {}).get(other, 0)
+
+    def observe(self, ids):
+        '''
+        Record that the features were seen together in one scan
+        Input:
+            iterable ids
+        Output:
+            None
+        '''
+        ids = sorted(set(ids))
+        for id_ in ids:
+            node = self._node(id_)
+            for other in ids:
+                if other != id_:
+                    node[other] = node.get(other, 0) + 1
+
+    def remove(self, id_):
+        '''
+        Remove a feature and its edges (no error if it isn't in the graph)
+        '''
+        if id_ not in self._edges:
+            return
+        for other in list(self._edges[id_]):
+            self._node(other).pop(id_, None)
+        self._own_edges()
+        del self._edges[id_]
+        self._owned.discard(id_)
+
+    def expand(self, seeds, max_nodes, max_depth=2):
+        '''
+        Bounded breadth first search out from the seeds. Stronger edges are
+        followed first, and the search stops after max_nodes features or
+        max_depth edges from the seeds.
+        Input:
+            iterable seeds
+            int max_nodes
+            int max_depth
+        Output:
+            set of ids (including the seeds)
+        '''
+        found = set(seeds)
+        frontier = list(found)
+        depth = 0
+        while frontier and depth < max_depth and len(found) < max_nodes:
+            next_frontier = []
+            for id_ in frontier:
+                neighbors = self.neighbors(id_)
+                for other in sorted(neighbors, key=neighbors.get, reverse=True):
+                    if other in found:
+                        continue
+                    if len(found) >= max_nodes:
+                        return found
+                    found.add(other)
+                    next_frontier.append(other)
+            frontier = next_frontier
+            depth += 1
+        return found
@@ -0,0 +1,138 @@
+'''
+Distributed shards
+
+Runs the shards of a particle set (see sharding.py) on other machines. Each
+node serves one ShardWorker on a multiprocessing.connection Listener: a
+(host, port) address for TCP, or a filesystem path for a Unix socket when the
+node is on the same host. The coordinator (DistributedShards) connects to
+every node, hands each one its share of the particle maps and from then on
+sends each shard its particles' poses with every scan and gets their log
+likelihoods back. The motion update, weights and resampling stay on the
+coordinator, as with ShardPool.
+
+Resampling works as in ShardPool (see sharding.plan_shards): only the
+parents of the overflow are exported and sent through the coordinator to the
+shards that are short. All other parents are forked in place.
+
+A node runs whatever pickled commands arrive on its connection, so both ends
+must be given the same authkey; multiprocessing.connection checks it before
+any command is read. There is no unauthenticated mode.
+'''
+
+# pylint: disable=invalid-name
+
+import numpy as np
+import time
+
+from multiprocessing.connection import Client, Listener
+from sharding import ShardPool, ShardSlot, ShardWorker
+
+def check_authkey(authkey):
+    '''
+    Input:
+        bytes authkey
+    Output:
+        None
+    raises:
+        ValueError (no authkey, see the module docstring)
+    '''
+    if not authkey:
+        raise ValueError('shard nodes need an authkey')
+
+def serve_node(address, step, authkey):
+    '''
+    Serve one shard at the address until the coordinator stops it
+    Input:
+        (str host, int port) or str path address
+        function step (see sharding.ShardWorker)
+        bytes authkey (shared with the coordinator)
+    Output:
+        None
+    raises:
+        ValueError (no authkey)
+    '''
+    check_authkey(authkey)
+    listener = Listener(address, authkey=authkey)
+    try:
+        connection = listener.accept()
+        ShardWorker(step, {}).serve(connection)
+    finally:
+        listener.close()
+
+def connect(address, authkey, timeout=10.0):
+    '''
+    Connect to a node, retrying until it is listening or the timeout passes
+    Input:
+        (str host, int port) or str path address
+        bytes authkey
+        float timeout (seconds)
+    Output:
+        Connection
+    raises:
+        ValueError (no authkey)
+        socket.error (or OSError) when the node doesn't come up in time
+        multiprocessing.AuthenticationError (the node has another authkey)
+    '''
+    check_authkey(authkey)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except (IOError, OSError):
+            if time.time() > deadline:
+                raise
+            time.sleep(.05)
+
+class DistributedShards(ShardPool):
+    # pylint: disable=super-init-not-called
+    def __init__(self, store, addresses, authkey, slack=.1, timeout=10.0):
+        '''
+        Connect to the nodes and hand the store's maps over to them. The
+        store's maps are replaced with ShardSlots.
+        Input:
+            ParticleStore store
+            list of addresses (see serve_node)
+            bytes authkey
+            float slack (see plan_shards)
+            float timeout (for connecting, see connect)
+        raises:
+            ValueError (no authkey)
+        '''
+        check_authkey(authkey)
+        self.slack = slack
+        self.capacity = None
+        # parents sent between shards in the last resampling step
+        self.moved = 0
+        self.processes = []
+        self.connections = [connect(address, authkey, timeout)
+            for address in addresses]
+
+        slots = [None]*len(store)
+        messages = []
+        chunks = np.array_split(np.arange(0, len(store)), len(addresses))
+        for shard, chunk in enumerate(chunks):
+            maps = {}
+            for index in chunk.tolist():
+                maps[index] = store.maps[index]
+                slots[index] = ShardSlot(shard)
+            messages.append(('select', [(index, index) for index in maps],
+                maps))
+        self._scatter(messages)
+        store.maps = slots
+
+    def observe(self, store, scan, match_version, Qt, sqrt=False):
+        '''
+        Measurement update of every particle for one scan (see
+        ShardPool.observe). Each shard is sent the poses of its particles.
+        '''
+        poses = np.column_stack((store.x, store.y, store.heading))
+        owned = [[] for _ in self.connections]
+        for index, slot in enumerate(store.maps):
+            owned[slot.shard].append(index)
+        results = self._scatter([('observe_poses', indices, poses[indices],
+            scan, match_version, Qt, sqrt) for indices in owned])
+
+        log_likelihood = np.zeros(len(store))
+        for indices, values in zip(owned, results):
+            log_likelihood[indices] = values
+        return log_likelihood
@@ -0,0 +1,244 @@
+'''
+Batched EKF
+
+The landmark EKF update from FilterParticle (generate_measurement,
+measurement_jacobian, measurement_covariance, kalman_gain, Feature.update_mean,
+Feature.update_covar and importance_factor) for a whole stack of
+(pose, feature, observation) triples at once. Every step is one einsum or one
+stacked numpy.linalg call over all of the triples, so the cost per update is a
+few floating point operations instead of a dozen small array allocations.
+
+The math is the same as the per-feature methods, including their quirks: the
+expected bearing is not relative to the heading, and the importance factor
+uses the (Frobenius) norm of Q, as matrix.magnitude does.
+
+sparse_ekf_update is the same update specialized for the bearing + RGB
+measurement model. The Jacobian is a bearing row with two non-zero entries
+over an identity block for the color, so Q splits into a scalar bearing block
+and a 3x3 color block. Q is inverted with the Schur complement of the color
+block (closed form), and the likelihood reuses that factorization.
+
+sqrt_ekf_update works on the Cholesky factors of the covariances instead
+(square-root form). The gain and the likelihood come from triangular solves
+against the factor of Q, and the new factor is the old one with one rank-one
+downdate per measurement dimension, so the covariance stays symmetric and
+positive definite by construction.
+'''
+
+# pylint: disable=invalid-name
+
+import math
+import numpy as np
+
+from matrix import cholesky_rank_one_update, forward_substitute, mm
+from matrix import psd_cholesky
+
+LOG_2PI = math.log(2.0*math.pi)
+
+def expected_measurements(poses, means):
+    '''
+    Expected [bearing, r, g, b] measurement of each feature from each pose
+    (see FilterParticle.generate_measurement)
+    Input:
+        np.ndarray poses (T, 3) [x, y, heading]
+        np.ndarray means (T, 5) [x, y, r, g, b]
+    Output:
+        np.ndarray (T, 4)
+    '''
+    result = np.empty((len(means), 4))
+    result[:, 0] = np.arctan2(means[:, 1] - poses[:, 1],
+        means[:, 0] - poses[:, 0])
+    result[:, 1:4] = means[:, 2:5]
+    return result
+
+def measurement_jacobians(poses, means):
+    '''
+    Jacobian of the measurement with respect to the feature for each triple
+    (see FilterParticle.measurement_jacobian)
+    Input:
+        np.ndarray poses (T, 3)
+        np.ndarray means (T, 5)
+    Output:
+        np.ndarray (T, 4, 5)
+    '''
+    dx = means[:, 0] - poses[:, 0]
+    dy = means[:, 1] - poses[:, 1]
+    q = dx*dx + dy*dy
+    safe_q = np.where(q == 0.0, 1.0, q)
+
+    result = np.zeros((len(means), 4, 5))
+    result[:, 0, 0] = np.where(q == 0.0, 0.0, dy / safe_q)
+    result[:, 0, 1] = np.where(q == 0.0, 0.0, dx / safe_q)
+    result[:, 1, 2] = 1.0
+    result[:, 2, 3] = 1.0
+    result[:, 3, 4] = 1.0
+    return result
+
+def ekf_update(poses, means, covars, observations, Qt):
+    '''
+    EKF update of every feature with its observation, with the full 5x5
+    algebra. The filter uses sparse_ekf_update (or sqrt_ekf_update); this
+    dense version is not called by the filter, it is only kept as the
+    reference the tests check sparse_ekf_update against.
+    Input:
+        np.ndarray poses (T, 3) [x, y, heading]
+        np.ndarray means (T, 5)
+        np.ndarray covars (T, 5, 5)
+        np.ndarray observations (T, 4) [bearing, r, g, b]
+        np.ndarray Qt (4, 4) measurement noise
+    Output:
+        (np.ndarray means (T, 5), np.ndarray covars (T, 5, 5),
+            np.ndarray log importance factors (T,))
+    '''
+    if len(means) == 0:
+        return (np.zeros((0, 5)), np.zeros((0, 5, 5)), np.zeros(0))
+    bigH = measurement_jacobians(poses, means)
+    delz = observations - expected_measurements(poses, means)
+
+    # Q = H P H^T + Qt
+    bigQ = np.einsum('tij,tjk,tlk->til', bigH, covars, bigH) + Qt
+    bigQinv = np.linalg.inv(bigQ)
+    # K = P H^T Q^-1
+    bigK = np.einsum('tij,tkj,tkl->til', covars, bigH, bigQinv)
+
+    new_means = means + np.einsum('tij,tj->ti', bigK, delz)
+    adjust = np.identity(5) - np.einsum('tij,tjk->tik', bigK, bigH)
+    new_covars = np.einsum('tij,tjk->tik', adjust, covars)
+
+    norm = np.sqrt(np.sum(bigQ*bigQ, axis=(1, 2)))
+    maha = np.einsum('ti,tij,tj->t', delz, bigQinv, delz)
+    log_weights = -0.5*(LOG_2PI + np.log(norm)) - 0.5*maha
+    return (new_means, new_covars, log_weights)
+
+def inverse_3x3(matrices):
+    '''
+    Closed-form (adjugate) inverse and determinant of a stack of 3x3 matrices
+    Input:
+        np.ndarray matrices (T, 3, 3)
+    Output:
+        (np.ndarray inverses (T, 3, 3), np.ndarray determinants (T,))
+    '''
+    m = matrices
+    cofactors = np.empty_like(m)
+    cofactors[:, 0, 0] = m[:, 1, 1]*m[:, 2, 2] - m[:, 1, 2]*m[:, 2, 1]
+    cofactors[:, 0, 1] = m[:, 1, 2]*m[:, 2, 0] - m[:, 1, 0]*m[:, 2, 2]
+    cofactors[:, 0, 2] = m[:, 1, 0]*m[:, 2, 1] - m[:, 1, 1]*m[:, 2, 0]
+    cofactors[:, 1, 0] = m[:, 0, 2]*m[:, 2, 1] - m[:, 0, 1]*m[:, 2, 2]
+    cofactors[:, 1, 1] = m[:, 0, 0]*m[:, 2, 2] - m[:, 0, 2]*m[:, 2, 0]
+    cofactors[:, 1, 2] = m[:, 0, 1]*m[:, 2, 0] - m[:, 0, 0]*m[:, 2, 1]
+    cofactors[:, 2, 0] = m[:, 0, 1]*m[:, 1, 2] - m[:, 0, 2]*m[:, 1, 1]
+    cofactors[:, 2, 1] = m[:, 0, 2]*m[:, 1, 0] - m[:, 0, 0]*m[:, 1, 2]
+    cofactors[:, 2, 2] = m[:, 0, 0]*m[:, 1, 1] - m[:, 0, 1]*m[:, 1, 0]
+    det = np.einsum('ti,ti->t', m[:, 0, :], cofactors[:, 0, :])
+    inverses = np.transpose(cofactors, (0, 2, 1)) / det[:, np.newaxis, np.newaxis]
+    return (inverses, det)
+
+def sparse_ekf_update(poses, means, covars, observations, Qt):
+    '''
+    ekf_update using the block structure of the measurement Jacobian,
+    H = [[h_x, h_y, 0, 0, 0], [0, 0, I]]
+    Input:
+        (same as ekf_update)
+    Output:
+        (same as ekf_update)
+    '''
+    count = len(means)
+    if count == 0:
+        return (np.zeros((0, 5)), np.zeros((0, 5, 5)), np.zeros(0))
+    bigH = measurement_jacobians(poses, means)
+    h = bigH[:, 0, 0:2] # (T, 2)
+    delz = observations - expected_measurements(poses, means)
+
+    # P H^T (T, 5, 4): the bearing column, then the color columns of P
+    PHt = np.empty((count, 5, 4))
+    PHt[:, :, 0] = np.einsum('tij,tj->ti', covars[:, :, 0:2], h)
+    PHt[:, :, 1:4] = covars[:, :, 2:5]
+    # H P (T, 4, 5)
+    HP = np.empty((count, 4, 5))
+    HP[:, 0, :] = np.einsum('tj,tjk->tk', h, covars[:, 0:2, :])
+    HP[:, 1:4, :] = covars[:, 2:5, :]
+
+    # Q = H P H^T + Qt = [[s, b^T], [c, C]]
+    s = np.einsum('tj,tj->t', h, PHt[:, 0:2, 0]) + Qt[0, 0]
+    b = np.einsum('tj,tjk->tk', h, PHt[:, 0:2, 1:4]) + Qt[0, 1:4]
+    c = PHt[:, 2:5, 0] + Qt[1:4, 0]
+    C = covars[:, 2:5, 2:5] + Qt[1:4, 1:4]
+
+    # Schur complement of the color block
+    Cinv, _ = inverse_3x3(C)
+    Cinv_c = np.einsum('tij,tj->ti', Cinv, c)
+    bt_Cinv = np.einsum('tj,tjk->tk', b, Cinv)
+    sigma = s - np.einsum('tj,tj->t', b, Cinv_c)
+
+    bigQinv = np.empty((count, 4, 4))
+    bigQinv[:, 0, 0] = 1.0 / sigma
+    bigQinv[:, 0, 1:4] = -bt_Cinv / sigma[:, np.newaxis]
+    bigQinv[:, 1:4, 0] = -Cinv_c / sigma[:, np.newaxis]
+    bigQinv[:, 1:4, 1:4] = Cinv + (Cinv_c[:, :, np.newaxis] *
+        bt_Cinv[:, np.newaxis, :]) / sigma[:, np.newaxis, np.newaxis]
+
+    bigK = np.einsum('tij,tjk->tik', PHt, bigQinv)
+    new_means = means + np.einsum('tij,tj->ti', bigK, delz)
+    # (I - K H) P = P - K (H P)
+    new_covars = covars - np.einsum('tij,tjk->tik', bigK, HP)
+
+    # the likelihood reuses the inverse from the factorization; the norm of Q
+    #   is the norm of its blocks
+    maha = np.einsum('ti,tij,tj->t', delz, bigQinv, delz)
+    norm = np.sqrt(s*s + np.sum(b*b, axis=1) + np.sum(c*c, axis=1) +
+        np.sum(C*C, axis=(1, 2)))
+    log_weights = -0.5*(LOG_2PI + np.log(norm)) - 0.5*maha
+    return (new_means, new_covars, log_weights)
+
+def sqrt_ekf_update(poses, means, chols, observations, Qt):
+    '''
+    ekf_update in square-root form. With P = L L^T and the factor Lq of Q,
+    A = Lq^-1 H L and e = Lq^-1 (z - z_hat):
+        K (z - z_hat) = L A^T e
+        P - K Q K^T = L L^T - (L A^T)(L A^T)^T (rank-one downdates)
+        (z - z_hat)^T Q^-1 (z - z_hat) = e^T e
+    Input:
+        np.ndarray poses (T, 3)
+        np.ndarray means (T, 5)
+        np.ndarray chols (T, 5, 5) lower triangular covariance factors
+        np.ndarray observations (T, 4)
+        np.ndarray Qt (4, 4)
+    Output:
+        (np.ndarray means (T, 5), np.ndarray chols (T, 5, 5),
+            np.ndarray log importance factors (T,))
+    '''
+    count = len(means)
+    if count == 0:
+        return (np.zeros((0, 5)), np.zeros((0, 5, 5)), np.zeros(0))
+    h = measurement_jacobians(poses, means)[:, 0, 0:2]
+    delz = observations - expected_measurements(poses, means)
+
+    # H L (T, 4, 5): the bearing row, then the color rows of L
+    HL = np.empty((count, 4, 5))
+    HL[:, 0, :] = np.einsum('tj,tjk->tk', h, chols[:, 0:2, :])
+    HL[:, 1:4, :] = chols[:, 2:5, :]
+    bigQ = np.einsum('tij,tkj->tik', HL, HL) + Qt
+    Q_chol = np.linalg.cholesky(bigQ)
+
+    A = forward_substitute(Q_chol, HL)
+    e = forward_substitute(Q_chol, delz)
+    downdates = np.einsum('tij,tkj->tik', chols, A) # L A^T (T, 5, 4)
+
+    new_means = means + np.einsum('tik,tk->ti', downdates, e)
+    new_chols = chols
+    ok = np.ones(count, dtype=bool)
+    for column in range(0, 4):
+        new_chols, column_ok = cholesky_rank_one_update(new_chols,
+            downdates[:, :, column], -1.0)
+        ok &= column_ok
+    for row in np.nonzero(~ok)[0]:
+        # rounding made the downdate lose positive definiteness; refactor
+        covar = (mm(chols[row], chols[row].T) -
+            mm(downdates[row], downdates[row].T))
+        new_chols[row] = psd_cholesky(covar)
+
+    norm = np.sqrt(np.sum(bigQ*bigQ, axis=(1, 2)))
+    maha = np.sum(e*e, axis=1)
+    log_weights = -0.5*(LOG_2PI + np.log(norm)) - 0.5*maha
+    return (new_means, new_chols, log_weights)
+
@@ -0,0 +1,226 @@
+'''
+Ingest queue
+
+Timestamped queue between the ROS callbacks and the filter. The /cmd_vel and
+/camera/features callbacks only push the message with its stamp and return;
+one filter worker thread (IngestWorker) takes the queued messages in stamp
+order and runs the motion and measurement updates. The filter is only ever
+touched by that thread.
+
+Every queued scan is handed to the worker exactly once. The queue holds at
+most max_scans scans: when the filter falls further behind than that, the
+oldest waiting scan is dropped and counted (see IngestQueue.dropped), never
+skipped silently. Twists are never dropped, since every twist is needed to
+move the particles.
+
+ScanTracker remembers which scans the filter has already fused, so that a
+scan handed over twice (e.g. the same last_sensor_reading on every loop) is
+only used once, and counts the processed, duplicate and dropped scans.
+'''
+
+# pylint: disable=invalid-name
+
+import collections
+import heapq
+import itertools
+import rospy
+import threading
+import traceback
+
+SCAN = 'scan'
+TWIST = 'twist'
+
+def message_stamp(msg):
+    '''
+    Stamp of a message in seconds: its header stamp, or the current time for
+    messages without one (Twist) or with an unset stamp
+    Input:
+        ROS message msg
+    Output:
+        float
+    '''
+    header = getattr(msg, 'header', None)
+    if header is not None:
+        stamp = header.stamp.to_sec()
+        if stamp > 0.0:
+            return stamp
+    return rospy.Time.now().to_sec()
+
+class IngestQueue(object):
+    def __init__(self, max_scans=10):
+        # heap of (stamp, arrival order, kind, message)
+        self._heap = []
+        self._order = itertools.count()
+        self._ready = threading.Condition(threading.Lock())
+        self._closed = False
+        self.max_scans = max_scans
+        # scans in the queue, and scans dropped because the queue was full
+        self.scans = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, kind, message, stamp=None):
+        '''
+        Queue a message (from a callback thread)
+        Input:
+            str kind (SCAN or TWIST)
+            ROS message
+            float stamp (defaults to message_stamp(message))
+        Output:
+            None
+        '''
+        if stamp is None:
+            stamp = message_stamp(message)
+        with self._ready:
+            heapq.heappush(self._heap, (stamp, next(self._order), kind,
+                message))
+            if kind == SCAN:
+                self.scans += 1
+                if self.scans > self.max_scans:
+                    self._drop_oldest_scan()
+            self._ready.notify()
+
+    def put_scan(self, scan, stamp=None):
+        self.put(SCAN, scan, stamp)
+
+    def put_twist(self, twist, stamp=None):
+        self.put(TWIST, twist, stamp)
+
+    def _drop_oldest_scan(self):
+        '''
+        Remove the scan with the earliest stamp (the queue is locked)
+        '''
+        oldest = min((item, i) for i, item in enumerate(self._heap)
+            if item[2] == SCAN)[1]
+        self._heap[oldest] = self._heap[-1]
+        self._heap.pop()
+        heapq.heapify(self._heap)
+        self.scans -= 1
+        self.dropped += 1
+        rospy.logwarn('ingest: filter is behind, dropped a scan (%d so far)' %
+            (self.dropped,))
+
+    def get_batch(self, timeout=None):
+        '''
+        Wait for messages and take every queued one (from the worker thread)
+        Input:
+            float timeout (seconds, wait forever if None)
+        Output:
+            list of (float stamp, str kind, message) in stamp order (empty if
+                the timeout passed), or None once the queue is closed and empty
+        '''
+        with self._ready:
+            if not self._heap and not self._closed:
+                self._ready.wait(timeout)
+            if not self._heap:
+                return None if self._closed else []
+            batch = [heapq.heappop(self._heap) for _ in range(0,
+                len(self._heap))]
+            self.scans = 0
+        return [(stamp, kind, message) for stamp, _, kind, message in batch]
+
+    def close(self):
+        '''
+        Shut the queue down: the worker drains what is queued and exits.
+        '''
+        with self._ready:
+            self._closed = True
+            self._ready.notify_all()
+
+class IngestWorker(threading.Thread):
+    '''
+    The filter worker: hands each queued message to the handler for its kind
+    (handler(message, stamp)) until the queue is closed
+    '''
+    def __init__(self, queue, handlers):
+        '''
+        Input:
+            IngestQueue queue
+            dict {kind: function handler(message, float stamp)}
+        '''
+        threading.Thread.__init__(self, name='ingest')
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            batch = self.queue.get_batch()
+            if batch is None:
+                return
+            for stamp, kind, message in batch:
+                try:
+                    self.handlers[kind](message, stamp)
+                except Exception: # pylint: disable=broad-except
+                    rospy.logerr('ingest: %s handler failed\n%s' % (kind,
+                        traceback.format_exc()))
+
+def scan_identity(scan):
+    '''
+    Identity of a scan: its header seq and stamp if either is set, otherwise a
+    hash of its blobs (so an unstamped scan is a repeat if it has exactly the
+    same blobs as one seen recently)
+    Input:
+        VizScan scan
+    Output:
+        hashable tuple
+    '''
+    header = scan.header
+    if header.seq or header.stamp.secs or header.stamp.nsecs:
+        return ('header', header.seq, header.stamp.secs, header.stamp.nsecs)
+    return ('content', hash(tuple((blob.bearing, blob.color.r, blob.color.g,
+        blob.color.b) for blob in scan.observes)))
+
+class ScanTracker(object):
+    def __init__(self, memory=64):
+        # identities of the last memory scans that were accepted
+        self._recent = collections.deque(maxlen=memory)
+        self._seen = set()
+        self._last_seq = None
+        self.processed = 0
+        self.duplicate = 0
+        # scans that never arrived, from gaps in the header seq
+        self.dropped = 0
+
+    def accept(self, scan):
+        '''
+        Check a scan before fusing it, and count it
+        Input:
+            VizScan scan
+        Output:
+            bool (False if the scan was seen before and should be skipped)
+        '''
+        identity = scan_identity(scan)
+        if identity in self._seen:
+            self.duplicate += 1
+            return False
+        if len(self._recent) == self._recent.maxlen:
+            self._seen.discard(self._recent[0])
+        self._recent.append(identity)
+        self._seen.add(identity)
+        self.processed += 1
+
+        seq = scan.header.seq
+        if identity[0] == 'header' and seq:
+            if self._last_seq is None:
+                self._last_seq = seq
+            elif seq > self._last_seq:
+                self.dropped += seq - self._last_seq - 1
+                self._last_seq = seq
+            elif self.dropped > 0:
+                # a late scan that was counted as dropped
+                self.dropped -= 1
+        return True
+
+    def counters(self):
+        '''
+        Output:
+            dict {'processed': int, 'duplicate': int, 'dropped': int}
+        '''
+        return {
+            'processed': self.processed,
+            'duplicate': self.duplicate,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,90 @@
+'''
+KLD-sampling
+
+Adaptive particle count for the particle filter (Fox, "Adapting the Sample Size
+in Particle Filters Through KLD-Sampling"). The pose posterior is put into a
+spatial histogram over (x, y, heading). The more bins the particles occupy, the
+more particles are needed to keep the error of the sample-based approximation
+(the Kullback-Leibler distance) below epsilon with probability 1 - delta.
+'''
+
+# pylint: disable=invalid-name
+
+import math
+import numpy as np
+
+from numpy.random import random_sample
+from resampling import normalize
+
+# upper 1 - delta quantile of the standard normal distribution, delta = 0.01
+DEFAULT_Z = 2.326
+
+def kld_sample_size(k, epsilon=.05, z=DEFAULT_Z):
+    '''
+    Number of samples needed for k occupied bins
+    Input:
+        int or np.ndarray k (number of occupied histogram bins)
+        float epsilon (allowed KL distance)
+        float z (upper 1 - delta quantile of the standard normal)
+    Output:
+        np.ndarray (same shape as k)
+    '''
+    k = np.asarray(k, dtype=float)
+    # a single occupied bin has no spread, so there is no bound to satisfy
+    safe_k = np.maximum(k, 2.0)
+    a = 2.0 / (9.0 * (safe_k - 1.0))
+    size = ((safe_k - 1.0) / (2.0 * epsilon) *
+        np.power(1.0 - a + np.sqrt(a) * z, 3))
+    return np.where(k > 1.0, np.ceil(size), 0.0)
+
+def histogram_bins(x, y, heading, bin_size):
+    '''
+    Integer (x, y, heading) histogram bin for every pose
+    Input:
+        np.ndarray x, y, heading (M,)
+        (float, float, float) bin_size (x, y, heading)
+    Output:
+        np.ndarray (M, 3) int
+    '''
+    wrapped = np.mod(heading, 2.0*math.pi)
+    bins = np.empty((len(x), 3), dtype=np.int64)
+    bins[:, 0] = np.floor(x / bin_size[0])
+    bins[:, 1] = np.floor(y / bin_size[1])
+    bins[:, 2] = np.floor(wrapped / bin_size[2])
+    return bins
+
+def kld_particle_count(x, y, heading, weights, min_count, max_count,
+    bin_size=(.25, .25, math.pi/18.0), epsilon=.05, z=DEFAULT_Z):
+    '''
+    Pick the number of particles for the next generation. Up to max_count
+    samples are drawn from the weighted particle set (in random order), and the
+    count is the first sample count that covers the KLD bound for the number of
+    bins occupied so far.
+    Input:
+        np.ndarray x, y, heading, weights (M,)
+        int min_count, max_count
+        (float, float, float) bin_size (x, y, heading)
+        float epsilon, z (see kld_sample_size)
+    Output:
+        int
+    '''
+    cumulative = np.cumsum(normalize(weights))
+    draws = np.searchsorted(cumulative, random_sample(max_count), side='right')
+    draws = np.minimum(draws, len(cumulative) - 1)
+
+    bins = histogram_bins(x[draws], y[draws], heading[draws], bin_size)
+    # one opaque key per row so that np.unique works on whole bins
+    keys = np.ascontiguousarray(bins).view(
+        np.dtype((np.void, bins.dtype.itemsize * 3))).ravel()
+    _, first = np.unique(keys, return_index=True)
+
+    new_bin = np.zeros(max_count, dtype=bool)
+    new_bin[first] = True
+    occupied = np.cumsum(new_bin)
+
+    samples = np.arange(1, max_count + 1)
+    enough = (samples >= kld_sample_size(occupied, epsilon, z))
+    enough &= (samples >= min_count)
+    if not np.any(enough):
+        return int(max_count)
+    return int(np.argmax(enough)) + 1
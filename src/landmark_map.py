@@ -0,0 +1,266 @@
+'''
+Copy-on-write landmark map
+
+A dict-like map from id to Feature that resampled particles can share. Forking
+a map does not copy any Features: siblings keep reading the same objects, and a
+Feature is only copied the first time a particle asks to update it (see
+LandmarkMap.mutable).
+
+Internally a map is a shared, never modified base dict plus a small private
+delta of the entries that were added, replaced or removed since the base was
+built. A fork copies only the delta, so its cost depends on how much the map
+changed recently, not on the size of the map. When the delta gets large
+compared to the base it is folded into a new base.
+
+Values must be replaced rather than modified in place (Feature.update_mean and
+Feature.update_covar assign new arrays), unless they came from mutable().
+
+Every change to a map gives it a new version number, and a fork starts with
+its parent's version, so two maps with the same version have the same contents
+(FastSLAM uses this to share data association between particles).
+
+For the vectorized kernels, arrays() packs the means and covariances of the
+map's Features into numpy arrays, along with the inverses and log
+determinants that each Feature caches (see Feature.match_terms), and keeps
+them until the map changes.
+subset_arrays() packs only the Features it is asked for, so its cost depends
+on how many there are, not on the size of the map or on whether it changed.
+
+A map can also keep GridIndexes (see spatial_index.py) of its Features' x, y
+means and r, g, b means, which are forked along with the map. Setting or
+deleting a Feature keeps the indexes current; after changing a Feature's mean
+through mutable(), call reindex().
+'''
+
+# pylint: disable=invalid-name
+
+import itertools
+import numpy as np
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+_versions = itertools.count(1)
+
+def pack_features(features):
+    '''
+    Means, covariances and match terms of Features as arrays
+    Input:
+        list of Features (N,)
+    Output:
+        (np.ndarray means (N, 5), np.ndarray covars (N, 5, 5),
+            np.ndarray inverses (N, 5, 5), np.ndarray log_dets (N, 2))
+    '''
+    if not features:
+        return (np.zeros((0, 5)), np.zeros((0, 5, 5)), np.zeros((0, 5, 5)),
+            np.zeros((0, 2)))
+    terms = [feature.match_terms() for feature in features]
+    means = np.array([np.ravel(feature.mean) for feature in features],
+        dtype=float)
+    covars = np.array([feature.covar for feature in features], dtype=float)
+    inverses = np.array([inverse for inverse, _ in terms])
+    log_dets = np.array([log_det for _, log_det in terms])
+    return (means, covars, inverses, log_dets)
+
+def next_version():
+    '''
+    A version number that no landmark map has had yet
+    Output:
+        int
+    '''
+    return next(_versions)
+
+class IndexedLandmarks(object):
+    '''
+    Color and spatial index upkeep shared by the landmark map types. The
+    subclass sets position_index and color_index (GridIndexes or None).
+    '''
+    def _indexes(self):
+        '''
+        The map's indexes and the columns of the mean that each one covers
+        '''
+        if self.position_index is not None:
+            yield (self.position_index, (0, 1))
+        if self.color_index is not None:
+            yield (self.color_index, (2, 3, 4))
+
+    def _index(self, key, value):
+        '''
+        Put the value's mean into the indexes (values without a mean, like
+        hypothesis readings, aren't indexed)
+        '''
+        mean = getattr(value, 'mean', None)
+        for index, columns in self._indexes():
+            if mean is None:
+                index.remove(key)
+            else:
+                index.insert(key, [mean[column] for column in columns])
+
+    def reindex(self, key):
+        '''
+        Move the key's entries in the indexes after its mean changed
+        Input:
+            key
+        Output:
+            None
+        raises:
+            KeyError
+        '''
+        self._index(key, self[key])
+
+class LandmarkMap(IndexedLandmarks, MutableMapping):
+    def __init__(self, items=None, index=None, color_index=None):
+        self._base = {}
+        self._delta = {}
+        self._removed = set()
+        # ids of values that only this map references (safe to modify)
+        self._owned = set()
+        self._size = 0
+        self._arrays = None
+        self.version = next_version()
+        # GridIndex of the x, y means, or None
+        self.position_index = index
+        # GridIndex of the r, g, b means, or None
+        self.color_index = color_index
+        if items is not None:
+            self.update(items)
+
+    def __getitem__(self, key):
+        if key in self._delta:
+            return self._delta[key]
+        if key in self._removed:
+            raise KeyError(key)
+        return self._base[key]
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._size += 1
+        self._delta[key] = value
+        self._removed.discard(key)
+        self._owned.discard(key)
+        self._arrays = None
+        self.version = next_version()
+        self._index(key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._delta.pop(key, None)
+        if key in self._base:
+            self._removed.add(key)
+        self._owned.discard(key)
+        self._size -= 1
+        self._arrays = None
+        self.version = next_version()
+        for index, _ in self._indexes():
+            index.remove(key)
+
+    def __contains__(self, key):
+        if key in self._delta:
+            return True
+        return key in self._base and key not in self._removed
+
+    def __iter__(self):
+        for key in self._delta:
+            yield key
+        for key in self._base:
+            if key not in self._delta and key not in self._removed:
+                yield key
+
+    def __len__(self):
+        return self._size
+
+    def compact(self):
+        '''
+        Fold the delta into a new base dict. The old base is left alone because
+        other maps may still be using it.
+        '''
+        if not self._delta and not self._removed:
+            return
+        base = dict(self._base)
+        for key in self._removed:
+            del base[key]
+        base.update(self._delta)
+        self._base = base
+        self._delta = {}
+        self._removed = set()
+
+    def fork(self):
+        '''
+        Create a new map with the same contents that shares all of the values
+        with this one. After a fork, neither map owns any of its values.
+        Output:
+            LandmarkMap
+        '''
+        if len(self._delta) + len(self._removed) > max(8, len(self._base)//4):
+            self.compact()
+        child = LandmarkMap()
+        if self.position_index is not None:
+            child.position_index = self.position_index.fork()
+        if self.color_index is not None:
+            child.color_index = self.color_index.fork()
+        child._base = self._base
+        child._delta = dict(self._delta)
+        child._removed = set(self._removed)
+        child._size = self._size
+        child._arrays = self._arrays
+        child.version = self.version
+        self._owned = set()
+        return child
+
+    def mutable(self, key):
+        '''
+        Get the value for key so that it can be modified in place. The value is
+        copied (value.copy()) the first time unless this map already owns it.
+        Immutable features are returned as they are.
+        Input:
+            key
+        Output:
+            value (Feature)
+        raises:
+            KeyError
+        '''
+        value = self[key]
+        if getattr(value, '__immutable__', False):
+            return value
+        # the caller is about to change the value
+        self._arrays = None
+        self.version = next_version()
+        if key in self._owned:
+            return value
+        value = value.copy()
+        self._delta[key] = value
+        self._owned.add(key)
+        return value
+
+    def arrays(self):
+        '''
+        Pack the Features in the map into arrays (in iteration order). The
+        result is cached until the map changes, including a mutable() call.
+        Output:
+            (list of ids (N,), np.ndarray means (N, 5),
+                np.ndarray covars (N, 5, 5), np.ndarray inverses (N, 5, 5),
+                np.ndarray log_dets (N, 2)) (see
+                correspondence.covariance_terms)
+        '''
+        if self._arrays is None:
+            ids = list(self)
+            self._arrays = (ids,) + pack_features([self[key] for key in ids])
+        return self._arrays
+
+    def subset_arrays(self, keys):
+        '''
+        arrays() for only the given keys (in sorted order), packed straight
+        from their Features
+        Input:
+            iterable keys
+        Output:
+            (list of ids, np.ndarray means (n, 5), np.ndarray covars (n, 5, 5),
+                np.ndarray inverses (n, 5, 5), np.ndarray log_dets (n, 2))
+        raises:
+            KeyError
+        '''
+        ids = sorted(keys)
+        return (ids,) + pack_features([self[key] for key in ids])
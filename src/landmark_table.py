@@ -0,0 +1,297 @@
+'''
+Packed landmark table
+
+A dict-like map from id to feature, like LandmarkMap, that keeps every feature
+in a few packed arrays instead of one Feature object per landmark:
+    - means (N, 5)
+    - covariances (N, 5, 5)
+    - update counts (N,)
+    - flags (N,) (immutable, terms current)
+    - inverses (N, 5, 5) and log determinants (N, 2) of the covariance blocks
+      (see correspondence.covariance_terms), computed when first needed after
+      the covariance changes
+plus an id -> row map. Rows of deleted features go on a free list and are
+reused by the next insert. Reading a feature returns a lightweight view of its
+row (see prkt_core_v2.FeatureView) that reads and writes the arrays.
+
+The rows are stored in pages of PAGE_ROWS rows, each with its own arrays.
+Forks share the pages, and a write copies only the page it touches, so a
+particle that updates a few landmarks after resampling copies a few pages,
+not the whole table. The id -> row map is a LandmarkMap, which forks just as
+cheaply. The vectorized kernels gather rows straight out of the pages (see
+subset_arrays).
+
+A view stays tied to its row: don't hold on to one across a delete of its
+feature.
+'''
+
+# pylint: disable=invalid-name
+
+import numpy as np
+
+from correspondence import covariance_terms
+from landmark_map import IndexedLandmarks, LandmarkMap, next_version
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+IMMUTABLE = 1
+# the row's inverses and log_dets match its covariance
+TERMS = 2
+
+PAGE_ROWS = 64
+
+def new_page():
+    '''
+    Arrays for PAGE_ROWS empty rows. keys holds the id in each row (None for
+    unused rows) and sqrts the cached Cholesky factor of each row's covariance
+    (see FeatureView).
+    Output:
+        dict {column name: np.ndarray (PAGE_ROWS, ...)}
+    '''
+    return {
+        'means': np.zeros((PAGE_ROWS, 5)),
+        'covars': np.zeros((PAGE_ROWS, 5, 5)),
+        'counts': np.zeros(PAGE_ROWS, dtype=np.int64),
+        'flags': np.zeros(PAGE_ROWS, dtype=np.uint8),
+        'inverses': np.zeros((PAGE_ROWS, 5, 5)),
+        'log_dets': np.zeros((PAGE_ROWS, 2)),
+        'keys': np.array([None]*PAGE_ROWS, dtype=object),
+        'sqrts': np.array([None]*PAGE_ROWS, dtype=object),
+    }
+
+def refresh_terms(page, offsets):
+    '''
+    Compute the terms of the rows whose covariance changed since they were
+    last computed. The terms only depend on the covariance, so they are
+    written even if the page is shared with a fork: the fork has the same
+    covariances.
+    Input:
+        dict page (see new_page)
+        np.ndarray offsets (int) of the rows in the page
+    Output:
+        None
+    '''
+    stale = offsets[(page['flags'][offsets] & TERMS) == 0]
+    if len(stale) == 0:
+        return
+    inverses, log_dets = covariance_terms(page['covars'][stale])
+    page['inverses'][stale] = inverses
+    page['log_dets'][stale] = log_dets
+    page['flags'][stale] |= TERMS
+
+class LandmarkTable(IndexedLandmarks, MutableMapping):
+    def __init__(self, view_class, items=None, index=None, color_index=None):
+        # view_class(table, row) makes the feature views
+        self._view_class = view_class
+        self._pages = []
+        # numbers of the pages that only this table uses (safe to write)
+        self._owned = set()
+        # id -> row
+        self._rows = LandmarkMap()
+        self._free = []
+        # rows at or above top have never been used
+        self._top = 0
+        self._arrays = None
+        self.version = next_version()
+        self.position_index = index
+        self.color_index = color_index
+        if items is not None:
+            self.update(items)
+
+    def __getitem__(self, key):
+        return self._view_class(self, self._rows[key])
+
+    def __setitem__(self, key, value):
+        if key in self._rows:
+            row = self._rows[key]
+        else:
+            row = self._allocate()
+            self._rows[key] = row
+        page, offset = self.writable(row)
+        page['keys'][offset] = key
+        page['means'][offset] = np.ravel(value.mean)
+        page['counts'][offset] = value.update_count
+        page['flags'][offset] = IMMUTABLE if value.__immutable__ else 0
+        self.set_covar(row, value.covar)
+        self._index(key, value)
+
+    def __delitem__(self, key):
+        if key not in self._rows:
+            raise KeyError(key)
+        row = self._rows[key]
+        del self._rows[key]
+        page, offset = self.writable(row)
+        page['keys'][offset] = None
+        page['sqrts'][offset] = None
+        self._free.append(row)
+        for index, _ in self._indexes():
+            index.remove(key)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __iter__(self):
+        for row in range(0, self._top):
+            key = self._pages[row // PAGE_ROWS]['keys'][row % PAGE_ROWS]
+            if key is not None:
+                yield key
+
+    def __len__(self):
+        return len(self._rows)
+
+    def page(self, row):
+        '''
+        The page that holds a row, for reading
+        Input:
+            int row
+        Output:
+            (dict page (see new_page), int offset of the row in the page)
+        '''
+        return (self._pages[row // PAGE_ROWS], row % PAGE_ROWS)
+
+    def writable(self, row):
+        '''
+        The page that holds a row, for writing. The page is copied first if a
+        fork may share it. Every write changes the version and drops the
+        cached arrays.
+        Input:
+            int row
+        Output:
+            (dict page (see new_page), int offset of the row in the page)
+        '''
+        number = row // PAGE_ROWS
+        if number not in self._owned:
+            self._pages[number] = dict((name, column.copy())
+                for name, column in self._pages[number].items())
+            self._owned.add(number)
+        self._arrays = None
+        self.version = next_version()
+        return (self._pages[number], row % PAGE_ROWS)
+
+    def set_covar(self, row, covar):
+        '''
+        Write a row's covariance, and drop the terms and factor derived from
+        it
+        Input:
+            int row
+            np.ndarray covar (5, 5)
+        Output:
+            None
+        '''
+        page, offset = self.writable(row)
+        page['covars'][offset] = covar
+        page['flags'][offset] &= IMMUTABLE
+        page['sqrts'][offset] = None
+
+    def row_terms(self, row):
+        '''
+        The inverses and log determinants of a row's covariance blocks
+        Input:
+            int row
+        Output:
+            (np.ndarray inverses (5, 5), np.ndarray log_dets (2,))
+        '''
+        page, offset = self.page(row)
+        offsets = np.array([offset])
+        refresh_terms(page, offsets)
+        return (page['inverses'][offset].copy(),
+            page['log_dets'][offset].copy())
+
+    def _allocate(self):
+        '''
+        A free row, adding a page if the pages are full
+        '''
+        if self._free:
+            return self._free.pop()
+        if self._top == len(self._pages) * PAGE_ROWS:
+            self._owned.add(len(self._pages))
+            self._pages.append(new_page())
+        self._top += 1
+        return self._top - 1
+
+    def fork(self):
+        '''
+        Create a new table with the same contents that shares the pages with
+        this one until either writes to them
+        Output:
+            LandmarkTable
+        '''
+        child = LandmarkTable(self._view_class)
+        child._pages = list(self._pages)
+        child._rows = self._rows.fork()
+        child._free = list(self._free)
+        child._top = self._top
+        child._arrays = self._arrays
+        child.version = self.version
+        if self.position_index is not None:
+            child.position_index = self.position_index.fork()
+        if self.color_index is not None:
+            child.color_index = self.color_index.fork()
+        self._owned = set()
+        return child
+
+    def mutable(self, key):
+        '''
+        Get the feature for key so that it can be modified. Views write
+        through the table, which copies the row's page first if it is shared,
+        so this is the same as self[key].
+        Input:
+            key
+        Output:
+            FeatureView
+        raises:
+            KeyError
+        '''
+        return self[key]
+
+    def arrays(self):
+        '''
+        The features in the table as arrays (in row order). The result is
+        cached until the table changes.
+        Output:
+            (list of ids (N,), np.ndarray means (N, 5),
+                np.ndarray covars (N, 5, 5), np.ndarray inverses (N, 5, 5),
+                np.ndarray log_dets (N, 2)) (see
+                correspondence.covariance_terms)
+        '''
+        if self._arrays is None:
+            self._arrays = self.subset_arrays(self._rows)
+        return self._arrays
+
+    def subset_arrays(self, keys):
+        '''
+        arrays() for only the given keys (in row order), gathered straight
+        from the pages
+        Input:
+            iterable keys
+        Output:
+            (list of ids, np.ndarray means (n, 5), np.ndarray covars (n, 5, 5),
+                np.ndarray inverses (n, 5, 5), np.ndarray log_dets (n, 2))
+        raises:
+            KeyError
+        '''
+        rows = np.array(sorted(self._rows[key] for key in keys), dtype=int)
+        means = np.zeros((len(rows), 5))
+        covars = np.zeros((len(rows), 5, 5))
+        inverses = np.zeros((len(rows), 5, 5))
+        log_dets = np.zeros((len(rows), 2))
+        ids = []
+        if len(rows) == 0:
+            return (ids, means, covars, inverses, log_dets)
+        numbers = rows // PAGE_ROWS
+        # rows is sorted, so the rows of each page are next to each other
+        starts = np.flatnonzero(np.diff(numbers)) + 1
+        for start, end in zip([0] + starts.tolist(),
+            starts.tolist() + [len(rows)]):
+            page = self._pages[numbers[start]]
+            offsets = rows[start:end] % PAGE_ROWS
+            refresh_terms(page, offsets)
+            means[start:end] = page['means'][offsets]
+            covars[start:end] = page['covars'][offsets]
+            inverses[start:end] = page['inverses'][offsets]
+            log_dets[start:end] = page['log_dets'][offsets]
+            ids.extend(page['keys'][offsets].tolist())
+        return (ids, means, covars, inverses, log_dets)
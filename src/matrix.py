@@ -1,3 +1,4 @@
+import math
 import numpy as np
 
 from numpy import dot as mm
@@ -36,4 +37,138 @@ def blob_to_matrix(blob):
     if isinstance(blob, Blob):
         return np.array([blob.bearing, blob.color.r, blob.color.g, blob.color.b])
     else:
-        return blob
\ No newline at end of file
+        return blob
+
+def blobs_to_matrix(blobs):
+    '''
+    Stack the bearing and color of every blob into an array, one row per blob
+    Input:
+        list of Blob
+    Output:
+        np.ndarray (B, 4) [bearing, r, g, b]
+    '''
+    result = np.zeros((len(blobs), 4))
+    for row, blob in enumerate(blobs):
+        result[row] = (blob.bearing, blob.color.r, blob.color.g, blob.color.b)
+    return result
+
+class CovarianceFactor(object):
+    '''
+    Cholesky factor, inverse and log determinant of a covariance matrix,
+    computed once so that repeated Gaussian densities don't have to
+    re-derive them. Pass the Cholesky factor if it is already known.
+    raises:
+        np.linalg.LinAlgError (covariance is not positive definite)
+    '''
+    def __init__(self, covar, cholesky=None):
+        self.covar = np.asarray(covar, dtype=float)
+        if cholesky is None:
+            cholesky = np.linalg.cholesky(self.covar)
+        self.cholesky = cholesky
+        inv_cholesky = np.linalg.inv(self.cholesky)
+        self.inverse = mm(inv_cholesky.T, inv_cholesky)
+        self.log_det = 2.0*float(np.sum(np.log(np.diag(self.cholesky))))
+
+    def log_pdf(self, delta):
+        '''
+        Log density of an offset from the mean
+        Input:
+            np.ndarray delta (n,)
+        Output:
+            float
+        '''
+        return log_pdf(delta, self.inverse, self.log_det)
+
+def log_pdf(delta, inverse, log_det):
+    '''
+    Log density of an offset from the mean of a Gaussian, given the inverse
+    and log determinant of its covariance (see CovarianceFactor and
+    Feature.match_terms)
+    Input:
+        np.ndarray delta (n,)
+        np.ndarray inverse (n, n)
+        float log_det (inf for a covariance that is not positive definite)
+    Output:
+        float (-inf for a covariance that is not positive definite)
+    '''
+    if not np.isfinite(log_det):
+        return float('-inf')
+    delta = np.ravel(delta)
+    maha = float(mm(mm(delta, inverse), delta))
+    return -0.5*(maha + len(delta)*math.log(2.0*math.pi) + log_det)
+
+# smallest eigenvalue (relative to the largest) that psd_cholesky keeps
+PSD_FLOOR = 1e-12
+
+def psd_cholesky(covar):
+    '''
+    Lower triangular Cholesky factor of the symmetric part of covar. If that
+    isn't positive definite (the plain covariance update drifts), factor the
+    nearest positive definite matrix instead, with the eigenvalues clipped.
+    Input:
+        np.ndarray covar (n, n)
+    Output:
+        np.ndarray (n, n)
+    '''
+    symmetric = 0.5*(covar + np.transpose(covar))
+    try:
+        return np.linalg.cholesky(symmetric)
+    except np.linalg.LinAlgError:
+        values, vectors = np.linalg.eigh(symmetric)
+        floor = PSD_FLOOR*max(1.0, float(np.max(np.abs(values))))
+        values = np.maximum(values, floor)
+        return np.linalg.cholesky(mm(vectors*values, vectors.T))
+
+def forward_substitute(lower, rhs):
+    '''
+    Solve L X = B for a stack of lower triangular matrices
+    Input:
+        np.ndarray lower (T, n, n)
+        np.ndarray rhs (T, n) or (T, n, k)
+    Output:
+        np.ndarray (same shape as rhs)
+    '''
+    vector = (rhs.ndim == 2)
+    if vector:
+        rhs = rhs[:, :, np.newaxis]
+    result = np.empty(rhs.shape)
+    for i in range(0, lower.shape[1]):
+        known = np.einsum('tj,tjk->tk', lower[:, i, 0:i], result[:, 0:i])
+        result[:, i] = (rhs[:, i] - known) / lower[:, i, i, np.newaxis]
+    if vector:
+        return result[:, :, 0]
+    return result
+
+def cholesky_rank_one_update(lower, vectors, sign=1.0):
+    '''
+    Rank-one update (sign 1) or downdate (sign -1) of a stack of Cholesky
+    factors: the factor of L L^T + sign v v^T, in O(n^2) instead of
+    refactoring
+    Input:
+        np.ndarray lower (T, n, n)
+        np.ndarray vectors (T, n)
+        float sign
+    Output:
+        (np.ndarray lower (T, n, n), np.ndarray bool ok (T,)) ok is False
+        where a downdate would have lost positive definiteness (the factor
+        there is not valid)
+    '''
+    lower = np.array(lower, dtype=float)
+    vectors = np.array(vectors, dtype=float)
+    ok = np.ones(lower.shape[0], dtype=bool)
+    for k in range(0, lower.shape[1]):
+        diagonal = lower[:, k, k]
+        squared = diagonal*diagonal + sign*vectors[:, k]*vectors[:, k]
+        ok &= (squared > 0.0) & (diagonal > 0.0)
+        safe_diagonal = np.where(diagonal > 0.0, diagonal, 1.0)
+        r = np.sqrt(np.where(squared > 0.0, squared, 1.0))
+        c = r / safe_diagonal
+        s = vectors[:, k] / safe_diagonal
+        lower[:, k, k] = r
+        if k + 1 < lower.shape[1]:
+            lower[:, k+1:, k] = ((lower[:, k+1:, k] +
+                sign*s[:, np.newaxis]*vectors[:, k+1:]) / c[:, np.newaxis])
+            vectors[:, k+1:] = (c[:, np.newaxis]*vectors[:, k+1:] -
+                s[:, np.newaxis]*lower[:, k+1:, k])
+    return (lower, ok)
+
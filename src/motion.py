@@ -0,0 +1,90 @@
+'''
+Batched motion model
+
+Vectorized version of the FastSLAM twist motion model. All of the drive and
+heading noise for M particles is drawn in one call, and every pose is advanced
+in one step.
+
+    pS      h1        |
+    0-----------------0
+    |                 h2
+'''
+
+# pylint: disable=invalid-name
+
+import numpy as np
+
+from numpy.random import standard_normal
+
+def drive_sigma(v, w):
+    '''
+    standard deviation of the drive (distance) noise for a twist
+    '''
+    return np.abs(.05*v)+np.abs(.005*w)+.0005
+
+def heading_sigma(v, w):
+    '''
+    standard deviation of each of the two heading noise draws for a twist
+    '''
+    return np.abs(.025*w)+np.abs(.005*v)+.0005
+
+def sample_motion(x, y, heading, v, w, dt):
+    '''
+    Advance M poses by a twist (v, w) held for dt seconds, with noise.
+
+    v, w and dt can either be floats (the same control for every particle) or
+    arrays of length M.
+
+    Input:
+        np.ndarray x, y, heading (M,)
+        float or np.ndarray v, w, dt
+    Output:
+        (np.ndarray, np.ndarray, np.ndarray) new x, y, heading
+    '''
+    count = len(x)
+    noise = standard_normal((3, count))
+
+    dheading = w * dt
+    ds = v * dt + drive_sigma(v, w) * noise[0]
+
+    h_sigma = heading_sigma(v, w)
+    heading_1 = heading + dheading/2 + h_sigma * noise[1]
+    heading_2 = heading_1 + dheading/2 + h_sigma * noise[2]
+
+    new_x = x + ds*np.cos(heading_1)
+    new_y = y + ds*np.sin(heading_1)
+    return (new_x, new_y, heading_2,)
+
+def sample_motion_path(x, y, heading, v, w, dt):
+    '''
+    Advance M poses through K twists held one after the other (v[k], w[k]
+    for dt[k] seconds), with noise, in one pass. The headings at the start of
+    each interval come from a cumulative sum over the intervals. With the
+    same random state this gives the same poses as calling sample_motion for
+    each twist in turn.
+    Input:
+        np.ndarray x, y, heading (M,)
+        np.ndarray v, w, dt (K,)
+    Output:
+        (np.ndarray, np.ndarray, np.ndarray) new x, y, heading
+    '''
+    v = np.asarray(v, dtype=float)[:, np.newaxis]
+    w = np.asarray(w, dtype=float)[:, np.newaxis]
+    dt = np.asarray(dt, dtype=float)[:, np.newaxis]
+    if len(dt) == 0:
+        return (np.array(x, dtype=float), np.array(y, dtype=float),
+            np.array(heading, dtype=float),)
+    # (K, 3, M), in the order K calls of sample_motion would draw it
+    noise = standard_normal((len(dt), 3, len(x)))
+
+    dheading = w * dt
+    ds = v * dt + drive_sigma(v, w) * noise[:, 0]
+
+    h_sigma = heading_sigma(v, w)
+    turn = dheading + h_sigma * (noise[:, 1] + noise[:, 2]) # (K, M)
+    end = heading + np.cumsum(turn, axis=0)
+    heading_1 = end - turn + dheading/2 + h_sigma * noise[:, 1]
+
+    new_x = x + np.sum(ds*np.cos(heading_1), axis=0)
+    new_y = y + np.sum(ds*np.sin(heading_1), axis=0)
+    return (new_x, new_y, end[-1],)
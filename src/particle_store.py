@@ -0,0 +1,154 @@
+'''
+Particle Store
+
+Structure-of-arrays storage for the FastSLAM particle set. The robot pose
+(x, y, heading) and the log weight of every particle live in contiguous numpy
+arrays so the motion update, summary and resampling can run as array
+operations. The per-particle maps (feature_set, potential_features, ...) stay
+in FilterParticle objects, and a FilterParticle with a matching state is only
+built when someone asks for one.
+'''
+
+# pylint: disable=invalid-name
+
+import math
+import numpy as np
+
+from nav_msgs.msg import Odometry
+from resampling import log_normalize
+from utils import headings_to_quaternions, Pose2D
+
+class ParticleStore(object):
+    def __init__(self, maps):
+        '''
+        Input:
+            list of FilterParticle maps (one per particle)
+        '''
+        self.maps = list(maps)
+        count = len(self.maps)
+        self.x = np.zeros(count)
+        self.y = np.zeros(count)
+        self.heading = np.zeros(count)
+        self.log_weight = np.zeros(count)
+        # the previous generation's arrays, reused as the output of the next
+        #   resampling step. They may be longer than the particle set when the
+        #   number of particles shrinks.
+        self._back = {
+            'x': np.zeros(count),
+            'y': np.zeros(count),
+            'heading': np.zeros(count),
+        }
+
+    def __len__(self):
+        return len(self.maps)
+
+    def state(self, index):
+        '''
+        Get the planar state for the particle at the given index
+        Input:
+            int index
+        Output:
+            Pose2D
+        '''
+        return Pose2D(float(self.x[index]), float(self.y[index]),
+            float(self.heading[index]))
+
+    def odometry(self, indices=None):
+        '''
+        Build Odometry messages (for publishing) for the particles at the given
+        indices. The quaternions for all of them come from one vectorized
+        conversion.
+        Input:
+            np.ndarray indices (defaults to every particle)
+        Output:
+            list of Odometry
+        '''
+        if indices is None:
+            indices = np.arange(0, len(self.maps))
+        indices = np.asarray(indices, dtype=int)
+        quats = headings_to_quaternions(self.heading[indices])
+
+        messages = []
+        for row, index in enumerate(indices):
+            odom = Odometry()
+            odom.header.frame_id = 'odom'
+            odom.pose.pose.position.x = float(self.x[index])
+            odom.pose.pose.position.y = float(self.y[index])
+            orientation = odom.pose.pose.orientation
+            orientation.x, orientation.y, orientation.z, orientation.w = (
+                float(quats[row, 0]), float(quats[row, 1]),
+                float(quats[row, 2]), float(quats[row, 3]))
+            messages.append(odom)
+        return messages
+
+    def view(self, index):
+        '''
+        Get the FilterParticle at the given index with its state and (log)
+        weight filled in from the arrays. Changes to the view's state or weight
+        are not written back; use the arrays for that.
+        Input:
+            int index
+        Output:
+            FilterParticle
+        '''
+        particle = self.maps[index]
+        particle.state = self.state(index)
+        particle.log_weight = float(self.log_weight[index])
+        particle.weight = math.exp(particle.log_weight)
+        return particle
+
+    def views(self):
+        '''
+        Build views for every particle
+        Output:
+            list of FilterParticle
+        '''
+        return [self.view(i) for i in range(0, len(self.maps))]
+
+    def select(self, indices):
+        '''
+        Replace the particle set with the particles at the given indices (the
+        output of resampling). The first copy of a particle keeps its map, the
+        additional copies are forks that share its features. The poses are
+        gathered into the back buffers, which then become the front. The number
+        of indices sets the new number of particles.
+        Input:
+            np.ndarray indices (int)
+        Output:
+            None
+        '''
+        indices = np.asarray(indices, dtype=int)
+        used = set()
+        maps = []
+        for index in indices:
+            index = int(index)
+            if index in used:
+                maps.append(self.maps[index].fork())
+            else:
+                used.add(index)
+                maps.append(self.maps[index])
+
+        self.maps = maps
+        count = len(indices)
+        for name in ('x', 'y', 'heading'):
+            front = getattr(self, name)
+            back = self._back[name]
+            if len(back) < count:
+                back = np.empty(count)
+            np.take(front, indices, out=back[:count])
+            setattr(self, name, back[:count])
+            if front.base is not None:
+                front = front.base
+            self._back[name] = front
+        if len(self.log_weight) != count:
+            self.log_weight = np.empty(count)
+        self.log_weight.fill(0.0)
+
+    def weights(self):
+        '''
+        The normalized (linear) particle weights, computed from the log weights
+        with log-sum-exp so that very small weights do not underflow first
+        Output:
+            np.ndarray (M,)
+        '''
+        return np.exp(log_normalize(self.log_weight))
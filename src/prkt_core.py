@@ -10,12 +10,13 @@ node.
 
 import rospy
 import math
+import numpy as np
 
 from copy import deepcopy
 from geometry_msgs.msg import Twist
 from matrix import Matrix, inverse, transpose, mm, identity, magnitude
 from nav_msgs.msg import Odometry
-from random import random
+from resampling import systematic_resample
 from utils import version, heading_to_quaternion, quaternion_to_heading
 from viz_feature_sim.msg import Observation
 
@@ -219,19 +220,12 @@ class ParticleMixedSlam(SlamAlgorithm):
             # for all other features...do nothing
         # end for
 
-        temp_particle_list = []
-        sum_ = 0
-        for particle in self.robot_particles:
-            sum_ = sum_ + particle.weight
+        weights = np.array([particle.weight for particle in self.robot_particles])
+        indices = systematic_resample(weights)
 
-        chosen = random()*sum_
-
-        for _ in range(0, len(self.robot_particles)):
-            for particle in self.robot_particles:
-                chosen = chosen - particle.weight
-                if chosen < 0:
-                    # choose this particle
-                    temp_particle_list.append(particle.deep_copy())
+        temp_particle_list = []
+        for index in indices:
+            temp_particle_list.append(self.robot_particles[index].deep_copy())
 
         self.robot_particles = temp_particle_list
 
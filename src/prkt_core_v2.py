@@ -16,37 +16,222 @@ import rospy
 import copy as copy_module
 import math
 import sys
-# import numpy as np
-
-from copy import deepcopy
+import numpy as np
+
+from correspondence import best_matches, covariance_terms, log_match_matrix
+from correspondence import unique_matches
+from correspondence import stable_matches
+from correspondence import BEARING_GATE, COLOR_GATE
+from covisibility import CovisibilityGraph
+from ekf import sparse_ekf_update, sqrt_ekf_update
 from geometry_msgs.msg import Twist
+from ingest import message_stamp, ScanTracker
+from control_history import ControlHistory
+from kld import kld_particle_count
+from landmark_map import LandmarkMap
+from landmark_table import IMMUTABLE, LandmarkTable
 from math import sin, cos
 from matrix import inverse, mm, identity, magnitude, madd, msubtract
-from matrix import blob_to_matrix, Matrix
+from matrix import blob_to_matrix, blobs_to_matrix, CovarianceFactor, Matrix
+from matrix import log_pdf
+from matrix import psd_cholesky
+from motion import sample_motion, sample_motion_path
 from nav_msgs.msg import Odometry
-from numpy.random import normal
-from random import random
-# from scipy.stats import multivariate_normal
-from utils import heading_to_quaternion, quaternion_to_heading, scale
+from particle_store import ParticleStore
+from resampling import effective_sample_size, log_normalize, resample
+from distributed import DistributedShards
+from sharding import ShardPool
+from spatial_index import GridIndex
+from utils import pose_of, Pose2D, scale
 from utils import dot_product, unit
 from viz_feature_sim.msg import Blob
 
-# pylint: disable=no-name-in-module
-from scipy.stats import multivariate_normal
+def stack_arrays(first, second):
+    '''
+    Concatenate two sets of landmark arrays (see LandmarkMap.arrays)
+    Input:
+        (list of ids, np.ndarray means, ...) first, second
+    Output:
+        (list of ids, np.ndarray means, ...)
+    '''
+    if not second[0]:
+        return first
+    if not first[0]:
+        return second
+    return (first[0] + second[0],) + tuple(np.concatenate((a, b))
+        for a, b in zip(first[1:], second[1:]))
+
+def same_arrays(first, second):
+    '''
+    Check if two sets of landmark arrays (see LandmarkMap.arrays) hold the
+    same features with the same estimates
+    Input:
+        (list of ids, np.ndarray means, np.ndarray covars, ...) first, second
+    Output:
+        bool
+    '''
+    return (first[0] == second[0] and np.array_equal(first[1], second[1]) and
+        np.array_equal(first[2], second[2]))
+
+def observe_scan(particles, correspondences, Qt, sqrt=False):
+    '''
+    Measurement update of every particle for one scan. Unmatched blobs become
+    hypotheses; matched features get an EKF update, batched across all of the
+    particles (see ekf.sparse_ekf_update); and potential features that have been updated
+    enough are promoted to full features.
+
+    A feature that a particle matched more than once in the scan is updated
+    once per match, in order: the updates go in rounds, and each round has at
+    most one update per (particle, feature).
+    Input:
+        list of FilterParticle particles
+        list of list of (int, Blob) correspondences (one list per particle,
+            see FilterParticle.match_features_to_scan)
+        np.ndarray Qt (measurement noise)
+        bool sqrt (square-root mode: update the Cholesky factors of the
+            covariances, see ekf.sqrt_ekf_update)
+    Output:
+        np.ndarray (M,) log likelihood of the scan for each particle
+    '''
+    log_likelihood = np.zeros(len(particles))
+    pending = []
+    for i, (particle, correspondence) in enumerate(zip(particles,
+        correspondences)):
+        for feature_id, blob in correspondence:
+            if feature_id == 0:
+                # unseen feature observed
+                particle.add_hypothesis(particle.state, blob)
+                log_likelihood[i] += particle.no_match_weight()
+            else:
+                pending.append((i, feature_id, blob))
+
+    potentials = set()
+    while pending:
+        batch = []
+        later = []
+        in_batch = set()
+        for update in pending:
+            if update[0:2] in in_batch:
+                later.append(update)
+            else:
+                in_batch.add(update[0:2])
+                batch.append(update)
+        pending = later
+
+        poses = np.zeros((len(batch), 3))
+        means = np.zeros((len(batch), 5))
+        covars = np.zeros((len(batch), 5, 5))
+        for row, (i, feature_id, _) in enumerate(batch):
+            feature = particles[i].get_feature_by_id(feature_id)
+            poses[row] = pose_of(particles[i].state)
+            means[row] = np.ravel(feature.mean)
+            if sqrt:
+                covars[row] = feature.covar_sqrt()
+            else:
+                covars[row] = feature.covar
+        observations = blobs_to_matrix([update[2] for update in batch])
+
+        if sqrt:
+            new_means, new_covars, log_weights = sqrt_ekf_update(poses, means,
+                covars, observations, Qt)
+        else:
+            new_means, new_covars, log_weights = sparse_ekf_update(poses,
+                means, covars, observations, Qt)
+
+        for row, (i, feature_id, _) in enumerate(batch):
+            particle = particles[i]
+            particle.set_feature_estimate(feature_id, new_means[row].copy(),
+                new_covars[row].copy(), sqrt)
+            if feature_id < 0:
+                # potential new feature seen
+                # update feature ^ but update as if the feature not seen
+                log_likelihood[i] += particle.no_match_weight()
+                potentials.add((i, feature_id))
+            else:
+                # feature seen
+                # update feature and robot pose weight
+                log_likelihood[i] += log_weights[row]
+
+    for i, feature_id in potentials:
+        particle = particles[i]
+        feature = particle.potential_features[feature_id]
+        # possibly add the feature to the full feature set
+        if feature.update_count > 5:
+            # the particle has been seen 3 times
+            particle.feature_set[-feature_id] = feature
+            del particle.potential_features[feature_id]
+
+    return log_likelihood
+
+def scan_likelihood(particles, scan, match_version, Qt, sqrt=False):
+    '''
+    Match and update each particle on its own for one scan (the work a shard
+    does, see sharding.py)
+    Input:
+        list of FilterParticle particles (M)
+        VizScan scan
+        int match_version (see FilterParticle.match_features_to_scan)
+        np.ndarray Qt
+        bool sqrt (see observe_scan)
+    Output:
+        np.ndarray (M,) log likelihood of the scan for each particle
+    '''
+    correspondences = [particle.match_features_to_scan(scan, match_version)
+        for particle in particles]
+    return observe_scan(particles, correspondences, Qt, sqrt)
 
 class FastSLAM(object):
-    def __init__(self, preset_features=[]):
+    def __init__(self, preset_features=[], packed_landmarks=False):
         self.last_control = Twist()
         self.last_update = rospy.Time.now()
+        # stamped_motion: move the particles to the stamp of each scan
+        #   through the recorded twists (see record_control and advance_to)
+        #   instead of by last_control up to now
+        self.stamped_motion = False
+        self.controls = ControlHistory()
         self.num_particles = 50
-        self.particles = [None]*self.num_particles
-        for i in range(0,self.num_particles):
-            self.particles[i] = FilterParticle()
-        
-        for particle in self.particles:
-            if rospy.is_shutdown():
-                break
-            particle.load_feature_list(preset_features)
+        # packed_landmarks: store each particle's features in packed arrays
+        #   (see landmark_table.py)
+        first = FilterParticle(packed=packed_landmarks)
+        first.load_priors(preset_features)
+        # every particle starts out sharing the same prior map
+        maps = [first]
+        for _ in range(1, self.num_particles):
+            maps.append(first.fork())
+        self.store = ParticleStore(maps)
+        # systematic, stratified, residual or multinomial (see resampling.py)
+        self.resample_scheme = 'systematic'
+        # resample when the effective sample size drops below this fraction
+        #   of the number of particles
+        self.resample_threshold = 0.5
+        # KLD-sampling: grow and shrink the particle set with the spread of the
+        #   pose posterior, between min_particles and max_particles. The set is
+        #   only resized when the KLD count is more than kld_tolerance (a
+        #   fraction of the current count) away.
+        self.adaptive_particles = False
+        self.min_particles = 5
+        self.max_particles = 2000
+        self.kld_bin_size = (.25, .25, math.pi/18.0) # x, y, heading
+        self.kld_epsilon = .05
+        self.kld_tolerance = .2
+        # data association, see FilterParticle.match_features_to_scan
+        self.match_version = 1
+        # share data association between particles with the same maps and
+        #   poses in the same cluster_bin_size bin (x, y, heading). If any
+        #   blob's match is ambiguous (see FilterParticle.stable_association)
+        #   the particles in the cluster are matched one by one.
+        self.shared_association = False
+        self.cluster_bin_size = (.05, .05, .02)
+        self.ambiguity_margin = 2.0
+        # square-root mode: keep and update the Cholesky factors of the
+        #   feature covariances (see ekf.sqrt_ekf_update)
+        self.sqrt_covariance = False
+        # scans already fused, cam_cb skips repeats (see ingest.ScanTracker)
+        self.scan_tracker = ScanTracker()
+        # process pool that owns the particle maps, see start_shards
+        self.shard_pool = None
+        # publish every particle before and after resampling
+        self.publish_particles = False
         self.Qt = Matrix([[.1, 0, 0, 0], 
                           [0, .1, 0, 0],
                           [0, 0, .1, 0],
@@ -56,86 +241,199 @@ class FastSLAM(object):
         self.resampled_particles_pub = rospy.Publisher('/resampled_particles', Odometry, queue_size=1)
         self.particle_track_pub = rospy.Publisher('/particle_track', Odometry, queue_size=1)
 
-    def cam_cb(self, ros_view):
+    @property
+    def particles(self):
+        '''
+        FilterParticle views of the particle set, built on demand from the
+        particle store
+        '''
+        return self.store.views()
+
+    def cam_cb(self, ros_view, stamp=None):
         # motion update all particles
 
         rospy.loginfo('rolling cam_cb')
         rospy.loginfo('core_v2: cam_cb -> pre low_variance_resample')
 
         count = 0
-
-        for i in range(0, len(self.particles)):
+        scan = ros_view.last_sensor_reading
+        particles = []
+        correspondences = []
+
+        if not self.scan_tracker.accept(scan):
+            rospy.loginfo('core_v2: cam_cb -> skip repeated scan (%d so far)' %
+                (self.scan_tracker.duplicate,))
+            return
+
+        if self.shard_pool is not None:
+            self.advance_for_scan(scan, stamp)
+            log_likelihood = self.shard_pool.observe(self.store, scan,
+                self.match_version, self.Qt, self.sqrt_covariance)
+            # the shards did the per-particle work, skip the loop below
+            count = len(self.store)
+
+        for i in range(count, len(self.store)):
             if rospy.is_shutdown():
                 break
             count += 1
             if (count % 10) == 0:
                 rospy.loginfo('particle: %d' % count)
-            self.particles[i].weight = 1
 
             if count == 1:
                 rospy.loginfo('<<< start motion_update %d' % count)
-                self.motion_update(self.last_control)
+                self.advance_for_scan(scan, stamp)
+                shared = {}
+                if self.shared_association:
+                    shared = self.shared_correspondence(scan)
+
+            particle = self.store.view(i)
 
             if (count % 10) == 0:
                 rospy.loginfo('<<< start correspondence %d' % count)
 
-            scan = ros_view.last_sensor_reading
-
-            correspondence = self.particles[i].match_features_to_scan(scan)
+            if i in shared:
+                correspondence = shared[i]
+            else:
+                # pylint: disable=line-too-long
+                correspondence = particle.match_features_to_scan(scan, self.match_version)
             if (count % 10) == 0:
                 rospy.loginfo('<<< end correspondence %d' % count)
-            
-            for pair in correspondence:
-                if rospy.is_shutdown():
-                    break
-                blob = pair[1]
-                if pair[0] == 0:
-                    # unseen feature observed
-                    self.particles[i].add_hypothesis(self.particles[i].state, blob)
-                    self.particles[i].weight *= self.particles[i].no_match_weight()
-                else:
-                    # update feature
-                    pseudoblob = self.particles[i].generate_measurement(pair[0])
-                    bigH = self.particles[i].measurement_jacobian(pair[0])
-                    # pylint: disable=line-too-long
-                    bigQ = self.particles[i].measurement_covariance(bigH, pair[0], self.Qt)
-                    bigQinv = inverse(bigQ)
-                    bigK = self.particles[i].kalman_gain(pair[0], bigH, bigQinv)
-
-                    (self.particles[i].get_feature_by_id(pair[0])
-                        .update_mean(bigK, blob, pseudoblob))
-                    (self.particles[i].get_feature_by_id(pair[0])
-                        .update_covar(bigK, bigH))
-                    if pair[0] < 0:
-                        # potential new feature seen
-                        # update feature ^ but update as if the feature not seen
-                        weighty = self.particles[i].no_match_weight()
-                        # possibly add the feature to the full feature set
-                        if self.particles[i].get_feature_by_id(pair[0]).update_count > 5:
-                            # the self.particles[i] has been seen 3 times
-                            feature = self.particles[i].potential_features[pair[0]]
-                            self.particles[i].feature_set[-pair[0]] = feature
-                            del self.particles[i].potential_features[pair[0]]
-                    else:
-                        # feature seen
-                        # update feature and robot pose weight
-                        # pylint: disable=line-too-long
-                        weighty = self.particles[i].importance_factor(bigQ, blob, pseudoblob)
-                    self.particles[i].weight *= weighty
-            
-            self.particles[i].state.header.frame_id = 'odom'
-            self.particle_track_pub.publish(self.particles[i].state)
-            
-            if abs(self.particles[i].weight - 1) < .001:
-                rospy.loginfo('suspicious 1: %d' % len(correspondence))
+
+            particles.append(particle)
+            correspondences.append(correspondence)
+
+        # log likelihood of this scan, the weight carries over between scans
+        if self.shard_pool is None:
+            log_likelihood = observe_scan(particles, correspondences, self.Qt,
+                self.sqrt_covariance)
+        self.store.log_weight[0:len(log_likelihood)] += log_likelihood
+
+        for i in range(0, len(log_likelihood)):
+            if rospy.is_shutdown():
+                break
+            self.particle_track_pub.publish(self.store.odometry([i])[0])
+
+            if abs(log_likelihood[i]) < .001:
+                rospy.loginfo('suspicious 1: particle %d' % i)
             else:
-                rospy.loginfo('not suspicious weight: %f' % (self.particles[i].weight,))
-            if (count % 10) == 0:
-                rospy.loginfo('<<< end correspondence loop %d' % count)
+                rospy.loginfo('not suspicious log weight: %f' % (log_likelihood[i],))
+
+        self.store.log_weight = log_normalize(self.store.log_weight)
+        weights = np.exp(self.store.log_weight)
+        ess = effective_sample_size(weights)
+
+        count = len(self.store)
+        resize = False
+        if self.adaptive_particles:
+            count = self.kld_count(weights)
+            resize = abs(count - len(self.store)) > self.kld_tolerance*len(self.store)
+
+        if resize or ess < self.resample_threshold * len(self.store):
+            rospy.loginfo('core_v2: cam_cb -> post low_variance_resample')
+            self.low_variance_resample(count)
+        else:
+            rospy.loginfo('core_v2: cam_cb -> skip resample (ess %f)' % (ess,))
+
+
+    def association_clusters(self, blobs):
+        '''
+        Group the particles that come from the same fork (see
+        FilterParticle.lineage), have poses in the same cluster_bin_size bin
+        and have the same candidate features for the blobs (see
+        FilterParticle.association_arrays). Updates to features that no blob
+        can match don't split a cluster.
+        Input:
+            list of Blob blobs
+        Output:
+            list of lists of particle indices
+        '''
+        bin_x, bin_y, bin_heading = self.cluster_bin_size
+        bins = np.floor(np.column_stack((self.store.x / bin_x,
+            self.store.y / bin_y, self.store.heading / bin_heading)))
+        groups = {}
+        for i, cell in enumerate(bins.astype(int).tolist()):
+            key = (self.store.maps[i].lineage, tuple(cell))
+            groups.setdefault(key, []).append(i)
+
+        clusters = []
+        for members in groups.values():
+            # (candidate arrays, members) for each cluster in the group
+            found = []
+            for i in members:
+                arrays = self.store.maps[i].association_arrays(blobs)
+                for lead_arrays, cluster in found:
+                    if same_arrays(lead_arrays, arrays):
+                        cluster.append(i)
+                        break
+                else:
+                    found.append((arrays, [i]))
+            clusters.extend(cluster for _, cluster in found)
+        return clusters
 
-        rospy.loginfo('core_v2: cam_cb -> post low_variance_resample')
-        self.low_variance_resample()
+    def shared_correspondence(self, scan):
+        '''
+        Run data association once for each cluster of particles (see
+        association_clusters) and share it with the whole cluster. Clusters
+        where a match could change within the bin (see
+        FilterParticle.stable_association) are left out, and so are
+        single-particle clusters; cam_cb matches those particles one by one.
+        Input:
+            VizScan scan
+        Output:
+            dict {particle index: list of (feature id, Blob) pairs}
+        '''
+        bin_x, bin_y, bin_heading = self.cluster_bin_size
+        slack_distance = math.sqrt(bin_x*bin_x + bin_y*bin_y)
+        result = {}
+        for members in self.association_clusters(scan.observes):
+            if len(members) < 2:
+                continue
+            lead = self.store.view(members[0])
+            if not lead.stable_association(scan.observes, bin_heading,
+                slack_distance, self.ambiguity_margin):
+                continue
+            correspondence = lead.match_features_to_scan(scan,
+                self.match_version)
+            matches = [pair[0] for pair in correspondence]
+            result[members[0]] = correspondence
+            for i in members[1:]:
+                self.store.maps[i].record_matches(matches)
+                result[i] = correspondence
+        return result
 
+    def start_shards(self, workers=None, addresses=None, authkey=None):
+        '''
+        Hand the particle maps over to a pool of worker processes (see
+        sharding.py), or to shard nodes on other machines if addresses are
+        given (see distributed.py). cam_cb then runs data association and the
+        EKF updates in the shards; the motion update and resampling stay
+        here. The shards match each particle on its own (shared_association
+        is not used).
+        Input:
+            int workers (defaults to the number of cores)
+            list of node addresses (see distributed.serve_node)
+            bytes authkey (for the nodes, required with addresses)
+        Output:
+            None
+        raises:
+            ValueError (addresses without an authkey)
+        '''
+        if self.shard_pool is not None:
+            return
+        if addresses is not None:
+            self.shard_pool = DistributedShards(self.store, addresses,
+                authkey)
+        else:
+            self.shard_pool = ShardPool(self.store, scan_likelihood, workers,
+                max(self.max_particles, len(self.store)))
+
+    def stop_shards(self):
+        '''
+        Fetch the particle maps back from the workers and stop them
+        '''
+        if self.shard_pool is not None:
+            self.shard_pool.close(self.store)
+            self.shard_pool = None
 
     def odom_motion_update(self, odom):
         '''
@@ -145,6 +443,57 @@ class FastSLAM(object):
         '''
         pass
 
+    def record_control(self, twist, stamp):
+        '''
+        Add a twist to the control history (for stamped_motion). This does not
+        move the particles; advance_to does, when the next scan comes in.
+        Input:
+            Twist twist
+            float stamp (seconds)
+        Output:
+            None
+        '''
+        self.controls.add_twist(stamp, twist)
+
+    def advance_to(self, stamp):
+        '''
+        Move every particle from last_update to the given time through each
+        recorded twist in between (see ControlHistory.segments and
+        motion.sample_motion_path). A time before last_update (a late scan)
+        leaves the particles where they are.
+        Input:
+            float stamp (seconds)
+        Output:
+            None
+        '''
+        v, w, dt = self.controls.segments(self.last_update.to_sec(), stamp)
+        if len(dt) == 0:
+            return
+        store = self.store
+        store.x[:], store.y[:], store.heading[:] = sample_motion_path(store.x,
+            store.y, store.heading, v, w, dt)
+        self.last_update = rospy.Time.from_sec(stamp)
+        self.controls.prune(stamp)
+
+    def advance_for_scan(self, scan, stamp=None):
+        '''
+        Move the particles up to a scan: to its stamp with stamped_motion,
+        otherwise by last_control up to now (see motion_update). The stamp
+        given by the ingest queue, if any, is used instead of the scan's own,
+        so the motion agrees with the order the messages were queued in.
+        Input:
+            VizScan scan
+            float stamp (seconds, optional)
+        Output:
+            None
+        '''
+        if self.stamped_motion:
+            if stamp is None:
+                stamp = message_stamp(scan)
+            self.advance_to(stamp)
+        else:
+            self.motion_update(self.last_control)
+
     def motion_update(self, new_twist):
         '''
         update the state of all of the particles by the given twist
@@ -156,140 +505,183 @@ class FastSLAM(object):
         # rospy.loginfo('core_v2: motion_update '+str(new_twist))
         # rospy.loginfo('time: '+str(rospy.Time.now())+' | '+str(self.last_update))
         dt = rospy.Time.now() - self.last_update
-        for i in xrange(0, len(self.particles)):
-            if rospy.is_shutdown():
-                break
-            self.particles[i] = self.motion_model(self.particles[i],
-                self.last_control, dt)
+
+        v = self.last_control.linear.x
+        w = self.last_control.angular.z
+
+        store = self.store
+        store.x[:], store.y[:], store.heading[:] = sample_motion(store.x,
+            store.y, store.heading, v, w, dt.to_sec())
 
         self.last_update = self.last_update + dt
         self.last_control = new_twist
 
     def motion_model(self, particle, twist, dt):
-        # pS      h1        |
-        # 0-----------------0
-        # |                 h2
-        # dt = dt.secs + dt.nsecs*math.pow(10,-9)
-        # rospy.loginfo('dt secs: '+str(dt.to_sec()))
-        dt = dt.to_sec()
-
-        v = twist.linear.x
-        w = twist.angular.z
-
-        new_particle = FilterParticle()
-        
-        new_particle = copy_module.deepcopy(particle)
-
-        dheading = twist.angular.z * dt
-
-        drive_noise = normal(0, abs(.05*v)+abs(.005*w)+.0005, 1)
-        ds = twist.linear.x * dt + drive_noise
-
-        prev_heading = quaternion_to_heading(particle.state.pose.pose.orientation)
-
-        heading_noise = normal(0, abs(.025*w)+abs(.005*v)+.0005, 1)
-        heading_1 = prev_heading+dheading/2+heading_noise
-
-        heading_noise = normal(0, abs(.025*w)+abs(.005*v)+.0005, 1)
-        heading_2 = heading_1+dheading/2+heading_noise
-
-        # rospy.loginfo('asdf;kjasdf; '+str(heading_1 ))
-
-        dx = ds*cos(heading_1)
-        dy = ds*sin(heading_1)
+        '''
+        Move a single particle by the given twist for dt. This is the batched
+        motion model (see motion.py) run with one particle.
+        Input:
+            FilterParticle particle
+            Twist twist
+            rospy.Duration dt
+        Output:
+            FilterParticle (new particle)
+        '''
+        pose = pose_of(particle.state)
+        new_x, new_y, new_heading = sample_motion(np.array([pose.x]),
+            np.array([pose.y]), np.array([pose.heading]),
+            twist.linear.x, twist.angular.z, dt.to_sec())
 
-        # rospy.loginfo('ds delta: '+str(ds - v*dt))
-
-        new_particle.state.pose.pose.position.x += dx
-        new_particle.state.pose.pose.position.y += dy
-        # pylint: disable=line-too-long
-        new_particle.state.pose.pose.orientation = heading_to_quaternion(heading_2)
+        new_particle = particle.fork()
+        new_particle.state = Pose2D(float(new_x[0]), float(new_y[0]),
+            float(new_heading[0]))
 
         return new_particle
 
-    def low_variance_resample(self):
+    def low_variance_resample(self, count=None):
         '''
         Resample particles based on weights
+        Input:
+            int count (number of particles after resampling, defaults to the
+                current number)
         '''
         rospy.loginfo('low_variance_resample()')
 
-        sum_ = 0
-        max_ = 0
-        for element in self.particles:
-            # rospy.loginfo(element.weight)
-            sum_ += element.weight
-            if element.weight > max_:
-                max_ = element.weight
-
-        rospy.loginfo('summmm_ %f %f' % (sum_, max_,))
-        range_ = sum_/float(len(self.particles))
-        step = random()*range_
-        temp_particles = []
-        count = 0
+        indices = resample(self.store.weights(), self.resample_scheme, count)
 
-        rospy.loginfo('reshample')
-        ### resample ###
-        
-        for particle in self.particles:
-            if rospy.is_shutdown():
-                break
-            particle.state.header.frame_id = 'odom'
-            self.aged_particles_pub.publish(particle.state)
-            step = step - particle.weight
-            while step <= 0.0 and count < len(self.particles):
-                # add it to the list
-                particle.state.header.frame_id = 'odom'
-                self.resampled_particles_pub.publish(particle.state)
-                temp_particles.append(copy_module.deepcopy(particle))
-                # do I need the deepcopy?
-                #   If the motion model creates a new particle, no
-
-                # take a step forward
-                step += range_
-                count += 1
-                # repeat if its still in the particle range
-
-        self.particles = temp_particles
+        if self.publish_particles:
+            self.publish_particle_set(self.aged_particles_pub)
+        slots = None
+        if self.shard_pool is not None:
+            slots = self.shard_pool.select(self.store.maps, indices)
+        self.store.select(indices)
+        if slots is not None:
+            self.store.maps = slots
+        if self.publish_particles:
+            self.publish_particle_set(self.resampled_particles_pub)
 
-    def summary(self):
+    def kld_count(self, weights):
         '''
-        average x, y, heading
+        Number of particles for the next generation from KLD-sampling over the
+        current pose posterior (see kld.py)
+        Input:
+            np.ndarray weights (normalized)
+        Output:
+            int
         '''
-        x_sum = 0.0
-        y_sum = 0.0
-        heading_dx = 0.0
-        heading_dy = 0.0
-        count = float(len(self.particles))
+        return kld_particle_count(self.store.x, self.store.y,
+            self.store.heading, weights, self.min_particles,
+            self.max_particles, self.kld_bin_size, self.kld_epsilon)
 
-        for particle in self.particles:
+    def publish_particle_set(self, publisher):
+        '''
+        Publish the state of every particle (for debugging in rviz)
+        '''
+        for odom in self.store.odometry():
             if rospy.is_shutdown():
                 break
-            x_sum += float(particle.state.pose.pose.position.x)
-            y_sum += float(particle.state.pose.pose.position.y)
-            heading_t = float(quaternion_to_heading(particle.state.pose.pose.orientation))
-            heading_dx += cos(heading_t)
-            heading_dy += sin(heading_t)
-
-        x = x_sum / count
-        y = y_sum / count
-        heading = math.atan2(heading_dy, heading_dx)
+            publisher.publish(odom)
+
+    def summary(self):
+        '''
+        weighted average x, y, heading
+        '''
+        weights = self.store.weights()
+        x = float(np.dot(weights, self.store.x))
+        y = float(np.dot(weights, self.store.y))
+        heading = math.atan2(float(np.dot(weights, np.sin(self.store.heading))),
+            float(np.dot(weights, np.cos(self.store.heading))))
         return (x, y, heading,)
 
 class FilterParticle(object):
-    def __init__(self, state=None):
+    def __init__(self, state=None, packed=False):
         if state is None:
-            state = Odometry()
-            state.pose.pose.position.x = 0.0
-            state.pose.pose.position.y = 0.0
-            state.pose.pose.orientation = heading_to_quaternion(0.0)
+            state = Pose2D(0.0, 0.0, 0.0)
+        # Pose2D (or Odometry, see utils.pose_of)
         self.state = state
-        self.feature_set = {}
-        self.potential_features = {}
+        # packed: keep the features in LandmarkTables (arrays) instead of
+        #   LandmarkMaps of Feature objects
+        self.feature_set = self.new_feature_map(packed)
+        self.potential_features = self.new_feature_map(packed)
+        # versions of the maps when the particle was last forked, shared by
+        #   the particles from that fork (see FastSLAM.association_clusters)
+        self.lineage = (self.feature_set.version,
+            self.potential_features.version)
         self.weight = 1
+        # use the color and spatial indexes for correspondence once the maps
+        #   hold at least this many features (below that, scoring everything
+        #   is cheaper)
+        self.spatial_index_min = 64
+        # features farther than this from the particle are out of the
+        #   camera's sight and never matched (None for no limit); it also
+        #   bounds the cells the bearing wedges look at (see candidates)
+        self.max_range = None
+
+        self.hypothesis_set = LandmarkMap()
+        self.next_id = 1
 
+        # read-only prior (preset) features, shared by reference with every
+        #   fork and never copied, see load_priors
+        self.priors = LandmarkMap()
 
-        self.hypothesis_set = {}
-        self.next_id = 1
+        # features seen together, and the full features matched in the last
+        #   scan (Version 3 matching starts there)
+        self.covisibility = CovisibilityGraph()
+        self.last_matches = []
+        # how many features the Version 3 graph search looks at
+        self.graph_search_size = 64
+
+    def new_feature_map(self, packed=False):
+        '''
+        An empty, indexed feature map
+        Input:
+            bool packed (LandmarkTable instead of LandmarkMap)
+        Output:
+            LandmarkMap or LandmarkTable
+        '''
+        index = GridIndex()
+        color_index = GridIndex(math.sqrt(COLOR_GATE))
+        if packed:
+            return LandmarkTable(FeatureView, index=index,
+                color_index=color_index)
+        return LandmarkMap(index=index, color_index=color_index)
+
+    def fork(self):
+        '''
+        Copy the particle for resampling without copying its maps. The copy
+        shares every Feature with this particle until one of them updates it
+        (see LandmarkMap). The state is shared too, so replace it instead of
+        modifying it.
+        Output:
+            FilterParticle
+        '''
+        self.lineage = (self.feature_set.version,
+            self.potential_features.version)
+        child = copy_module.copy(self)
+        child.feature_set = self.feature_set.fork()
+        child.potential_features = self.potential_features.fork()
+        child.hypothesis_set = self.hypothesis_set.fork()
+        child.covisibility = self.covisibility.fork()
+        return child
+
+    def load_priors(self, features):
+        '''
+        Make the features this particle's prior map: a read-only map that is
+        shared by reference with every fork of the particle instead of being
+        part of its feature_set. The priors get the next ids and are marked
+        immutable.
+        Input:
+            list of Feature features
+        Output:
+            None
+        '''
+        priors = LandmarkMap(index=GridIndex(),
+            color_index=GridIndex(math.sqrt(COLOR_GATE)))
+        for feature in features:
+            feature.__immutable__ = True
+            priors[self.next_id] = feature
+            self.next_id += 1
+        self.priors = priors
 
     def load_feature_list(self, features):
         for feature in features:
@@ -311,19 +703,104 @@ class FilterParticle(object):
         '''
         if id_ < 0:
             return self.potential_features[int(id_)]
+        elif id_ in self.priors:
+            return self.priors[id_]
         else:
             return self.feature_set[id_]
 
-    def match_features_to_scan(self, scan):
+    def mutable_feature(self, id_):
+        '''
+        get the feature by id so that it can be updated. If the feature is
+        shared with other particles, this particle gets its own copy first.
+        Input:
+            int (feature)id_
+        Output:
+            Feature
+        raises:
+            KeyError
+        '''
+        if id_ < 0:
+            return self.potential_features.mutable(int(id_))
+        elif id_ in self.priors:
+            # priors never change
+            return self.priors[id_]
+        else:
+            return self.feature_set.mutable(id_)
+
+    def update_feature(self, id_, bigK, bigH, blob, pseudoblob):
+        '''
+        EKF update of the feature's mean and covariance (see
+        Feature.update_mean and Feature.update_covar), keeping the spatial
+        index up to date with the new mean
+        Input:
+            int (feature)id_
+            np.ndarray bigK (Kalman gain)
+            np.ndarray bigH (Jacobian of the measurement model)
+            Blob blob (recieved measurement)
+            Blob pseudoblob (estimated measurement)
+        Output:
+            Feature (the updated feature)
+        raises:
+            KeyError
+        '''
+        feature = self.mutable_feature(id_)
+        feature.update_mean(bigK, blob, pseudoblob)
+        feature.update_covar(bigK, bigH)
+        self.reindex_feature(id_)
+        return feature
+
+    def reindex_feature(self, id_):
+        '''
+        Update the feature's entries in the color and spatial indexes after its
+        mean changed
+        Input:
+            int (feature)id_
+        Output:
+            None
+        raises:
+            KeyError
+        '''
+        if id_ < 0:
+            self.potential_features.reindex(int(id_))
+        elif id_ not in self.priors:
+            self.feature_set.reindex(id_)
+
+    def set_feature_estimate(self, id_, mean, covar, sqrt=False):
+        '''
+        Replace the feature's mean and covariance with the result of an EKF
+        update computed elsewhere (see observe_scan), keeping the spatial
+        index up to date
+        Input:
+            int (feature)id_
+            np.ndarray mean (5,)
+            np.ndarray covar (5, 5) (its Cholesky factor if sqrt)
+            bool sqrt
+        Output:
+            Feature (the updated feature)
+        raises:
+            KeyError
+        '''
+        feature = self.mutable_feature(id_)
+        if sqrt:
+            feature.set_estimate_sqrt(mean, covar)
+        else:
+            feature.set_estimate(mean, covar)
+        self.reindex_feature(id_)
+        return feature
+
+    def match_features_to_scan(self, scan, version=1):
         '''
         Version 1: independently match each scan to the most likely feature
         Version 2: match each scan to a unique feature
             (if they are sufficiently far apart)
+            Solved as an assignment problem over the gated likelihoods (see
+            correspondence.unique_matches)
         Version 3: graph based enhanced lookup
             Use a graph of features that have been seen together to speed up the
             search for features that are likely to be seen
-            Might be: run v1, then take the most likely, and search from there
-            for features to match
+            Starts from the features matched in the last scan, searches out
+            along the co-visibility graph (see covisibility.py), and falls
+            back to a full (Version 1) search for the blobs it didn't match
 
         ** Note this can match to potential features as well.
             If it matches to a potential feature, the feature will update but
@@ -331,6 +808,7 @@ class FilterParticle(object):
 
         Input:
             VizScan scan
+            int version (1, 2 or 3)
         Output:
             list of tuples mapping feature ids to Blobs
             <0 = potential new feature
@@ -338,23 +816,189 @@ class FilterParticle(object):
             >0 = existing full feature
 
         '''
-        # Version 1
-        johndoe = []
-        count = 0
-        for blob in scan.observes:
-            if rospy.is_shutdown():
-                break
-            count += 1
-            # rospy.loginfo('start johndoe %d' % count)
-            johndoe.append((self.match_one(self.state, blob), blob))
-            # rospy.loginfo('end   johndoe %d' % count)
-        return johndoe
+        blobs = scan.observes
+        if version == 3 and self.last_matches:
+            matches = self.graph_matches(blobs)
+        elif version == 2:
+            ids, log_matrix = self.log_match_matrix(blobs)
+            matches = unique_matches(log_matrix, ids)
+        else:
+            # Version 1
+            ids, log_matrix = self.log_match_matrix(blobs)
+            matches = best_matches(log_matrix, ids)
+        self.record_matches(matches)
+        johndoe = zip(matches, blobs)
+        return list(johndoe)
+
+    def graph_matches(self, blobs):
+        '''
+        Version 3 matching: match the blobs against the neighborhood of the
+        last scan's matches in the co-visibility graph (and the potential
+        features), then do a full search for the blobs that didn't match there
+        Input:
+            list of Blob blobs
+        Output:
+            list of int (feature id for each blob, 0 for no match)
+        '''
+        seeds = [id_ for id_ in self.last_matches
+            if id_ in self.feature_set or id_ in self.priors]
+        local = self.covisibility.expand(seeds, self.graph_search_size)
+        ids, log_matrix = self.log_match_matrix(blobs, local)
+        matches = best_matches(log_matrix, ids)
+
+        missing = [row for row, id_ in enumerate(matches) if id_ == 0]
+        if missing:
+            ids, log_matrix = self.log_match_matrix(
+                [blobs[row] for row in missing])
+            for row, id_ in zip(missing, best_matches(log_matrix, ids)):
+                matches[row] = id_
+        return matches
+
+    def record_matches(self, matches):
+        '''
+        Add the full features matched in a scan to the co-visibility graph and
+        remember them as the starting point for the next Version 3 search
+        Input:
+            list of int matches (feature ids)
+        Output:
+            None
+        '''
+        seen = [id_ for id_ in matches if id_ > 0]
+        if len(set(seen)) > 1:
+            self.covisibility.observe(seen)
+        self.last_matches = seen
+
+    def candidates(self, landmarks, blobs, use_position=True):
+        '''
+        Ids of the features in landmarks (the full or the potential feature
+        map) that could pass the color gate and the bearing gate for at least
+        one of the blobs. The color index is checked first because it is a few
+        dict lookups per blob; the bearing wedges are only checked if that
+        leaves a lot of candidates.
+        Input:
+            LandmarkMap landmarks
+            list of Blob blobs
+            bool use_position (False to only use the color gate, which doesn't
+                depend on the particle's state)
+        Output:
+            set of ids
+        '''
+        gate = math.sqrt(COLOR_GATE)
+        result = set()
+        for blob in blobs:
+            result.update(landmarks.color_index.query_ball(
+                (blob.color.r, blob.color.g, blob.color.b), gate))
+        if not use_position or len(result) < self.spatial_index_min:
+            return result
+
+        state = pose_of(self.state)
+        directions = np.array([state.heading + blob.bearing for blob in blobs])
+        return result & landmarks.position_index.query_wedge(state.x, state.y,
+            directions, BEARING_GATE, self.max_range)
+
+    def searchable_arrays(self, landmarks, blobs, use_position=True):
+        '''
+        Arrays (see LandmarkMap.arrays) of the features in landmarks that could
+        match at least one of the blobs. Large maps are narrowed down with the
+        color and spatial indexes; small maps are returned whole.
+        Input:
+            LandmarkMap landmarks
+            list of Blob blobs
+            bool use_position (see candidates)
+        Output:
+            (list of ids (n,), np.ndarray means (n, 5), ...) (see
+                LandmarkMap.arrays)
+        '''
+        if blobs and len(landmarks) >= self.spatial_index_min:
+            return landmarks.subset_arrays(self.candidates(landmarks, blobs,
+                use_position))
+        return landmarks.arrays()
+
+    def log_match_matrix(self, blobs, local=None):
+        '''
+        Log likelihood of every blob matching every feature from the particle's
+        state (see correspondence.py). For large maps only the features that
+        can pass the color and bearing gates get scored; the others can't match
+        anyway.
+        Input:
+            list of Blob blobs
+            set of ids local (only consider these full features, optional)
+        Output:
+            (list of ids (N,), np.ndarray (B, N))
+        '''
+        if local is None:
+            full = stack_arrays(self.searchable_arrays(self.priors, blobs),
+                self.searchable_arrays(self.feature_set, blobs))
+        else:
+            full = stack_arrays(self.priors.subset_arrays(
+                [id_ for id_ in local if id_ in self.priors]),
+                self.feature_set.subset_arrays(
+                    [id_ for id_ in local if id_ not in self.priors]))
+        ids, means, covars, inverses, log_dets = stack_arrays(full,
+            self.searchable_arrays(self.potential_features, blobs))
+        log_matrix = log_match_matrix(pose_of(self.state),
+            blobs_to_matrix(blobs), means, covars, (inverses, log_dets))
+        return (ids, self.gate_range(means, log_matrix))
+
+    def gate_range(self, means, log_matrix):
+        '''
+        Rule out the features farther than max_range from the particle
+        Input:
+            np.ndarray means (N, 5)
+            np.ndarray log_matrix (B, N) (changed in place)
+        Output:
+            np.ndarray log_matrix
+        '''
+        if self.max_range is None or len(means) == 0:
+            return log_matrix
+        state = pose_of(self.state)
+        far = (np.hypot(means[:, 0] - state.x, means[:, 1] - state.y) >
+            self.max_range)
+        log_matrix[:, far] = -np.inf
+        return log_matrix
+
+    def association_arrays(self, blobs):
+        '''
+        Arrays of the prior, full and potential features that could match the
+        blobs from any state. Only the color index is used, since the wedge
+        query depends on the state.
+        Input:
+            list of Blob blobs
+        Output:
+            (list of ids (n,), np.ndarray means (n, 5), ...) (see
+                LandmarkMap.arrays)
+        '''
+        return stack_arrays(stack_arrays(
+            self.searchable_arrays(self.priors, blobs, False),
+            self.searchable_arrays(self.feature_set, blobs, False)),
+            self.searchable_arrays(self.potential_features, blobs, False))
+
+    def stable_association(self, blobs, slack_angle, slack_distance, margin):
+        '''
+        Check if every blob would match the same feature from any state within
+        the slack of this particle's state (see correspondence.stable_matches).
+        Input:
+            list of Blob blobs
+            float slack_angle (heading difference)
+            float slack_distance (position difference)
+            float margin (log likelihood between the best and second best
+                match)
+        Output:
+            bool
+        '''
+        ids, means, covars, inverses, log_dets = self.association_arrays(blobs)
+        pose = pose_of(self.state)
+        blob_matrix = blobs_to_matrix(blobs)
+        log_matrix = self.gate_range(means, log_match_matrix(pose, blob_matrix,
+            means, covars, (inverses, log_dets)))
+        return bool(np.all(stable_matches(pose, blob_matrix, means, log_matrix,
+            slack_angle, slack_distance, margin)))
 
     def match_one(self, state, blob):
         '''
         Return the independent best match to the feature set for the given blob
         Input:
-            Odometry state
+            Pose2D state
             Blob blob
         Output:
             int
@@ -363,16 +1007,17 @@ class FilterParticle(object):
             >0 = existing full feature
         '''
         # create a list of existing features as (id, feature) pairs
-        features = list(self.feature_set.items())
+        features = list(self.priors.items())
+        features.extend(list(self.feature_set.items()))
         features.extend(list(self.potential_features.items()))
         
-        max_match = 0.0
+        max_match = float('-inf')
         max_match_id = 0
 
         for id_, feature in features:
             if rospy.is_shutdown():
                 break
-            new_match = self.probability_of_match(state, blob, feature)
+            new_match = self.log_probability_of_match(state, blob, feature)
             # rospy.loginfo('%d new match %f' % (id_, new_match))
             if new_match > max_match:
                 max_match = new_match
@@ -386,22 +1031,37 @@ class FilterParticle(object):
         given feature
 
         Input:
-            Odometry state
+            Pose2D state
             Blob blob
             Feature feature
         Output:
             float (probability)
         '''
+        return math.exp(self.log_probability_of_match(state, blob, feature))
+
+    def log_probability_of_match(self, state, blob, feature):
+        '''
+        Calculate the log probability that a state and a blob observation match
+        a given feature. Working in logs keeps small probabilities from
+        multiplying out to 0.
+
+        Input:
+            Pose2D state
+            Blob blob
+            Feature feature
+        Output:
+            float (log probability, -inf for no match)
+        '''
 
         f_mean = feature.mean # [x, y, r, b, g]
         f_covar = feature.covar
+        # cached with the feature until its covariance changes
+        inverses, log_dets = feature.match_terms()
 
         f_x = f_mean[0]
         f_y = f_mean[1]
 
-        s_x = state.pose.pose.position.x
-        s_y = state.pose.pose.position.y
-        s_heading = quaternion_to_heading(state.pose.pose.orientation)
+        s_x, s_y, s_heading = pose_of(state)
 
         # rospy.loginfo('atan2(%f - %f, %f - %f) - %f' % (f_y, s_y, f_x, s_x, s_heading,))
 
@@ -426,33 +1086,24 @@ class FilterParticle(object):
                             math.pow(blob.color.g - f_mean[3], 2) +
                             math.pow(blob.color.b - f_mean[4], 2))
 
-        # add the 500s to boost small numbers away from 0. Everything gets the
-        #   multiple, but it should make the multiplication of the two numbers
-        #   less likely to hit 0 unless one of them really is 0
-
         if abs(del_bearing) > 0.5:
             # rospy.loginfo('color distance was ... %f' % color_distance)
             # rospy.loginfo('bearing exit')
-            return 0.0
+            return float('-inf')
         else:
             # pylint: disable=line-too-long
-            bearing_prob = 500.0*self.prob_position_match(f_mean, f_covar, s_x, s_y, observed_bearing)
+            bearing_prob = self.log_prob_position_match(f_mean, f_covar, s_x, s_y, observed_bearing, (inverses[0:2, 0:2], log_dets[0]))
 
         if abs(color_distance) > 300:
             # rospy.loginfo('%d %d %d | %d %d %d' % (blob.color.r, blob.color.g, blob.color.b, f_mean[2], f_mean[3], f_mean[4]))
             # rospy.loginfo('color exit')
-            return 0.0
+            return float('-inf')
         else:
-            color_prob = 500.0*self.prob_color_match(f_mean, f_covar, blob)
+            color_prob = self.log_prob_color_match(f_mean, f_covar, blob, (inverses[2:, 2:], log_dets[1]))
             # rospy.loginfo('bp: %f' % bearing_prob)
             # rospy.loginfo('cp: %f' % color_prob)
 
-        if not isinstance(bearing_prob, float):
-            rospy.loginfo('type(bearing_prob) %s' % str(type(bearing_prob)))
-        if not isinstance(color_prob, float):
-            rospy.loginfo('type(color_prob) %s' % str(type(color_prob)))
-            
-        return bearing_prob*color_prob / (250000.0)
+        return bearing_prob + color_prob
 
     def prob_position_match(self, f_mean, f_covar, s_x, s_y, bearing):
         '''
@@ -467,31 +1118,37 @@ class FilterParticle(object):
         Output:
             float
         '''
+        return math.exp(self.log_prob_position_match(f_mean, f_covar, s_x, s_y,
+            bearing))
+
+    def log_prob_position_match(self, f_mean, f_covar, s_x, s_y, bearing,
+        terms=None):
+        '''
+        Log of prob_position_match
+        Input:
+            (same as prob_position_match)
+            (np.ndarray inverse, float log_det) terms (of the position
+                covariance, see Feature.match_terms, optional)
+        Output:
+            float (-inf for no match)
+        '''
         f_x = float(f_mean[0])
         f_y = float(f_mean[1])
 
         pse_bearing = math.atan2(f_y-s_y, f_x-s_x)
         if abs(pse_bearing - bearing) > math.pi/2:
-            return 0.0
+            return float('-inf')
 
         # find closest point to feature on the line from state, bearing
         near_x, near_y = self.closest_point(f_x, f_y, s_x, s_y, bearing)
 
         # then use multivariate distribution pdf to find the probability of the
         #   closest point being inside that distribution
-        feature_mean = Matrix([f_x, f_y])
-        feature_mean.flatten()
-        
-        feature_covar = f_covar[0:2, 0:2]
-
-        obs_mean = Matrix([near_x, near_y])
-        obs_mean.flatten()
-        result = multivariate_normal.pdf(obs_mean, mean=feature_mean,
-            cov=feature_covar)
-        if not isinstance(result, float):
-            rospy.loginfo('scipy gotcha: %s' % str(type(result)))
-            rospy.loginfo('result: %s' % str(result))
-        return result
+        if terms is None:
+            factor = CovarianceFactor(f_covar[0:2, 0:2])
+            terms = (factor.inverse, factor.log_det)
+
+        return log_pdf(Matrix([near_x - f_x, near_y - f_y]), *terms)
 
     def closest_point(self, f_x, f_y, s_x, s_y, obs_bearing):
         '''
@@ -526,6 +1183,18 @@ class FilterParticle(object):
         Calculate the likelihood of the observed color being within the
         distribution defined by the color mean and covariance from the feature
         '''
+        return math.exp(self.log_prob_color_match(f_mean, f_covar, blob))
+
+    def log_prob_color_match(self, f_mean, f_covar, blob, terms=None):
+        '''
+        Log of prob_color_match
+        Input:
+            np.ndarray f_mean
+            np.ndarray f_covar
+            Blob blob
+            (np.ndarray inverse, float log_det) terms (of the color
+                covariance, see Feature.match_terms, optional)
+        '''
 
         f_r = f_mean[2]
         f_g = f_mean[3]
@@ -537,11 +1206,12 @@ class FilterParticle(object):
         b_b = blob.color.b
         blob_mean = Matrix([b_r, b_g, b_b])
 
-        color_covar = f_covar[2:, 2:]
+        if terms is None:
+            factor = CovarianceFactor(f_covar[2:, 2:])
+            terms = (factor.inverse, factor.log_det)
 
         # use multivariate pdf to calculate the probability of a color match
-        return multivariate_normal.pdf(blob_mean,
-            mean=color_mean, cov=color_covar)
+        return log_pdf(blob_mean - color_mean, *terms)
 
     def add_hypothesis(self, state, blob):
         '''
@@ -549,7 +1219,7 @@ class FilterParticle(object):
         check to see if it matches a hypothetical feature. If that hypothetical
         is strong enough, add it to the particles
         Input:
-            Odometry state (position of observation)
+            Pose2D state (position of observation)
             Blob blob (observation)
         Output:
             None
@@ -568,7 +1238,7 @@ class FilterParticle(object):
         close enough, return the id of the other reading that is close.
         Otherwise, return -1*the id of the other reading that is closest.
         Input:
-            Odometry state
+            Pose2D state
             Blob blob
         Output:
             int
@@ -595,12 +1265,10 @@ class FilterParticle(object):
         not intersect, the distance is infinite. Otherwise, it is the distance
         between two colors.
         '''
-        x1 = state1.pose.pose.position.x
-        y1 = state1.pose.pose.position.y
-        b1 = blob1.bearing + quaternion_to_heading(state1.pose.pose.orientation)
-        x2 = state2.pose.pose.position.x
-        y2 = state2.pose.pose.position.y
-        b2 = blob2.bearing + quaternion_to_heading(state2.pose.pose.orientation)
+        x1, y1, h1 = pose_of(state1)
+        b1 = blob1.bearing + h1
+        x2, y2, h2 = pose_of(state2)
+        b2 = blob2.bearing + h2
 
         if not self.ray_intersect(x1, y1, b1, x2, y2, b2):
             return float('inf')
@@ -655,7 +1323,7 @@ class FilterParticle(object):
         Adds a new feature based on the intersection of the last two readings.
         Input:
             int old_id
-            Odometry state
+            Pose2D state
             Blob blob
         Output:
             None
@@ -690,22 +1358,18 @@ class FilterParticle(object):
         See https://en.wikipedia.org/wiki/Line-line_intersection
 
         Input:
-            (Odometry, Blob,) old_reading
-            (Odometry, Blob,) new_reading
+            (Pose2D, Blob,) old_reading
+            (Pose2D, Blob,) new_reading
         Output:
             (float, float)
         '''
 
-        x1 = old_reading[0].pose.pose.position.x
-        y1 = old_reading[0].pose.pose.position.y
-        h1 = quaternion_to_heading(old_reading[0].pose.pose.orientation)
+        x1, y1, h1 = pose_of(old_reading[0])
         h1 = h1+old_reading[1].bearing
         x2 = x1+cos(h1)
         y2 = y1+sin(h1)
 
-        x3 = new_reading[0].pose.pose.position.x
-        y3 = new_reading[0].pose.pose.position.y
-        h3 = quaternion_to_heading(new_reading[0].pose.pose.orientation)
+        x3, y3, h3 = pose_of(new_reading[0])
         h3 = h3+new_reading[1].bearing
         x4 = x3+cos(h3)
         y4 = y3+sin(h3)
@@ -773,9 +1437,9 @@ class FilterParticle(object):
          Moving jacobian from derivative of measurement wrt pose
          to derivative of measurement wrt to feature state
         '''
-        state = self.state
-        mean_x = state.pose.pose.position.x
-        mean_y = state.pose.pose.position.y
+        state = pose_of(self.state)
+        mean_x = state.x
+        mean_y = state.y
         feature_mean = self.get_feature_by_id(feature_id).mean
         feature_x = feature_mean[0]
         feature_y = feature_mean[1]
@@ -832,37 +1496,41 @@ class FilterParticle(object):
         old_covar = self.get_feature_by_id(feature_id).covar
         return Matrix(mm(mm(old_covar, bigH.T), Qinv))
 
-    def importance_factor(self, bigQ, blob, pseudoblob):
+    def importance_factor(self, bigQ, blob, pseudoblob, Qinv=None):
         '''
-        Calculate the relative importance of this measurement (weight) to be
-        used as part of resampling
+        Calculate the relative importance of this measurement (log weight) to
+        be used as part of resampling
         Input:
             np.ndarray bigQ (measurement covariance)
             Blob blob (recieved measurement)
             Blob pseudoblob (estimated measurement)
+            np.ndarray Qinv (inverse of bigQ, if it was already computed)
+        Output:
+            float (log weight)
         '''
-        v1 = 2.0*math.pi *magnitude(bigQ)
-        v1 = pow(v1, -0.5)
+        if Qinv is None:
+            Qinv = inverse(bigQ)
+        v1 = -0.5*math.log(2.0*math.pi *magnitude(bigQ))
         delz = blob_to_matrix(blob) - blob_to_matrix(pseudoblob)
         delzt = delz.T
-        v2 = math.exp(-0.5 * mm(mm(delzt, inverse(bigQ)), delz))
-        return v1 * v2
+        v2 = -0.5 * float(mm(mm(delzt, Qinv), delz))
+        return v1 + v2
 
     def no_match_weight(self):
         '''
-        return the default weight for when a particle doesn't match an
+        return the default log weight for when a particle doesn't match an
         observation to an existing feature
         '''
         # TODO(later): choose/tune the right arbitrary weight
-        return 0.1
+        return math.log(0.1)
 
     def generate_measurement(self, featureid):
         '''
         Generate an expected measurement for the given featureid
         '''
-        state = self.state
-        s_x = state.pose.pose.position.x
-        s_y = state.pose.pose.position.y
+        state = pose_of(self.state)
+        s_x = state.x
+        s_y = state.y
         feature = self.get_feature_by_id(featureid)
         f_x = feature.mean[0]
         f_y = feature.mean[1]
@@ -893,6 +1561,83 @@ class Feature(object):
         self.covar = covar
         self.identity = identity(covar.shape[0])
         self.update_count = 0
+        # lazily computed inverses and log determinants for matching (see
+        #   match_terms), reset by update_covar
+        self._terms = None
+        # Cholesky factor of covar (see covar_sqrt)
+        self._sqrt = None
+
+    def covar_sqrt(self):
+        '''
+        Lower triangular Cholesky factor of the covariance. In square-root
+        mode (see set_estimate_sqrt) this is the stored factor; otherwise it
+        is computed from covar (see matrix.psd_cholesky) and cached.
+        Output:
+            np.ndarray (5, 5)
+        '''
+        if self._sqrt is None:
+            self._sqrt = psd_cholesky(self.covar)
+        return self._sqrt
+
+    def match_terms(self):
+        '''
+        Inverses and log determinants of the position and color blocks of the
+        covariance (see correspondence.covariance_terms), cached until the
+        covariance changes. The landmark maps pack these next to the means for
+        log_match_matrix.
+        Output:
+            (np.ndarray inverses (5, 5), np.ndarray log_dets (2,))
+        '''
+        if self._terms is None:
+            inverses, log_dets = covariance_terms(
+                np.asarray(self.covar)[np.newaxis])
+            self._terms = (inverses[0], log_dets[0])
+        return self._terms
+
+    def copy(self):
+        '''
+        Copy the feature for a copy-on-write update. update_mean and
+        update_covar assign new arrays instead of changing the old ones, so a
+        shallow copy is enough.
+        Output:
+            Feature
+        '''
+        return copy_module.copy(self)
+
+    def set_estimate(self, mean, covar):
+        '''
+        Set the mean and covariance from an EKF update computed elsewhere (see
+        ekf.py). It counts as two updates, the same as update_mean followed by
+        update_covar.
+        Input:
+            np.ndarray mean
+            np.ndarray covar
+        Output:
+            None
+        '''
+        if self.__immutable__:
+            return None
+        self.mean = mean
+        self.covar = covar
+        self._terms = None
+        self._sqrt = None
+        self.update_count += 2
+
+    def set_estimate_sqrt(self, mean, covar_sqrt):
+        '''
+        set_estimate with the covariance given by its (lower triangular)
+        Cholesky factor, for square-root mode. The covariance is rebuilt from
+        the factor, so it stays symmetric and positive definite.
+        Input:
+            np.ndarray mean
+            np.ndarray covar_sqrt
+        Output:
+            None
+        '''
+        if self.__immutable__:
+            return None
+        self.set_estimate(mean, mm(covar_sqrt, covar_sqrt.T))
+        self._sqrt = covar_sqrt
 
     def update_mean(self, kalman_gain, measure, expected_measure):
         '''
@@ -927,4 +1672,89 @@ class Feature(object):
             return None
         adjust = msubtract(self.identity, mm(kalman_gain, bigH))
         self.covar = mm(adjust, self.covar)
+        self._terms = None
+        self._sqrt = None
         self.update_count += 1
+
+class FeatureView(Feature):
+    '''
+    A Feature that lives in a row of a LandmarkTable. Reading an attribute
+    reads the table, and setting one writes the table (which copies the row's
+    page first if a fork shares it), so the Feature methods work unchanged.
+    '''
+    # pylint: disable=super-init-not-called
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def mean(self):
+        page, offset = self.table.page(self.row)
+        return page['means'][offset].copy()
+
+    @mean.setter
+    def mean(self, value):
+        page, offset = self.table.writable(self.row)
+        page['means'][offset] = np.ravel(value)
+
+    @property
+    def covar(self):
+        page, offset = self.table.page(self.row)
+        return page['covars'][offset].copy()
+
+    @covar.setter
+    def covar(self, value):
+        self.table.set_covar(self.row, value)
+
+    @property
+    def update_count(self):
+        page, offset = self.table.page(self.row)
+        return int(page['counts'][offset])
+
+    @update_count.setter
+    def update_count(self, value):
+        page, offset = self.table.writable(self.row)
+        page['counts'][offset] = value
+
+    @property
+    def __immutable__(self):
+        page, offset = self.table.page(self.row)
+        return bool(page['flags'][offset] & IMMUTABLE)
+
+    @property
+    def identity(self):
+        return identity(5)
+
+    # the caches live in the table so that they outlast the view, and the
+    #   table drops them when the covariance is written (see set_covar)
+    @property
+    def _terms(self):
+        return self.table.row_terms(self.row)
+
+    @_terms.setter
+    def _terms(self, value):
+        pass
+
+    @property
+    def _sqrt(self):
+        page, offset = self.table.page(self.row)
+        return page['sqrts'][offset]
+
+    @_sqrt.setter
+    def _sqrt(self, value):
+        # a page shared with a fork holds the same covariances, so the factor
+        #   is written without copying the page
+        page, offset = self.table.page(self.row)
+        page['sqrts'][offset] = value
+
+    def copy(self):
+        '''
+        Detach the feature from the table
+        Output:
+            Feature
+        '''
+        feature = Feature(mean=self.mean, covar=self.covar)
+        feature.update_count = self.update_count
+        feature.__immutable__ = self.__immutable__
+        return feature
+
@@ -7,13 +7,18 @@ Create a ROS node that uses the parakeet core to do SLAM
 import rospy
 import sys
 
+from collections import namedtuple
 from geometry_msgs.msg import Twist
+from ingest import IngestQueue, IngestWorker, SCAN, TWIST
 from matrix import Matrix
 from nav_msgs.msg import Odometry
 from prkt_core_v2 import FastSLAM, Feature
 from utils import quaternion_to_heading, heading_to_quaternion
 from viz_feature_sim.msg import VizScan
 
+# what FastSLAM.cam_cb reads the scan from
+ScanView = namedtuple('ScanView', ['last_sensor_reading'])
+
 class CamSlam360(object):
     '''
     Maintains a state for the robot, as well as for features
@@ -30,6 +35,11 @@ class CamSlam360(object):
 
         self.last_sensor_reading = None
 
+        # the callbacks queue messages here, and the ingest worker thread
+        #   runs the filter on them (see ingest.py and start_worker)
+        self.ingest = IngestQueue()
+        self.worker = None
+
         preset_covariance = Matrix([[0.25,0,0,0,0],
                                     [0,0.25,0,0,0],
                                     [0,0,0.25,0,0],
@@ -65,30 +75,56 @@ class CamSlam360(object):
         if self.core is not None:
             rospy.loginfo('Running!')
             self.print_summary()
-            while (not rospy.is_shutdown()) and (self.last_sensor_reading is None):
-                rospy.loginfo('waiting on the first sensor data')
-                if (rospy.Time.now().to_sec() > 40):
-                    return 10
-                joke_rate.sleep()
-            while not rospy.is_shutdown():
-                self.loop_over_particles()
-                rospy.loginfo('joke rate stop?')
-                if (rospy.Time.now().to_sec() > 40):
-                    # rospy.loginfo('... yes')
-                    return 10
-                joke_rate.sleep()
+            self.start_worker()
+            try:
+                while (not rospy.is_shutdown()) and (self.last_sensor_reading is None):
+                    rospy.loginfo('waiting on the first sensor data')
+                    if (rospy.Time.now().to_sec() > 40):
+                        return 10
+                    joke_rate.sleep()
+                while not rospy.is_shutdown():
+                    # the ingest worker does the filtering
+                    rospy.loginfo('joke rate stop?')
+                    if (rospy.Time.now().to_sec() > 40):
+                        # rospy.loginfo('... yes')
+                        return 10
+                    joke_rate.sleep()
+            finally:
+                self.stop_worker()
             rospy.loginfo('exited main loop. Done!')
 
-    def loop_over_particles(self):
-        rospy.loginfo('main loop passing of sensor data to SLAM')
-        self.core.cam_cb(self)
-        self.odom_pub.publish(self.easy_odom())
+    def start_worker(self):
+        '''
+        Start the filter worker thread that processes the queued twists and
+        scans in stamp order
+        '''
+        if self.worker is None:
+            self.worker = IngestWorker(self.ingest, {
+                SCAN: self.process_scan,
+                TWIST: self.process_twist,
+            })
+            self.worker.start()
+
+    def stop_worker(self):
+        '''
+        Let the worker finish the queued messages, then stop it
+        '''
+        if self.worker is not None:
+            self.ingest.close()
+            self.worker.join()
+            self.worker = None
 
     def initialize_particle_filter(self, preset_features):
         '''
         Create an instance of FastSLAM algorithm
         '''
         self.core = FastSLAM(preset_features)
+        # with the preset features, the robot should stay well localized, so
+        #   let the filter shrink to a few particles when it can
+        self.core.adaptive_particles = True
+        # the twists go into the control history, and the particles are
+        #   moved to the stamp of each scan (see process_twist)
+        self.core.stamped_motion = True
 
     def easy_odom(self):
         x, y, heading = self.core.summary()
@@ -102,29 +138,46 @@ class CamSlam360(object):
 
     def measurement_update(self, msg):
         '''
-        Pass along a VizScan message to the main running loop
+        Pass along a VizScan message to the filter worker (see process_scan)
         '''
-        # self.core.cam_cb(msg)
-        # rospy.loginfo('new sensor data...')
-        self.last_sensor_reading = msg
-        odom = self.easy_odom()
-        self.odom_pub.publish(odom)
+        self.ingest.put_scan(msg)
 
     def motion_update(self, msg):
         '''
-        Pass along a Twist message
+        Pass along a Twist message to the filter worker (see process_twist)
+        '''
+        self.ingest.put_twist(msg)
+
+    def process_scan(self, scan, stamp):
+        '''
+        Run the filter on a scan (on the worker thread)
+        Input:
+            VizScan scan
+            float stamp
+        '''
+        self.last_sensor_reading = scan
+        # cam_cb gets its own view so it never sees a later reading, and the
+        #   stamp the scan was queued with, so it moves the particles through
+        #   the twists queued before it (see FastSLAM.advance_for_scan)
+        self.core.cam_cb(ScanView(scan), stamp)
+        self.odom_pub.publish(self.easy_odom())
+
+    def process_twist(self, twist, stamp):
+        '''
+        Record a new twist (on the worker thread). The particles move through
+        it when the next scan is processed (see FastSLAM.advance_to).
+        Input:
+            Twist twist
+            float stamp
         '''
-        # rospy.loginfo('motion_update('+str(msg)+')')
-        self.core.motion_update(msg)
-        # self.print_summary()
-        odom = self.easy_odom()
-        self.odom_pub.publish(odom)
+        self.core.record_control(twist, stamp)
 
     def print_summary(self):
         '''
         average x, y, heading
         '''
         rospy.loginfo('prkt_summary: '+str(self.core.summary()))
+        rospy.loginfo('prkt_scans: '+str(self.core.scan_tracker.counters()))
 
 
 if __name__ == '__main__':
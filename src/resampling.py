@@ -0,0 +1,157 @@
+'''
+Resampling
+
+Vectorized O(M) resampling schemes for the particle filters. Each scheme takes
+the (unnormalized) particle weights and returns an array of indices of the
+particles to keep; the caller applies the index array to its particle set in
+bulk (see ParticleStore.select).
+
+All of the schemes are index gathers: a set of points in [0, 1) is located in
+the cumulative sum of the normalized weights with searchsorted.
+'''
+
+# pylint: disable=invalid-name
+
+import math
+import numpy as np
+
+from numpy.random import random_sample
+
+def normalize(weights):
+    '''
+    Normalize the weights so they sum to 1. If the weights are all zero (or
+    not finite), every particle gets the same weight.
+    Input:
+        np.ndarray weights (M,)
+    Output:
+        np.ndarray (M,)
+    '''
+    weights = np.asarray(weights, dtype=float)
+    total = np.sum(weights)
+    if not np.isfinite(total) or total <= 0.0:
+        return np.ones(len(weights)) / float(len(weights))
+    return weights / total
+
+def log_normalize(log_weights):
+    '''
+    Normalize log weights so that their exponents sum to 1 (log-sum-exp). If
+    every weight is -inf (or not finite), every particle gets the same weight.
+    Input:
+        np.ndarray log_weights (M,)
+    Output:
+        np.ndarray log_weights (M,)
+    '''
+    log_weights = np.asarray(log_weights, dtype=float)
+    peak = np.max(log_weights)
+    if not np.isfinite(peak):
+        return np.zeros(len(log_weights)) - math.log(len(log_weights))
+    total = peak + math.log(float(np.sum(np.exp(log_weights - peak))))
+    return log_weights - total
+
+def effective_sample_size(weights):
+    '''
+    Effective sample size of the particle set, 1 / sum(w^2) of the normalized
+    weights. It is M when the weights are uniform and 1 when one particle has
+    all of the weight.
+    Input:
+        np.ndarray weights (M,)
+    Output:
+        float
+    '''
+    weights = normalize(weights)
+    return 1.0 / float(np.sum(weights * weights))
+
+def _gather(weights, points):
+    '''
+    Find the index of the particle that each point in [0, 1) lands on
+    '''
+    cumulative = np.cumsum(normalize(weights))
+    indices = np.searchsorted(cumulative, points, side='right')
+    # guard against the last cumulative sum being slightly less than 1
+    return np.minimum(indices, len(cumulative) - 1)
+
+def systematic_resample(weights, count=None):
+    '''
+    Low variance resampling: one random offset, then count evenly spaced
+    points.
+    Input:
+        np.ndarray weights (M,)
+        int count (number of particles to draw, defaults to M)
+    Output:
+        np.ndarray indices (count,)
+    '''
+    if count is None:
+        count = len(weights)
+    points = (random_sample() + np.arange(0, count)) / float(count)
+    return _gather(weights, points)
+
+def stratified_resample(weights, count=None):
+    '''
+    One random point in each of count equal strata of [0, 1).
+    Input:
+        np.ndarray weights (M,)
+        int count (number of particles to draw, defaults to M)
+    Output:
+        np.ndarray indices (count,)
+    '''
+    if count is None:
+        count = len(weights)
+    points = (random_sample(count) + np.arange(0, count)) / float(count)
+    return _gather(weights, points)
+
+def multinomial_resample(weights, count=None):
+    '''
+    count independent draws from the weights.
+    Input:
+        np.ndarray weights (M,)
+        int count (number of particles to draw, defaults to M)
+    Output:
+        np.ndarray indices (count,)
+    '''
+    if count is None:
+        count = len(weights)
+    points = np.sort(random_sample(count))
+    return _gather(weights, points)
+
+def residual_resample(weights, count=None):
+    '''
+    Keep floor(count * w) copies of every particle, then draw the rest
+    multinomially from the leftover weights.
+    Input:
+        np.ndarray weights (M,)
+        int count (number of particles to draw, defaults to M)
+    Output:
+        np.ndarray indices (count,)
+    '''
+    if count is None:
+        count = len(weights)
+    scaled = normalize(weights) * count
+    copies = np.floor(scaled).astype(int)
+    kept = np.repeat(np.arange(0, len(copies)), copies)
+
+    remaining = count - len(kept)
+    if remaining <= 0:
+        return kept
+    leftover = multinomial_resample(scaled - copies, remaining)
+    return np.concatenate((kept, leftover))
+
+SCHEMES = {
+    'systematic': systematic_resample,
+    'stratified': stratified_resample,
+    'multinomial': multinomial_resample,
+    'residual': residual_resample,
+}
+
+def resample(weights, scheme='systematic', count=None):
+    '''
+    Resample with the named scheme
+    Input:
+        np.ndarray weights (M,)
+        str scheme (systematic, stratified, multinomial or residual)
+        int count (number of particles to draw, defaults to M)
+    Output:
+        np.ndarray indices (count,)
+    raises:
+        KeyError (unknown scheme)
+    '''
+    return SCHEMES[scheme](weights, count)
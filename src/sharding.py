@@ -0,0 +1,428 @@
+'''
+Particle sharding
+
+Runs the measurement update of a particle set in a pool of worker processes.
+Each worker (a ShardWorker) owns the maps (FilterParticles) of some of the
+particles, by global particle index. The coordinator keeps only the poses and
+weights, in the ParticleStore, and a ShardSlot in place of each map that says
+which worker owns it.
+
+For each scan the coordinator copies the poses into shared memory, pickles the
+scan once and sends the same bytes to every worker. Each worker matches and
+updates its own particles (see prkt_core_v2.scan_likelihood) and writes their
+log likelihoods into a second shared array, so only a short reply goes back
+through the pipe.
+
+Resampling moves ownership by index: a new particle belongs to the worker
+that owns its parent, and each worker is sent the (new index, parent index)
+pairs for its own particles, and forks the maps locally. When a few parents
+win most of the weight, that would pile the particles onto a few workers, so
+once a worker would hold more than slack over an even share, plan_shards
+sends the overflow to the workers that are short. Only the parents of the
+overflow are pickled: their owners export them, and the receiving workers
+fork them like their own parents.
+'''
+
+# pylint: disable=invalid-name
+
+import math
+import multiprocessing
+import numpy as np
+import traceback
+
+from multiprocessing.sharedctypes import RawArray
+from utils import Pose2D
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+class ShardSlot(object):
+    '''
+    Stand-in for a particle's map in the coordinator's ParticleStore. Forking
+    it (see ParticleStore.select) gives a slot with the same owner.
+    '''
+    def __init__(self, shard):
+        self.shard = shard
+
+    def fork(self):
+        return ShardSlot(self.shard)
+
+class ShardWorker(object):
+    '''
+    The particles owned by one shard and the commands that run on them.
+    '''
+    def __init__(self, step, maps, poses=None, log_likelihood=None):
+        '''
+        Input:
+            function step(particles, scan, match_version, Qt, sqrt) -> log
+                likelihoods (see prkt_core_v2.scan_likelihood)
+            dict {global index: FilterParticle} maps
+            np.ndarray poses (capacity, 3) (shared, x, y, heading)
+            np.ndarray log_likelihood (capacity,) (shared output)
+        '''
+        self.step = step
+        self.maps = dict(maps)
+        self.poses = poses
+        self.log_likelihood = log_likelihood
+
+    def observe(self, scan, match_version, Qt, sqrt):
+        '''
+        Measurement update of the shard's particles for one scan. The poses
+        are read from, and the log likelihoods written to, the shared arrays.
+        Output:
+            int (number of particles updated)
+        '''
+        indices = sorted(self.maps)
+        if indices:
+            self.log_likelihood[indices] = self.observe_poses(indices,
+                self.poses[indices], scan, match_version, Qt, sqrt)
+        return len(indices)
+
+    def observe_poses(self, indices, poses, scan, match_version, Qt, sqrt):
+        '''
+        observe for a shard without shared memory: the poses come with the
+        command and the log likelihoods go back in the reply
+        Input:
+            list of int indices (every particle in the shard)
+            np.ndarray poses (len(indices), 3)
+        Output:
+            np.ndarray (len(indices),) log likelihoods
+        '''
+        particles = []
+        for index, (x, y, heading) in zip(indices, poses):
+            particle = self.maps[index]
+            particle.state = Pose2D(float(x), float(y), float(heading))
+            particles.append(particle)
+        if not particles:
+            return np.zeros(0)
+        return self.step(particles, scan, match_version, Qt, sqrt)
+
+    def select(self, pairs, incoming=None):
+        '''
+        Apply a resampling step to the shard. The first copy of a parent keeps
+        its map and the others are forks (like ParticleStore.select).
+        Input:
+            list of (int new index, int parent index) pairs
+            dict {parent index: FilterParticle} incoming (parents that other
+                shards own, see export)
+        Output:
+            int (number of particles in the shard)
+        '''
+        if incoming is None:
+            incoming = {}
+        maps = {}
+        used = set()
+        for new_index, parent in pairs:
+            if parent in incoming:
+                source = incoming[parent]
+            else:
+                source = self.maps[parent]
+            if parent in used:
+                maps[new_index] = source.fork()
+            else:
+                used.add(parent)
+                maps[new_index] = source
+        self.maps = maps
+        return len(maps)
+
+    def export(self, parents):
+        '''
+        Copies of the given parents for other shards (the copies are pickled
+        on the way, so they don't share anything with this shard)
+        Input:
+            iterable of parent indices
+        Output:
+            dict {parent index: FilterParticle}
+        '''
+        return self.fetch(parents)
+
+    def fetch(self, indices):
+        '''
+        Input:
+            iterable of global indices
+        Output:
+            dict {global index: FilterParticle}
+        '''
+        return dict((index, self.maps[index]) for index in indices)
+
+    def handle(self, message):
+        '''
+        Run one command: ('observe', scan, match_version, Qt, sqrt),
+        ('observe_poses', indices, poses, scan, match_version, Qt, sqrt),
+        ('select', pairs[, incoming]), ('export', parents) or
+        ('fetch', indices)
+        Output:
+            the command's result
+        raises:
+            ValueError (unknown command)
+        '''
+        command = message[0]
+        if command == 'observe':
+            return self.observe(*message[1:])
+        elif command == 'observe_poses':
+            return self.observe_poses(*message[1:])
+        elif command == 'select':
+            return self.select(*message[1:])
+        elif command == 'export':
+            return self.export(*message[1:])
+        elif command == 'fetch':
+            return self.fetch(*message[1:])
+        raise ValueError('unknown shard command %r' % (command,))
+
+    def serve(self, connection):
+        '''
+        Answer commands (pickled tuples) from the connection until 'stop'.
+        Each reply is ('ok', result) or ('error', traceback text).
+        '''
+        while True:
+            message = pickle.loads(connection.recv_bytes())
+            if message[0] == 'stop':
+                connection.close()
+                return
+            try:
+                reply = ('ok', self.handle(message))
+            except Exception: # pylint: disable=broad-except
+                reply = ('error', traceback.format_exc())
+            connection.send(reply)
+
+def plan_shards(owners, indices, shard_count, slack=0.0):
+    '''
+    Choose the shard of every particle after resampling. A particle stays with
+    its parent's shard while that shard holds at most (1 + slack) times an
+    even share; the rest go to the shards that are below an even share,
+    with the copies of one parent kept together where they fit.
+    Input:
+        list of int owners (shard of each particle before resampling)
+        np.ndarray indices (parent of each new particle)
+        int shard_count
+        float slack
+    Output:
+        np.ndarray (int) shard of each new particle
+    '''
+    indices = np.asarray(indices, dtype=int)
+    owners = np.asarray(owners, dtype=int)
+    count = len(indices)
+    target = int(math.ceil(count / float(shard_count)))
+    limit = int(math.floor(target * (1.0 + slack)))
+    new_owners = np.zeros(count, dtype=int)
+    load = np.zeros(shard_count, dtype=int)
+    overflow = []
+    # parents with the fewest copies stay first, so that the overflow is
+    #   made of the parents with the most copies (fewer maps to send), and
+    #   the copies of a parent are next to each other
+    copies = np.bincount(indices, minlength=len(owners))
+    for child in np.lexsort((indices, copies[indices])).tolist():
+        shard = owners[indices[child]]
+        if load[shard] < limit:
+            new_owners[child] = shard
+            load[shard] += 1
+        else:
+            overflow.append(child)
+    receiver = 0
+    for child in overflow:
+        while load[receiver] >= target:
+            receiver += 1
+        new_owners[child] = receiver
+        load[receiver] += 1
+    return new_owners
+
+def shared_array(raw, shape):
+    '''
+    numpy view of a RawArray of doubles
+    '''
+    return np.ctypeslib.as_array(raw).reshape(shape)
+
+def serve_shard(connection, step, maps, raw_poses, raw_likelihood, capacity):
+    '''
+    Worker process entry point (see ShardPool)
+    '''
+    worker = ShardWorker(step, maps, shared_array(raw_poses, (capacity, 3)),
+        shared_array(raw_likelihood, (capacity,)))
+    worker.serve(connection)
+
+class ShardPool(object):
+    def __init__(self, store, step, workers=None, capacity=None, slack=.1):
+        '''
+        Start the worker processes and hand the store's maps over to them.
+        The store's maps are replaced with ShardSlots.
+        Input:
+            ParticleStore store
+            function step (see ShardWorker)
+            int workers (defaults to the number of cores)
+            int capacity (most particles the pool will hold, defaults to the
+                current number)
+            float slack (see plan_shards)
+        '''
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if capacity is None:
+            capacity = len(store)
+        workers = max(1, min(workers, len(store)))
+        self.slack = slack
+        # parents sent between shards in the last resampling step
+        self.moved = 0
+        self.capacity = capacity
+        self._raw_poses = RawArray('d', capacity * 3)
+        self._raw_likelihood = RawArray('d', capacity)
+        self.poses = shared_array(self._raw_poses, (capacity, 3))
+        self.log_likelihood = shared_array(self._raw_likelihood, (capacity,))
+
+        self.connections = []
+        self.processes = []
+        slots = [None]*len(store)
+        chunks = np.array_split(np.arange(0, len(store)), workers)
+        for shard, chunk in enumerate(chunks):
+            maps = {}
+            for index in chunk.tolist():
+                maps[index] = store.maps[index]
+                slots[index] = ShardSlot(shard)
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve_shard, args=(child,
+                step, maps, self._raw_poses, self._raw_likelihood, capacity))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        store.maps = slots
+
+    def __len__(self):
+        return len(self.connections)
+
+    def _broadcast(self, message, shards=None):
+        '''
+        Send one message (pickled once) to the shards and collect the results
+        Output:
+            list of results (in shard order)
+        raises:
+            RuntimeError (a shard failed)
+        '''
+        if shards is None:
+            shards = range(0, len(self.connections))
+        payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        for shard in shards:
+            self.connections[shard].send_bytes(payload)
+        return [self._reply(shard) for shard in shards]
+
+    def _scatter(self, messages):
+        '''
+        Send each shard its own message and collect the results
+        Input:
+            list of messages (one per shard)
+        Output:
+            list of results (in shard order)
+        raises:
+            RuntimeError (a shard failed)
+        '''
+        for connection, message in zip(self.connections, messages):
+            connection.send_bytes(pickle.dumps(message,
+                pickle.HIGHEST_PROTOCOL))
+        return [self._reply(shard) for shard in range(0, len(messages))]
+
+    def _reply(self, shard):
+        status, result = self.connections[shard].recv()
+        if status != 'ok':
+            raise RuntimeError('shard %d failed:\n%s' % (shard, result))
+        return result
+
+    def observe(self, store, scan, match_version, Qt, sqrt=False):
+        '''
+        Measurement update of every particle in the pool for one scan
+        Input:
+            ParticleStore store (poses)
+            VizScan scan
+            int match_version
+            np.ndarray Qt
+            bool sqrt
+        Output:
+            np.ndarray (M,) log likelihood of the scan for each particle
+        raises:
+            ValueError (more particles than the pool's capacity)
+        '''
+        count = len(store)
+        if count > self.capacity:
+            raise ValueError('%d particles in a pool for %d' % (count,
+                self.capacity))
+        self.poses[0:count, 0] = store.x
+        self.poses[0:count, 1] = store.y
+        self.poses[0:count, 2] = store.heading
+        self._broadcast(('observe', scan, match_version, Qt, sqrt))
+        return self.log_likelihood[0:count].copy()
+
+    def select(self, slots, indices):
+        '''
+        Move ownership for a resampling step (see plan_shards): export the
+        parents that have to change shards, then have every shard build its
+        new particles from its own parents and the imported ones. Call this
+        before ParticleStore.select.
+        Input:
+            list of ShardSlot slots (the store's maps before resampling)
+            np.ndarray indices (parent of each new particle)
+        Output:
+            list of ShardSlot (for the store's maps after resampling)
+        raises:
+            ValueError (more particles than the pool's capacity)
+        '''
+        if self.capacity is not None and len(indices) > self.capacity:
+            raise ValueError('%d particles in a pool for %d' % (len(indices),
+                self.capacity))
+        owners = [slot.shard for slot in slots]
+        indices = np.asarray(indices, dtype=int).tolist()
+        new_owners = plan_shards(owners, indices, len(self),
+            self.slack).tolist()
+
+        pairs = [[] for _ in self.connections]
+        exports = [set() for _ in self.connections]
+        for child, (parent, shard) in enumerate(zip(indices, new_owners)):
+            pairs[shard].append((child, parent))
+            if owners[parent] != shard:
+                exports[owners[parent]].add(parent)
+        moved = {}
+        if any(exports):
+            for found in self._scatter([('export', sorted(parents))
+                for parents in exports]):
+                moved.update(found)
+        self.moved = len(moved)
+
+        messages = []
+        for shard, shard_pairs in enumerate(pairs):
+            incoming = dict((parent, moved[parent]) for _, parent in
+                shard_pairs if owners[parent] != shard)
+            messages.append(('select', shard_pairs, incoming))
+        self._scatter(messages)
+        return [ShardSlot(shard) for shard in new_owners]
+
+    def fetch(self, slots, indices):
+        '''
+        Copy particles back from their shards (for inspection)
+        Input:
+            list of ShardSlot slots (the store's maps)
+            list of int indices
+        Output:
+            list of FilterParticle (in the order of indices)
+        '''
+        wanted = {}
+        for index in indices:
+            wanted.setdefault(slots[index].shard, []).append(index)
+        found = {}
+        for shard, shard_indices in wanted.items():
+            found.update(self._broadcast(('fetch', shard_indices), [shard])[0])
+        return [found[index] for index in indices]
+
+    def close(self, store=None):
+        '''
+        Stop the workers. If a store is given, its maps are fetched back from
+        the shards first.
+        '''
+        if store is not None:
+            store.maps = self.fetch(store.maps, range(0, len(store)))
+        payload = pickle.dumps(('stop',), pickle.HIGHEST_PROTOCOL)
+        for connection in self.connections:
+            connection.send_bytes(payload)
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
@@ -0,0 +1,258 @@
+'''
+Spatial index
+
+Uniform hash grid over landmark means, used to skip landmarks that can't pass
+the correspondence gates before any likelihoods are computed. Each cell holds
+the ids of the landmarks whose mean falls inside it. The grid works in any
+number of dimensions: the landmark maps keep one over x, y for the bearing
+gate (query_wedge) and one over r, g, b for the color gate (query_ball).
+
+Like LandmarkMap, a GridIndex can be forked for resampled particles. The
+forks share the cell tables until one of them changes, and then that one
+copies the (shallow) tables for itself.
+'''
+
+# pylint: disable=invalid-name
+
+import itertools
+import math
+import numpy as np
+
+DEFAULT_CELL_SIZE = 1.0
+
+class GridIndex(object):
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = float(cell_size)
+        # cell key (tuple of ints) -> tuple of ids
+        self._cells = {}
+        # id -> cell key
+        self._where = {}
+        # True when the tables may be shared with a fork
+        self._shared = False
+        self._cell_arrays = None
+        # smallest and largest cell key used in each dimension (only ever
+        #   grows, see query_wedge)
+        self._low = None
+        self._high = None
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, id_):
+        return id_ in self._where
+
+    def key(self, point):
+        '''
+        Cell key for a point
+        Input:
+            sequence of floats point
+        Output:
+            tuple of ints
+        '''
+        return tuple(int(math.floor(float(c) / self.cell_size)) for c in point)
+
+    def _own(self):
+        '''
+        Make the tables private to this index before changing them
+        '''
+        if self._shared:
+            self._cells = dict(self._cells)
+            self._where = dict(self._where)
+            self._shared = False
+        self._cell_arrays = None
+
+    def fork(self):
+        '''
+        Create an index with the same contents that shares the tables with this
+        one until either changes
+        Output:
+            GridIndex
+        '''
+        child = GridIndex(self.cell_size)
+        child._cells = self._cells
+        child._where = self._where
+        child._cell_arrays = self._cell_arrays
+        child._low = self._low
+        child._high = self._high
+        child._shared = True
+        self._shared = True
+        return child
+
+    def insert(self, id_, point):
+        '''
+        Add an id at the given point, or move it there if it is already indexed
+        Input:
+            id_
+            sequence of floats point
+        Output:
+            None
+        '''
+        key = self.key(point)
+        if self._where.get(id_) == key:
+            return
+        self._own()
+        if id_ in self._where:
+            self._remove_from_cell(id_)
+        self._where[id_] = key
+        self._cells[key] = self._cells.get(key, ()) + (id_,)
+        if self._low is None:
+            self._low = self._high = key
+        else:
+            self._low = tuple(min(a, b) for a, b in zip(self._low, key))
+            self._high = tuple(max(a, b) for a, b in zip(self._high, key))
+
+    def remove(self, id_):
+        '''
+        Remove an id from the index (no error if it isn't there)
+        '''
+        if id_ not in self._where:
+            return
+        self._own()
+        self._remove_from_cell(id_)
+        del self._where[id_]
+
+    def _remove_from_cell(self, id_):
+        key = self._where[id_]
+        remaining = tuple(other for other in self._cells[key] if other != id_)
+        if remaining:
+            self._cells[key] = remaining
+        else:
+            del self._cells[key]
+
+    def cell_arrays(self):
+        '''
+        The occupied cells as an array of cell centers and a list of the ids in
+        each cell (cached until the index changes)
+        Output:
+            (np.ndarray centers (C, dimensions), list of tuples of ids (C,))
+        '''
+        if self._cell_arrays is None:
+            keys = list(self._cells.keys())
+            if keys:
+                centers = (np.array(keys, dtype=float) + 0.5) * self.cell_size
+            else:
+                centers = np.zeros((0, 2))
+            self._cell_arrays = (centers, [self._cells[key] for key in keys])
+        return self._cell_arrays
+
+    def query_ball(self, point, radius):
+        '''
+        Ids in the cells that might hold a point within radius of the given
+        point (conservative, like query_wedge). With a cell size equal to the
+        radius this looks at 3^dimensions cells.
+        Input:
+            sequence of floats point
+            float radius
+        Output:
+            set of ids
+        '''
+        center = self.key(point)
+        reach = int(math.ceil(radius / self.cell_size))
+        steps = range(-reach, reach + 1)
+        result = set()
+        for offset in itertools.product(steps, repeat=len(center)):
+            key = tuple(c + o for c, o in zip(center, offset))
+            if key in self._cells:
+                result.update(self._cells[key])
+        return result
+
+    def query_wedge(self, x, y, directions, half_angle, max_range=None):
+        '''
+        Ids in the cells that might hold a point inside any of the wedges (rays
+        with an angular half width, out to max_range) starting at x, y. This is
+        conservative: it can return ids outside of the wedges, but never misses
+        one inside.
+
+        Only the cells in the bounding box of each wedge are looked at, so with
+        a max_range the cost depends on the range and not on the size of the
+        map. Without one the wedges reach the far side of the index. If the
+        wedges cover more cells than are occupied, the occupied cells are
+        tested instead.
+        Input:
+            float x, y (apex of the wedges)
+            np.ndarray directions (W,) world frame direction of each wedge
+            float half_angle
+            float max_range (optional)
+        Output:
+            set of ids
+        '''
+        if not self._cells:
+            return set()
+        directions = np.asarray(directions, dtype=float)
+        if max_range is None:
+            max_range = self._reach(x, y)
+        boxes = [self._wedge_box(x, y, direction, half_angle, max_range)
+            for direction in directions.tolist()]
+        size = sum((high[0] - low[0] + 1) * (high[1] - low[1] + 1)
+            for low, high in boxes)
+
+        result = set()
+        if size > len(self._cells):
+            centers, cell_ids = self.cell_arrays()
+            hit = self._wedge_hits(centers, x, y, directions, half_angle,
+                max_range)
+            for cell in np.nonzero(hit)[0]:
+                result.update(cell_ids[cell])
+            return result
+
+        for direction, (low, high) in zip(directions, boxes):
+            keys = np.mgrid[low[0]:high[0] + 1, low[1]:high[1] + 1]
+            keys = keys.reshape(2, -1).T
+            hit = self._wedge_hits((keys + 0.5) * self.cell_size, x, y,
+                direction[np.newaxis], half_angle, max_range)
+            for key in keys[hit].tolist():
+                result.update(self._cells.get(tuple(key), ()))
+        return result
+
+    def _reach(self, x, y):
+        '''
+        Distance from x, y to the farthest corner of every cell that has been
+        used (see _low, _high)
+        '''
+        corners_x = (self._low[0] * self.cell_size,
+            (self._high[0] + 1) * self.cell_size)
+        corners_y = (self._low[1] * self.cell_size,
+            (self._high[1] + 1) * self.cell_size)
+        return max(math.hypot(cx - x, cy - y) for cx in corners_x
+            for cy in corners_y)
+
+    def _wedge_box(self, x, y, direction, half_angle, max_range):
+        '''
+        Cell keys (low, high) of the bounding box of one wedge, padded by a
+        cell
+        '''
+        half_angle = min(half_angle, math.pi)
+        angles = [direction - half_angle, direction + half_angle]
+        # the arc also reaches out to the axis directions inside the wedge
+        quarter = int(math.ceil((direction - half_angle) / (math.pi / 2.0)))
+        while quarter * math.pi / 2.0 <= direction + half_angle:
+            angles.append(quarter * math.pi / 2.0)
+            quarter += 1
+        xs = [x] + [x + max_range * math.cos(angle) for angle in angles]
+        ys = [y] + [y + max_range * math.sin(angle) for angle in angles]
+        low = self.key((min(xs) - self.cell_size, min(ys) - self.cell_size))
+        high = self.key((max(xs) + self.cell_size, max(ys) + self.cell_size))
+        return (low, high)
+
+    def _wedge_hits(self, centers, x, y, directions, half_angle, max_range):
+        '''
+        Which of the cells (given by their centers) might overlap one of the
+        wedges
+        Output:
+            np.ndarray (bool) (C,)
+        '''
+        dx = centers[:, 0] - x
+        dy = centers[:, 1] - y
+        distance = np.sqrt(dx*dx + dy*dy)
+        radius = self.cell_size * math.sqrt(2.0) / 2.0
+
+        # angular half width of each cell as seen from the apex
+        near = distance <= radius
+        cell_width = np.arcsin(np.minimum(radius / np.maximum(distance, 1e-9),
+            1.0))
+
+        angle = np.arctan2(dy, dx)
+        offset = angle[:, np.newaxis] - directions[np.newaxis, :]
+        offset = np.abs(np.arctan2(np.sin(offset), np.cos(offset))) # (C, W)
+        hit = np.any(offset <= (half_angle + cell_width)[:, np.newaxis], axis=1)
+        return (hit | near) & (distance - radius <= max_range)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+'''
+Tests for the time-indexed control history
+'''
+
+import numpy as np
+import unittest
+
+from control_history import ControlHistory
+from geometry_msgs.msg import Twist
+
+class ControlHistoryTest(unittest.TestCase):
+    def test_segments(self):
+        history = ControlHistory()
+        history.add(1.0, 1.0, 0.0)
+        history.add(3.0, 2.0, .5)
+        # out of order
+        history.add(2.0, 0.0, .1)
+        v, w, dt = history.segments(1.5, 3.5)
+        self.assertEqual(v.tolist(), [1.0, 0.0, 2.0])
+        self.assertEqual(w.tolist(), [0.0, .1, .5])
+        self.assertTrue(np.allclose(dt, [.5, 1.0, .5]))
+
+        # standing still before the first twist
+        v, w, dt = history.segments(0.0, 1.5)
+        self.assertEqual(v.tolist(), [0.0, 1.0])
+        self.assertTrue(np.allclose(dt, [1.0, .5]))
+
+        # an interval inside one twist, and an empty one
+        v, w, dt = history.segments(3.5, 4.0)
+        self.assertEqual(v.tolist(), [2.0])
+        self.assertEqual(len(history.segments(2.0, 2.0)[2]), 0)
+
+    def test_empty(self):
+        v, w, dt = ControlHistory().segments(0.0, 1.0)
+        self.assertEqual(v.tolist(), [0.0])
+        self.assertEqual(dt.tolist(), [1.0])
+
+    def test_bounded(self):
+        history = ControlHistory(capacity=3)
+        twist = Twist()
+        for stamp in range(0, 5):
+            twist.linear.x = stamp
+            history.add_twist(float(stamp), twist)
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history.stamps.tolist(), [2.0, 3.0, 4.0])
+        self.assertEqual(history.v.tolist(), [2.0, 3.0, 4.0])
+
+        # the controls before 2.0 are lost, and that is counted
+        self.assertEqual(history.missing, 0)
+        v, w, dt = history.segments(1.0, 3.0)
+        self.assertEqual(v.tolist(), [0.0, 2.0])
+        self.assertEqual(history.missing, 1)
+        history.segments(2.0, 3.0)
+        self.assertEqual(history.missing, 1)
+
+    def test_prune(self):
+        history = ControlHistory()
+        for stamp in (1.0, 2.0, 3.0):
+            history.add(stamp, stamp, 0.0)
+        history.prune(2.5)
+        # the twist in effect at 2.5 stays
+        self.assertEqual(history.stamps.tolist(), [2.0, 3.0])
+        self.assertEqual(history.segments(2.5, 3.5)[0].tolist(), [2.0, 3.0])
+        # pruned twists were already used, so they aren't missing
+        history.segments(1.0, 2.5)
+        self.assertEqual(history.missing, 0)
+
+if __name__ == '__main__':
+    import rostest
+    rostest.rosrun('crispy_parakeet', 'test_control_history',
+        ControlHistoryTest)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+'''
+Tests for the vectorized correspondence kernel
+'''
+
+import math
+import numpy as np
+import unittest
+
+from correspondence import best_matches, log_gaussian_2d, log_gaussian_3d
+from correspondence import gated_components, log_match_matrix, unique_matches
+from correspondence import stable_matches
+from itertools import permutations
+from scipy.stats import multivariate_normal
+from utils import Pose2D
+
+class CorrespondenceTest(unittest.TestCase):
+    def test_log_gaussian_2d(self):
+        covar = np.array([[[2.0, 0.3], [0.3, 1.0]]])
+        expected = multivariate_normal.logpdf([0.5, -1.0], mean=[0.0, 0.0],
+            cov=covar[0])
+        result = log_gaussian_2d(np.array([0.5]), np.array([-1.0]), covar)
+        self.assertAlmostEqual(result[0], expected)
+
+    def test_log_gaussian_3d(self):
+        covar = np.array([[[2.0, 0.3, 0.1], [0.3, 1.0, -0.2], [0.1, -0.2, 3.0]]])
+        delta = np.array([[1.0, -2.0, 0.5]])
+        expected = multivariate_normal.logpdf(delta[0], mean=[0.0]*3,
+            cov=covar[0])
+        result = log_gaussian_3d(delta, covar)
+        self.assertAlmostEqual(result[0], expected)
+
+    def test_singular_covariance_never_matches(self):
+        result = log_gaussian_3d(np.zeros((1, 3)), np.zeros((1, 3, 3)))
+        self.assertEqual(result[0], -np.inf)
+
+    def test_gates(self):
+        pose = Pose2D(0.0, 0.0, 0.0)
+        means = np.array([[1.0, 0.0, 10.0, 10.0, 10.0]])
+        covars = np.array([np.identity(5)])
+
+        blobs = np.array([[0.0, 10.0, 10.0, 10.0], # match
+                          [math.pi, 10.0, 10.0, 10.0], # bearing
+                          [0.0, 255.0, 10.0, 10.0]]) # color
+        result = log_match_matrix(pose, blobs, means, covars)
+        self.assertTrue(np.isfinite(result[0, 0]))
+        self.assertEqual(result[1, 0], -np.inf)
+        self.assertEqual(result[2, 0], -np.inf)
+
+    def test_best_matches(self):
+        log_matrix = np.array([[-1.0, -2.0],
+                               [-np.inf, -3.0],
+                               [-np.inf, -np.inf]])
+        self.assertEqual(best_matches(log_matrix, [4, -7]), [4, -7, 0])
+        self.assertEqual(best_matches(np.zeros((2, 0)), []), [0, 0])
+
+    def test_stable_matches(self):
+        pose = Pose2D(0.0, 0.0, 0.0)
+        means = np.array([[4.0, 0.0, 10.0, 10.0, 10.0],
+                          [4.0, 1.0, 200.0, 10.0, 10.0],
+                          [4.0, 1.1, 200.0, 10.0, 10.0]])
+        covars = np.array([np.identity(5)]*3)
+        blobs = np.array([[0.0, 10.0, 10.0, 10.0], # clear match
+                          [0.3, 200.0, 10.0, 10.0], # two close features
+                          [0.49, 10.0, 10.0, 10.0]]) # near the bearing gate
+        log_matrix = log_match_matrix(pose, blobs, means, covars)
+        result = stable_matches(pose, blobs, means, log_matrix, .02, .05, 2.0)
+        self.assertEqual(list(result), [True, False, False])
+        # no slack and no margin: nothing can change
+        result = stable_matches(pose, blobs, means, log_matrix, 0.0, 0.0, 0.0)
+        self.assertTrue(np.all(result))
+
+    def test_stable_matches_without_any_match(self):
+        pose = Pose2D(0.0, 0.0, 0.0)
+        means = np.array([[4.0, 0.0, 10.0, 10.0, 10.0],
+                          [4.0, 1.0, 200.0, 10.0, 10.0]])
+        log_matrix = np.full((1, 2), -np.inf)
+        with np.errstate(invalid='raise'):
+            result = stable_matches(pose, np.array([[3.0, 10.0, 200.0, 10.0]]),
+                means, log_matrix, .02, .05, 2.0)
+        self.assertEqual(list(result), [True])
+
+    def test_gated_components(self):
+        log_matrix = np.array([[-1.0, -np.inf, -np.inf, -np.inf],
+                               [-np.inf, -1.0, -np.inf, -2.0],
+                               [-np.inf, -np.inf, -np.inf, -1.0],
+                               [-np.inf, -np.inf, -np.inf, -np.inf]])
+        components = [(list(rows), list(columns))
+            for rows, columns in gated_components(log_matrix)]
+        self.assertEqual(sorted(components), [([0], [0]), ([1, 2], [1, 3])])
+
+    def test_unique_matches(self):
+        # both blobs like feature 4 best, the total is best with 4 -> blob 1
+        log_matrix = np.array([[-1.0, -2.0, -np.inf],
+                               [-1.5, -9.0, -np.inf],
+                               [-np.inf, -np.inf, -np.inf],
+                               [-np.inf, -np.inf, -1.0]])
+        ids = [4, 5, -6]
+        self.assertEqual(best_matches(log_matrix, ids), [4, 4, 0, -6])
+        self.assertEqual(unique_matches(log_matrix, ids), [5, 4, 0, -6])
+
+        # one feature, two blobs
+        log_matrix = np.array([[-3.0], [-1.0]])
+        self.assertEqual(unique_matches(log_matrix, [2]), [0, 2])
+
+    def test_unique_matches_is_optimal(self):
+        generator = np.random.RandomState(2)
+        for _ in range(0, 20):
+            log_matrix = -generator.uniform(0.0, 10.0, (4, 4))
+            log_matrix[generator.uniform(size=(4, 4)) < 0.3] = -np.inf
+            ids = [1, 2, 3, 4]
+            result = unique_matches(log_matrix, ids)
+            matched = [id_ for id_ in result if id_ != 0]
+            self.assertEqual(len(matched), len(set(matched)))
+
+            def score(assignment):
+                values = [log_matrix[row, column]
+                    for row, column in enumerate(assignment)
+                    if column is not None]
+                return (sum(np.isfinite(values)),
+                    sum(value for value in values if np.isfinite(value)))
+            best = max(score(perm) for perm in permutations(range(0, 4)))
+            chosen = [ids.index(id_) if id_ != 0 else None for id_ in result]
+            self.assertEqual(score(chosen)[0], best[0])
+            self.assertAlmostEqual(score(chosen)[1], best[1])
+
+if __name__ == '__main__':
+    import rostest
+    rostest.rosrun('crispy_parakeet', 'test_correspondence', CorrespondenceTest)
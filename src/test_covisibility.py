@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+'''
+Tests for the co-visibility graph
+'''
+
+import unittest
+
+from covisibility import CovisibilityGraph
+
+class CovisibilityGraphTest(unittest.TestCase):
+    def test_observe_counts_edges(self):
+        graph = CovisibilityGraph()
+        graph.observe([1, 2, 3])
+        graph.observe([2, 3])
+        self.assertEqual(len(graph), 3)
+        self.assertEqual(graph.weight(2, 3), 2)
+        self.assertEqual(graph.weight(3, 2), 2)
+        self.assertEqual(graph.weight(1, 2), 1)
+        self.assertEqual(graph.weight(1, 4), 0)
+
+    def test_remove(self):
+        graph = CovisibilityGraph()
+        graph.observe([1, 2, 3])
+        graph.remove(2)
+        graph.remove(2)
+        self.assertFalse(2 in graph)
+        self.assertEqual(graph.neighbors(1), {3: 1})
+
+    def test_fork_is_independent(self):
+        parent = CovisibilityGraph()
+        parent.observe([1, 2])
+        child = parent.fork()
+        child.observe([1, 2, 3])
+        parent.remove(1)
+        self.assertEqual(child.weight(1, 2), 2)
+        self.assertEqual(parent.weight(2, 1), 0)
+        self.assertFalse(3 in parent)
+
+    def test_expand_is_bounded(self):
+        graph = CovisibilityGraph()
+        # a chain 1 - 2 - ... - 10, plus a strong edge 1 - 20
+        for id_ in range(1, 10):
+            graph.observe([id_, id_ + 1])
+        graph.observe([1, 20])
+        graph.observe([1, 20])
+        self.assertEqual(graph.expand([1], 100, max_depth=2), set([1, 2, 3, 20]))
+        self.assertEqual(graph.expand([1], 2), set([1, 20]))
+        self.assertEqual(graph.expand([5], 100, max_depth=0), set([5]))
+
+if __name__ == '__main__':
+    import rostest
+    rostest.rosrun('crispy_parakeet', 'test_covisibility', CovisibilityGraphTest)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+'''
+Tests for the distributed shards, with local processes standing in for the
+nodes
+'''
+
+import multiprocessing
+import numpy as np
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from distributed import connect, DistributedShards, serve_node
+from prkt_core_v2 import scan_likelihood
+from sharding import plan_shards
+from test_sharding import make_scan, make_store, QT
+
+AUTHKEY = b'crispy parakeet'
+
+def free_port():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+class DistributedTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # one node over a Unix socket and one over TCP
+        self.addresses = [os.path.join(self.directory, 'shard0'),
+            ('127.0.0.1', free_port())]
+        self.nodes = []
+        for address in self.addresses:
+            node = multiprocessing.Process(target=serve_node, args=(address,
+                scan_likelihood, AUTHKEY))
+            node.daemon = True
+            node.start()
+            self.nodes.append(node)
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.join(5.0)
+            if node.is_alive():
+                node.terminate()
+        shutil.rmtree(self.directory)
+
+    def test_observe_and_resample(self):
+        store = make_store(6)
+        particles = [store.maps[i].fork() for i in range(0, 6)]
+        for i, particle in enumerate(particles):
+            particle.state = store.state(i)
+        expected = scan_likelihood(particles, make_scan(), 1, QT)
+
+        shards = DistributedShards(store, self.addresses, AUTHKEY, slack=0.0)
+        try:
+            self.assertEqual([slot.shard for slot in store.maps],
+                [0, 0, 0, 1, 1, 1])
+            result = shards.observe(store, make_scan(), 1, QT)
+            self.assertTrue(np.allclose(result, expected))
+
+            # every new particle comes from shard 0, so one parent moves
+            indices = np.array([1, 1, 1, 1, 2, 2])
+            slots = shards.select(store.maps, indices)
+            store.select(indices)
+            store.maps = slots
+            self.assertEqual(shards.moved, 1)
+            self.assertEqual(sorted(slot.shard for slot in slots),
+                [0, 0, 0, 1, 1, 1])
+            result = shards.observe(store, make_scan(), 1, QT)
+            self.assertTrue(np.all(np.isfinite(result)))
+        finally:
+            shards.close(store)
+        self.assertEqual(len(store.maps), 6)
+        self.assertEqual(store.maps[5].get_feature_by_id(2).update_count, 4)
+        self.assertIsNot(store.maps[0], store.maps[5])
+
+class AuthenticationTest(unittest.TestCase):
+    def test_wrong_key_is_rejected(self):
+        address = ('127.0.0.1', free_port())
+        node = multiprocessing.Process(target=serve_node, args=(address,
+            scan_likelihood, AUTHKEY))
+        node.daemon = True
+        node.start()
+        try:
+            self.assertRaises(multiprocessing.AuthenticationError, connect,
+                address, b'not the key')
+            # the node gives up on the connection without running anything
+            node.join(5.0)
+            self.assertFalse(node.is_alive())
+        finally:
+            if node.is_alive():
+                node.terminate()
+
+    def test_key_is_required(self):
+        address = ('127.0.0.1', free_port())
+        self.assertRaises(ValueError, serve_node, address, scan_likelihood,
+            None)
+        self.assertRaises(ValueError, connect, address, None)
+        self.assertRaises(ValueError, DistributedShards, make_store(2),
+            [address], None)
+
+class PlanShardsTest(unittest.TestCase):
+    def test_keeps_balanced_shards(self):
+        owners = [0, 0, 1, 1]
+        indices = np.array([0, 1, 2, 3])
+        self.assertEqual(plan_shards(owners, indices, 2).tolist(),
+            [0, 0, 1, 1])
+
+    def test_moves_overflow(self):
+        owners = [0, 0, 1, 1]
+        indices = np.array([0, 0, 0, 1, 1, 1])
+        new_owners = plan_shards(owners, indices, 2)
+        self.assertEqual(sorted(new_owners.tolist()), [0, 0, 0, 1, 1, 1])
+        # the copies that moved all come from one parent
+        self.assertEqual(len(set(indices[new_owners == 1].tolist())), 1)
+
+    def test_slack(self):
+        owners = [0, 1]
+        indices = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 1])
+        # 6 is within 20% of an even share of 5, so nothing moves
+        self.assertEqual(plan_shards(owners, indices, 2, .2).tolist(),
+            [0]*6 + [1]*4)
+        self.assertEqual(sorted(plan_shards(owners, indices, 2).tolist()),
+            [0]*5 + [1]*5)
+
+if __name__ == '__main__':
+    import rostest
+    rostest.rosrun('crispy_parakeet', 'test_distributed', DistributedTest)
+    rostest.rosrun('crispy_parakeet', 'test_distributed_authentication',
+        AuthenticationTest)
+    rostest.rosrun('crispy_parakeet', 'test_plan_shards', PlanShardsTest)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+'''
+Tests for the batched EKF against the per-feature FilterParticle methods
+'''
+
+import numpy as np
+import unittest
+
+from ekf import ekf_update, inverse_3x3, sparse_ekf_update, sqrt_ekf_update
+from matrix import cholesky_rank_one_update, forward_substitute, inverse
+from matrix import psd_cholesky
+from prkt_core_v2 import FilterParticle, Feature, observe_scan
+from utils import Pose2D
+from viz_feature_sim.msg import Blob
+
+QT = np.identity(4)*.1
+
+def random_blob(generator):
+    blob = Blob()
+    blob.bearing = generator.uniform(-3.0, 3.0)
+    blob.color.r, blob.color.g, blob.color.b = generator.uniform(0, 255, 3)
+    return blob
+
+class EkfTest(unittest.TestCase):
+    def test_matches_per_feature_update(self):
+        generator = np.random.RandomState(4)
+        count = 8
+        poses = np.zeros((count, 3))
+        means = np.zeros((count, 5))
+        covars = np.zeros((count, 5, 5))
+        observations = np.zeros((count, 4))
+        expected = []
+        for t in range(0, count):
+            poses[t] = generator.uniform(-2.0, 2.0, 3)
+            means[t, 0:2] = generator.uniform(-5.0, 5.0, 2)
+            means[t, 2:5] = generator.uniform(0, 255, 3)
+            root = generator.uniform(-1.0, 1.0, (5, 5))
+            covars[t] = np.dot(root, root.T) + np.identity(5)
+            blob = random_blob(generator)
+            observations[t] = (blob.bearing, blob.color.r, blob.color.g,
+                blob.color.b)
+
+            particle = FilterParticle(Pose2D(*poses[t]))
+            particle.feature_set[1] = Feature(mean=means[t].copy(),
+                covar=covars[t].copy())
+            pseudoblob = particle.generate_measurement(1)
+            bigH = particle.measurement_jacobian(1)
+            bigQ = particle.measurement_covariance(bigH, 1, QT)
+            bigQinv = inverse(bigQ)
+            bigK = particle.kalman_gain(1, bigH, bigQinv)
+            weight = particle.importance_factor(bigQ, blob, pseudoblob, bigQinv)
+            feature = particle.update_feature(1, bigK, bigH, blob, pseudoblob)
+            expected.append((feature.mean, feature.covar, weight))
+
+        new_means, new_covars, log_weights = ekf_update(poses, means, covars,
+            observations, QT)
+        for t, (mean, covar, weight) in enumerate(expected):
+            self.assertTrue(np.allclose(new_means[t], mean))
+            self.assertTrue(np.allclose(new_covars[t], covar))
+            self.assertAlmostEqual(log_weights[t], weight)
+
+    def test_sparse_matches_dense(self):
+        generator = np.random.RandomState(6)
+        count = 50
+        poses = generator.uniform(-2.0, 2.0, (count, 3))
+        means = np.zeros((count, 5))
+        means[:, 0:2] = generator.uniform(-5.0, 5.0, (count, 2))
+        means[:, 2:5] = generator.uniform(0, 255, (count, 3))
+        # the covariances drift from symmetric in the plain (I - K H) P form
+        roots = generator.uniform(-1.0, 1.0, (count, 5, 5))
+        covars = np.einsum('tij,tkj->tik', roots, roots) + np.identity(5)
+        covars += generator.uniform(-.01, .01, (count, 5, 5))
+        observations = generator.uniform(0, 255, (count, 4))
+        observations[:, 0] = generator.uniform(-3.0, 3.0, count)
+        noise = QT + generator.uniform(0, .01, (4, 4))
+        # a feature right on top of its pose has a zero bearing row
+        means[0, 0:2] = poses[0, 0:2]
+
+        dense = ekf_update(poses, means, covars, observations, noise)
+        sparse = sparse_ekf_update(poses, means, covars, observations, noise)
+        for expected, actual in zip(dense, sparse):
+            self.assertTrue(np.allclose(expected, actual))
+
+    def test_sqrt_matches_sparse(self):
+        generator = np.random.RandomState(8)
+        count = 50
+        poses = generator.uniform(-2.0, 2.0, (count, 3))
+        means = np.zeros((count, 5))
+        means[:, 0:2] = generator.uniform(-5.0, 5.0, (count, 2))
+        means[:, 2:5] = generator.uniform(0, 255, (count, 3))
+        roots = generator.uniform(-1.0, 1.0, (count, 5, 5))
+        covars = np.einsum('tij,tkj->tik', roots, roots) + np.identity(5)
+        observations = generator.uniform(0, 255, (count, 4))
+        observations[:, 0] = generator.uniform(-3.0, 3.0, count)
+
+        sparse = sparse_ekf_update(poses, means, covars, observations, QT)
+        new_means, chols, log_weights = sqrt_ekf_update(poses, means,
+            np.linalg.cholesky(covars), observations, QT)
+        self.assertTrue(np.allclose(new_means, sparse[0]))
+        self.assertTrue(np.allclose(np.einsum('tij,tkj->tik', chols, chols),
+            sparse[1]))
+        self.assertTrue(np.allclose(log_weights, sparse[2]))
+        # the factors stay lower triangular
+        self.assertTrue(np.allclose(np.triu(chols, 1), 0))
+
+    def test_cholesky_rank_one_update(self):
+        generator = np.random.RandomState(2)
+        roots = generator.uniform(-1.0, 1.0, (10, 5, 5))
+        covars = np.einsum('tij,tkj->tik', roots, roots) + np.identity(5)
+        vectors = generator.uniform(-.5, .5, (10, 5))
+        outer = np.einsum('ti,tj->tij', vectors, vectors)
+
+        lower, ok = cholesky_rank_one_update(np.linalg.cholesky(covars),
+            vectors)
+        self.assertTrue(np.all(ok))
+        self.assertTrue(np.allclose(lower, np.linalg.cholesky(covars + outer)))
+
+        lower, ok = cholesky_rank_one_update(np.linalg.cholesky(covars + outer),
+            vectors, -1.0)
+        self.assertTrue(np.all(ok))
+        self.assertTrue(np.allclose(lower, np.linalg.cholesky(covars)))
+
+        # a downdate that would leave the matrix indefinite is flagged
+        _, ok = cholesky_rank_one_update(np.linalg.cholesky(covars[0:1]),
+            vectors[0:1]*100, -1.0)
+        self.assertFalse(ok[0])
+
+    def test_forward_substitute(self):
+        generator = np.random.RandomState(3)
+        lower = np.tril(generator.uniform(-1.0, 1.0, (6, 4, 4)))
+        lower += np.identity(4)*4
+        vectors = generator.uniform(-1.0, 1.0, (6, 4))
+        blocks = generator.uniform(-1.0, 1.0, (6, 4, 5))
+        self.assertTrue(np.allclose(forward_substitute(lower, vectors),
+            np.linalg.solve(lower, vectors[:, :, np.newaxis])[:, :, 0]))
+        self.assertTrue(np.allclose(forward_substitute(lower, blocks),
+            np.linalg.solve(lower, blocks)))
+
+    def test_psd_cholesky(self):
+        root = np.random.RandomState(5).uniform(-1.0, 1.0, (5, 5))
+        covar = np.dot(root, root.T) + np.identity(5)
+        self.assertTrue(np.allclose(psd_cholesky(covar),
+            np.linalg.cholesky(covar)))
+        # a singular matrix is floored instead of raising
+        singular = np.zeros((5, 5))
+        singular[0, 0] = 1.0
+        lower = psd_cholesky(singular)
+        self.assertTrue(np.all(np.isfinite(lower)))
+        self.assertTrue(np.allclose(np.dot(lower, lower.T), singular))
+
+    def test_inverse_3x3(self):
+        generator = np.random.RandomState(1)
+        matrices = generator.uniform(-1.0, 1.0, (10, 3, 3))
+        inverses, det = inverse_3x3(matrices)
+        self.assertTrue(np.allclose(inverses, np.linalg.inv(matrices)))
+        self.assertTrue(np.allclose(det, np.linalg.det(matrices)))
+
+    def test_empty(self):
+        new_means, new_covars, log_weights = ekf_update(np.zeros((0, 3)),
+            np.zeros((0, 5)), np.zeros((0, 5, 5)), np.zeros((0, 4)), QT)
+        self.assertEqual(new_means.shape, (0, 5))
+        self.assertEqual(log_weights.shape, (0,))
+
+    def test_observe_scan(self):
+        generator = np.random.RandomState(9)
+        parent = FilterParticle()
+        parent.feature_set[1] = Feature(mean=np.array([2.0, 0, 10, 10, 10]))
+        potential = Feature(mean=np.array([0, 2.0, 200, 10, 10]))
+        potential.update_count = 4
+        parent.potential_features[-2] = potential
+        particles = [parent, parent.fork()]
+
+        blobs = [random_blob(generator) for _ in range(0, 3)]
+        correspondences = [[(1, blobs[0]), (-2, blobs[1])],
+            [(1, blobs[0]), (1, blobs[1])]]
+        lonely = FilterParticle()
+        particles.append(lonely)
+        correspondences.append([(0, blobs[2])])
+        result = observe_scan(particles, correspondences, QT)
+
+        # the feature matched twice was updated twice
+        self.assertEqual(particles[0].get_feature_by_id(1).update_count, 2)
+        self.assertEqual(particles[1].get_feature_by_id(1).update_count, 4)
+        # and the particles don't share the updates
+        self.assertIsNot(particles[0].get_feature_by_id(1),
+            particles[1].get_feature_by_id(1))
+        # the potential feature was promoted
+        self.assertTrue(2 in particles[0].feature_set)
+        self.assertFalse(-2 in particles[0].potential_features)
+        self.assertTrue(-2 in particles[1].potential_features)
+        self.assertEqual(len(lonely.hypothesis_set), 1)
+        self.assertAlmostEqual(result[2], lonely.no_match_weight())
+        self.assertEqual(result.shape, (3,))
+        self.assertTrue(np.all(np.isfinite(result)))
+
+    def test_observe_scan_sqrt(self):
+        generator = np.random.RandomState(9)
+        particles = []
+        for _ in range(0, 2):
+            particle = FilterParticle(Pose2D(.5, -.5, .2))
+            particle.feature_set[1] = Feature(mean=np.array(
+                [2.0, 1.0, 100.0, 50.0, 25.0]), covar=np.identity(5))
+            particles.append(particle)
+        blob = random_blob(generator)
+        plain = observe_scan(particles[0:1], [[(1, blob)]], QT)
+        sqrt = observe_scan(particles[1:2], [[(1, blob)]], QT, sqrt=True)
+
+        self.assertTrue(np.allclose(plain, sqrt))
+        expected = particles[0].get_feature_by_id(1)
+        feature = particles[1].get_feature_by_id(1)
+        self.assertTrue(np.allclose(feature.mean, expected.mean))
+        self.assertTrue(np.allclose(feature.covar, expected.covar))
+        self.assertTrue(np.allclose(np.dot(feature.covar_sqrt(),
+            feature.covar_sqrt().T), feature.covar))
+
+if __name__ == '__main__':
+    import rostest
+    rostest.rosrun('crispy_parakeet', 'test_ekf', EkfTest)
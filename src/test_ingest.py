@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+'''
+Tests for the timestamped ingest queue and its worker
+'''
+
+import threading
+import unittest
+
+from ingest import IngestQueue, IngestWorker, message_stamp, SCAN, TWIST
+from ingest import scan_identity, ScanTracker
+from geometry_msgs.msg import Twist
+from viz_feature_sim.msg import Blob, VizScan
+
+import rospy
+
+class IngestQueueTest(unittest.TestCase):
+    def test_stamp_order(self):
+        queue = IngestQueue()
+        queue.put_twist('b', 2.0)
+        queue.put_scan('c', 3.0)
+        queue.put_twist('a', 1.0)
+        # same stamp: arrival order
+        queue.put_scan('d', 3.0)
+        batch = queue.get_batch(0.0)
+        self.assertEqual([message for _, _, message in batch],
+            ['a', 'b', 'c', 'd'])
+        self.assertEqual(batch[2][0:2], (3.0, SCAN))
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.get_batch(0.0), [])
+
+    def test_drops_oldest_scan(self):
+        queue = IngestQueue(max_scans=2)
+        queue.put_scan('late', 2.0)
+        queue.put_scan('early', 1.0)
+        queue.put_twist('twist', 0.5)
+        queue.put_scan('new', 3.0)
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual([message for _, _, message in queue.get_batch(0.0)],
+            ['twist', 'late', 'new'])
+
+    def test_close(self):
+        queue = IngestQueue()
+        queue.put_scan('scan', 1.0)
+        queue.close()
+        self.assertEqual(len(queue.get_batch()), 1)
+        self.assertIsNone(queue.get_batch())
+
+    def test_message_stamp(self):
+        scan = VizScan()
+        scan.header.stamp = rospy.Time(5, 500000000)
+        self.assertAlmostEqual(message_stamp(scan), 5.5)
+        self.assertTrue(message_stamp(Twist()) > 0.0)
+
+    def test_worker(self):
+        queue = IngestQueue()
+        seen = []
+        threads = set()
+        def handler(message, stamp):
+            seen.append((stamp, message))
+            threads.add(threading.current_thread().name)
+        worker = IngestWorker(queue, {SCAN: handler, TWIST: handler})
+        worker.start()
+        for stamp in (1.0, 2.0, 3.0):
+            queue.put_scan('scan %d' % stamp, stamp)
+        queue.close()
+        worker.join(5.0)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual([stamp for stamp, _ in seen], [1.0, 2.0, 3.0])
+        self.assertEqual(threads, set(['ingest']))
+
+class ScanTrackerTest(unittest.TestCase):
+    def test_header_identity(self):
+        tracker = ScanTracker()
+        scans = []
+        for seq in (1, 2, 5, 3):
+            scan = VizScan()
+            scan.header.seq = seq
+            scans.append(scan)
+        self.assertTrue(tracker.accept(scans[0]))
+        self.assertFalse(tracker.accept(scans[0]))
+        self.assertTrue(tracker.accept(scans[1]))
+        # 3 and 4 are missing
+        self.assertTrue(tracker.accept(scans[2]))
+        self.assertEqual(tracker.dropped, 2)
+        # 3 arrives late
+        self.assertTrue(tracker.accept(scans[3]))
+        self.assertEqual(tracker.counters(),
+            {'processed': 4, 'duplicate': 1, 'dropped': 1})
+
+    def test_content_identity(self):
+        first = VizScan()
+        blob = Blob()
+        blob.bearing = .5
+        first.observes = [blob]
+        second = VizScan()
+        second.observes = [blob]
+        self.assertEqual(scan_identity(first), scan_identity(second))
+        stamped = VizScan()
+        stamped.observes = [blob]
+        stamped.header.stamp = rospy.Time(1)
+        self.assertNotEqual(scan_identity(first), scan_identity(stamped))
+
+        tracker = ScanTracker(memory=1)
+        self.assertTrue(tracker.accept(first))
+        self.assertFalse(tracker.accept(second))
+        self.assertTrue(tracker.accept(stamped))
+        # only the last scan is remembered
+        self.assertTrue(tracker.accept(first))
+
+if __name__ == '__main__':
+    import rostest
+    rostest.rosrun('crispy_parakeet', 'test_ingest', IngestQueueTest)
+    rostest.rosrun('crispy_parakeet', 'test_scan_tracker', ScanTrackerTest)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+'''
+Tests for the KLD-sampling particle count
+'''
+
+import numpy as np
+import unittest
+
+from kld import histogram_bins, kld_particle_count, kld_sample_size
+
+class KldTest(unittest.TestCase):
+    def test_sample_size_grows_with_bins(self):
+        sizes = kld_sample_size(np.array([1, 2, 10, 100]))
+        self.assertEqual(sizes[0], 0.0)
+        self.assertTrue(sizes[1] < sizes[2])
+        self.assertTrue(sizes[2] < sizes[3])
+
+    def test_histogram_bins_wrap_heading(self):
+        bins = histogram_bins(np.array([0.1, 0.1]), np.array([-0.1, -0.1]),
+            np.array([0.05, 0.05 + 2*np.pi]), (1.0, 1.0, .5))
+        self.assertEqual(list(bins[0]), [0, -1, 0])
+        self.assertEqual(list(bins[0]), list(bins[1]))
+
+    def test_localized_shrinks_to_min(self):
+        count = 500
+        same = np.zeros(count)
+        result = kld_particle_count(same, same, same, np.ones(count), 7, 1000)
+        self.assertEqual(result, 7)
+
+    def test_spread_grows(self):
+        count = 500
+        spread = np.linspace(-10.0, 10.0, count)
+        result = kld_particle_count(spread, spread, spread, np.ones(count), 7,
+            1000)
+        self.assertTrue(result > 100)
+        self.assertTrue(result <= 1000)
+
+if __name__ == '__main__':
+    import rostest
+    rostest.rosrun('crispy_parakeet', 'test_kld', KldTest)
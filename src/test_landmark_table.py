@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+'''
+Tests for the packed landmark table
+'''
+
+import numpy as np
+import unittest
+
+from landmark_table import LandmarkTable, PAGE_ROWS
+from prkt_core_v2 import FilterParticle, Feature, FeatureView, observe_scan
+from spatial_index import GridIndex
+from utils import Pose2D
+from viz_feature_sim.msg import Blob
+
+def feature_at(x, y, r=10, g=10, b=10):
+    return Feature(mean=np.array([x, y, r, g, b], dtype=float))
+
+class LandmarkTableTest(unittest.TestCase):
+    def test_dict_behavior(self):
+        table = LandmarkTable(FeatureView)
+        for id_ in range(1, 6):
+            table[id_] = feature_at(id_, 0)
+        self.assertEqual(len(table), 5)
+        self.assertEqual(list(table), [1, 2, 3, 4, 5])
+        self.assertEqual(table[3].mean[0], 3.0)
+        del table[2]
+        self.assertFalse(2 in table)
+        self.assertRaises(KeyError, lambda: table[2])
+        # the freed row is reused
+        table[6] = feature_at(6, 0)
+        self.assertEqual(table[6].row, 1)
+        ids, means, covars, _, _ = table.arrays()
+        self.assertEqual(ids, [1, 6, 3, 4, 5])
+        self.assertEqual(list(means[:, 0]), [1, 6, 3, 4, 5])
+        self.assertEqual(covars.shape, (5, 5, 5))
+
+    def test_views_write_through(self):
+        table = LandmarkTable(FeatureView)
+        table[1] = feature_at(1, 0)
+        view = table.mutable(1)
+        inverses, _ = view.match_terms()
+        self.assertTrue(np.allclose(inverses, np.identity(5)))
+
+        bigK = np.zeros((5, 4))
+        bigK[0, 0] = 0.5
+        bigH = np.zeros((4, 5))
+        bigH[0, 0] = 1.0
+        view.update_covar(bigK, bigH)
+        self.assertEqual(table[1].covar[0, 0], 0.5)
+        self.assertEqual(table[1].update_count, 1)
+        # the cached inverse follows the covariance, in the views and in the
+        #   packed arrays
+        self.assertEqual(table[1].match_terms()[0][0, 0], 2.0)
+        self.assertEqual(table.arrays()[3][0, 0, 0], 2.0)
+
+    def test_fork_is_independent(self):
+        parent = LandmarkTable(FeatureView, index=GridIndex())
+        parent[1] = feature_at(1, 0)
+        parent[2] = feature_at(2, 0)
+        child = parent.fork()
+        self.assertEqual(child.version, parent.version)
+        child.mutable(1).mean = np.array([5.0, 5.0, 0, 0, 0])
+        child.reindex(1)
+        del child[2]
+        parent[3] = feature_at(3, 0)
+        self.assertNotEqual(child.version, parent.version)
+        self.assertEqual(parent[1].mean[0], 1.0)
+        self.assertEqual(child[1].mean[0], 5.0)
+        self.assertEqual(sorted(parent), [1, 2, 3])
+        self.assertEqual(sorted(child), [1])
+        self.assertTrue(2 in parent.position_index)
+        self.assertFalse(2 in child.position_index)
+
+    def test_fork_copies_only_written_pages(self):
+        parent = LandmarkTable(FeatureView)
+        for id_ in range(1, 4*PAGE_ROWS + 1):
+            parent[id_] = feature_at(id_, 0)
+        child = parent.fork()
+        child.mutable(1).mean = np.array([5.0, 5.0, 0, 0, 0])
+        written = child[1].row
+        untouched = child[3*PAGE_ROWS].row
+        self.assertIsNot(child.page(written)[0], parent.page(written)[0])
+        self.assertIs(child.page(untouched)[0], parent.page(untouched)[0])
+        self.assertEqual(parent[1].mean[0], 1.0)
+        # a new feature goes into a new page, not into a shared one
+        child[10**4] = feature_at(0, 0)
+        self.assertIs(child.page(untouched)[0], parent.page(untouched)[0])
+        self.assertFalse(10**4 in parent)
+        self.assertEqual(len(list(parent)), 4*PAGE_ROWS)
+
+    def test_immutable(self):
+        table = LandmarkTable(FeatureView)
+        feature = feature_at(1, 0)
+        feature.__immutable__ = True
+        table[1] = feature
+        view = table.mutable(1)
+        self.assertTrue(view.__immutable__)
+        view.set_estimate(np.zeros(5), np.identity(5))
+        self.assertEqual(table[1].mean[0], 1.0)
+        self.assertTrue(table[1].copy().__immutable__)
+
+    def test_packed_particle_matches_map_particle(self):
+        generator = np.random.RandomState(8)
+        results = []
+        for packed in (False, True):
+            parent = FilterParticle(Pose2D(0.2, 0.1, 0.05), packed=packed)
+            for id_ in range(1, 40):
+                x, y = generator.uniform(-6.0, 6.0, 2)
+                parent.feature_set[id_] = feature_at(x, y, *((id_ % 3)*90,
+                    10, 10))
+            potential = feature_at(1.0, 1.0, 200, 200, 200)
+            potential.update_count = 4
+            parent.potential_features[-50] = potential
+            particles = [parent, parent.fork()]
+
+            blobs = []
+            for bearing in (-1.0, 0.0, 0.8):
+                blob = Blob()
+                blob.bearing = bearing
+                blob.color.r = 90
+                blob.color.g = 10
+                blob.color.b = 10
+                blobs.append(blob)
+            blob = Blob()
+            blob.bearing = 0.75
+            blob.color.r = blob.color.g = blob.color.b = 200
+            blobs.append(blob)
+
+            correspondences = []
+            for particle in particles:
+                ids, log_matrix = particle.log_match_matrix(blobs)
+                correspondences.append([(ids[int(np.argmax(row))], blob)
+                    for row, blob in zip(log_matrix, blobs)
+                    if np.isfinite(np.max(row))])
+            weights = observe_scan(particles[0:1], correspondences[0:1],
+                np.identity(4)*.1)
+            results.append((correspondences[0], weights,
+                sorted((id_, tuple(particles[0].feature_set[id_].mean))
+                    for id_ in particles[0].feature_set),
+                sorted(particles[1].feature_set)))
+            generator = np.random.RandomState(8)
+
+        unpacked, packed = results
+        self.assertEqual([pair[0] for pair in unpacked[0]],
+            [pair[0] for pair in packed[0]])
+        self.assertTrue(np.allclose(unpacked[1], packed[1]))
+        self.assertEqual(unpacked[3], packed[3])
+        # the potential feature was matched and promoted
+        self.assertEqual(packed[2][-1][0], 50)
+        for (id_a, mean_a), (id_b, mean_b) in zip(unpacked[2], packed[2]):
+            self.assertEqual(id_a, id_b)
+            self.assertTrue(np.allclose(mean_a, mean_b))
+
+if __name__ == '__main__':
+    import rostest
+    rostest.rosrun('crispy_parakeet', 'test_landmark_table', LandmarkTableTest)
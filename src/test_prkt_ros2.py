@@ -6,18 +6,37 @@ It might make sense to just do testing in the same folder
 import rospy
 
 import sys
+import time
 sys.path.append('/home/buck/ros_workspace/src')
 
 import math
 import numpy as np
 import unittest
 
+from correspondence import COLOR_GATE
 from geometry_msgs.msg import Twist
+from landmark_map import LandmarkMap
+from motion import sample_motion, sample_motion_path
 from nav_msgs.msg import Odometry
+from particle_store import ParticleStore
 from prkt_core_v2 import FastSLAM, FilterParticle, Feature
 from prkt_ros import CamSlam360
-from utils import heading_to_quaternion
-from viz_feature_sim.msg import Blob
+from spatial_index import GridIndex
+from utils import heading_to_quaternion, headings_to_quaternions
+from utils import pose_of, Pose2D, quaternions_to_headings
+from viz_feature_sim.msg import Blob, VizScan
+
+class CountingMap(LandmarkMap):
+    '''
+    LandmarkMap that counts the Features read from it
+    '''
+    def __init__(self, *args, **kwargs):
+        self.reads = 0
+        LandmarkMap.__init__(self, *args, **kwargs)
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return LandmarkMap.__getitem__(self, key)
 
 class RosFunctionalityTest(unittest.TestCase):
     def test(self):
@@ -33,6 +52,50 @@ class RosFunctionalityTest(unittest.TestCase):
         self.assertIsInstance(cs.cam_sub, rospy.Subscriber)
         self.assertIsInstance(cs.twist_sub, rospy.Subscriber)
 
+    def test_ingest(self):
+        cs = CamSlam360()
+        processed = []
+        cam_cb = cs.core.cam_cb
+        def record(view, stamp=None):
+            processed.append(view.last_sensor_reading)
+            cam_cb(view, stamp)
+        cs.core.cam_cb = record
+
+        scans = [VizScan(), VizScan()]
+        scans[0].header.stamp = rospy.Time(1)
+        scans[1].header.stamp = rospy.Time(2)
+        # the callbacks only queue the messages
+        cs.measurement_update(scans[1])
+        cs.measurement_update(scans[0])
+        cs.motion_update(Twist())
+        self.assertEqual(processed, [])
+        self.assertIsNone(cs.last_sensor_reading)
+
+        cs.start_worker()
+        cs.stop_worker()
+        self.assertEqual(processed, scans)
+        self.assertIs(cs.last_sensor_reading, scans[1])
+
+    def test_ingest_stamps_motion(self):
+        cs = CamSlam360()
+        start = rospy.Time.now().to_sec()
+        x = np.mean(cs.core.store.x)
+        # an unstamped scan, then a twist: the particles only move through
+        #   the twist after the scan, up to the second scan
+        cs.measurement_update(VizScan())
+        twist = Twist()
+        twist.linear.x = 1.0
+        cs.motion_update(twist)
+        time.sleep(.2)
+        scan = VizScan()
+        scan.header.stamp = rospy.Time.from_sec(start + 1.0)
+        cs.measurement_update(scan)
+
+        cs.start_worker()
+        cs.stop_worker()
+        self.assertAlmostEqual(cs.core.last_update.to_sec(), start + 1.0, 5)
+        self.assertTrue(abs(np.mean(cs.core.store.x) - x - 1.0) < .05)
+
 class prktFastSLAMTest(unittest.TestCase):
     # it will be very hard to test the methods in the FastSLAM class alone
     #   because they don't return any values and/or they involve random noise
@@ -45,15 +108,14 @@ class prktFastSLAMTest(unittest.TestCase):
 
     def test_motion_model(self):
         fs = FastSLAM()
-        fpold = FilterParticle()
-        fpold.state.pose.pose.position.y = 2.0
+        fpold = FilterParticle(Pose2D(0.0, 2.0, 0.0))
         twist = Twist()
         twist.linear.x = 1
         dt = rospy.Duration.from_sec(.1)
         fpnew = fs.motion_model(fpold, twist, dt)
 
         dy_expected = twist.linear.x * dt.secs
-        dy_measured = fpnew.state.pose.pose.position.y - fpold.state.pose.pose.position.y
+        dy_measured = fpnew.state.y - fpold.state.y
 
         error = abs(dy_measured - dy_expected)
         self.assertTrue(error < .01)
@@ -63,22 +125,204 @@ class prktFastSLAMTest(unittest.TestCase):
         fpnew = fs.motion_model(fpold, twist, dt)
 
         dy_expected = twist.linear.x * dt.secs
-        dy_measured = fpnew.state.pose.pose.position.y - fpold.state.pose.pose.position.y
+        dy_measured = fpnew.state.y - fpold.state.y
 
         error = abs(dy_measured - dy_expected)
         self.assertTrue(error < .02)
 
+    def test_priors_are_shared(self):
+        presets = [Feature(mean=np.array([1, 0, 10, 10, 10])),
+            Feature(mean=np.array([0, 1, 200, 10, 10]))]
+        fs = FastSLAM(presets)
+        first = fs.store.maps[0]
+        for particle in fs.store.maps:
+            self.assertIs(particle.priors, first.priors)
+            self.assertEqual(len(particle.feature_set), 0)
+            self.assertEqual(particle.next_id, 3)
+        self.assertIs(first.get_feature_by_id(2), presets[1])
+        self.assertTrue(presets[0].__immutable__)
+
+        # a prior can be matched and "updated" but never changes
+        first.set_feature_estimate(1, np.zeros(5), np.identity(5))
+        self.assertEqual(first.get_feature_by_id(1).mean[0], 1)
+
+        near = Blob()
+        near.color.r = 10
+        near.color.g = 10
+        near.color.b = 10
+        scan = VizScan()
+        scan.observes = [near]
+        result = first.match_features_to_scan(scan)
+        self.assertEqual(result[0][0], 1)
+
+    def test_shared_correspondence(self):
+        fs = FastSLAM([Feature(mean=np.array([1, 0, 10, 10, 10])),
+            Feature(mean=np.array([0, 1, 200, 10, 10]))])
+        first = fs.store.maps[0]
+        first.feature_set[5] = Feature(mean=np.array([0, 3, 10, 200, 10]))
+        fs.store.maps = [first] + [first.fork()
+            for _ in range(1, fs.num_particles)]
+        fs.store.x[:] = 0.0
+        fs.store.y[:] = 0.0
+        fs.store.heading[:] = 0.0
+        near = Blob()
+        near.color.r = 10
+        near.color.g = 10
+        near.color.b = 10
+        scan = VizScan()
+        scan.observes = [near]
+
+        # one particle somewhere else, one with a new feature that the blob
+        #   could match
+        fs.store.x[1] = 3.0
+        fs.store.maps[2].feature_set[3] = Feature()
+        # an update to a feature the blob can't match doesn't split the
+        #   cluster
+        for particle in fs.store.maps:
+            particle.spatial_index_min = 1
+        moved = fs.store.maps[4].feature_set.mutable(5)
+        moved.mean = np.array([0, 4, 10, 200, 10])
+        clusters = fs.association_clusters(scan.observes)
+        self.assertEqual(sorted(len(members) for members in clusters),
+            [1, 1, fs.num_particles - 2])
+
+        shared = fs.shared_correspondence(scan)
+        self.assertEqual(len(shared), fs.num_particles - 2)
+        self.assertFalse(1 in shared)
+        self.assertEqual(shared[0][0][0], 1)
+        self.assertIs(shared[0], shared[3])
+        self.assertEqual(fs.store.maps[3].last_matches, [1])
+
+        # the blob is right at the edge of the bearing gate
+        near.bearing = 0.5
+        self.assertEqual(fs.shared_correspondence(scan), {})
+
+    def test_shards(self):
+        fs = FastSLAM([Feature(mean=np.array([1, 0, 10, 10, 10]))])
+        fs.num_particles = len(fs.store)
+        near = Blob()
+        near.color.r = 10
+        near.color.g = 10
+        near.color.b = 10
+        scan = VizScan()
+        scan.observes = [near]
+
+        class View(object):
+            last_sensor_reading = scan
+
+        fs.start_shards(2)
+        try:
+            fs.resample_threshold = 2.0 # always resample
+            for seq in (1, 2):
+                scan.header.seq = seq
+                fs.cam_cb(View())
+        finally:
+            fs.stop_shards()
+        self.assertIsNone(fs.shard_pool)
+        self.assertEqual(len(fs.particles), fs.num_particles)
+        self.assertEqual(fs.particles[0].last_matches, [1])
+
+    def test_cam_cb_skips_repeated_scans(self):
+        fs = FastSLAM()
+        scan = VizScan()
+        scan.header.seq = 1
+
+        class View(object):
+            last_sensor_reading = scan
+
+        fs.cam_cb(View())
+        fs.cam_cb(View())
+        scan.header.seq = 4
+        fs.cam_cb(View())
+        self.assertEqual(fs.scan_tracker.counters(),
+            {'processed': 2, 'duplicate': 1, 'dropped': 2})
+
+    def test_advance_to(self):
+        fs = FastSLAM()
+        fs.stamped_motion = True
+        start = fs.last_update.to_sec()
+        twist = Twist()
+        twist.linear.x = 1.0
+        fs.record_control(twist, start)
+        twist = Twist()
+        twist.angular.z = 1.0
+        fs.record_control(twist, start + .5)
+
+        scan = VizScan()
+        scan.header.stamp = rospy.Time.from_sec(start + 1.0)
+        fs.advance_for_scan(scan)
+        self.assertAlmostEqual(fs.last_update.to_sec(), start + 1.0, 5)
+        self.assertTrue(abs(np.mean(fs.store.x) - .5) < .05)
+        self.assertTrue(abs(np.mean(fs.store.heading) - .5) < .05)
+
+        # a late scan doesn't move the particles
+        x = fs.store.x.copy()
+        fs.advance_to(start + .8)
+        self.assertTrue(np.all(fs.store.x == x))
+
+class prktMotionTest(unittest.TestCase):
+    def test_sample_motion_path(self):
+        x = np.zeros(20)
+        y = np.zeros(20)
+        heading = np.linspace(0, 1, 20)
+        v = np.array([1.0, 0.0, .5])
+        w = np.array([0.0, .3, -.2])
+        dt = np.array([.1, .2, .3])
+        np.random.seed(3)
+        path = sample_motion_path(x, y, heading, v, w, dt)
+        np.random.seed(3)
+        expected = (x, y, heading)
+        for k in range(0, 3):
+            expected = sample_motion(expected[0], expected[1], expected[2],
+                v[k], w[k], dt[k])
+        for actual, pose in zip(path, expected):
+            self.assertTrue(np.allclose(actual, pose))
+
+        unmoved = sample_motion_path(x, y, heading, [], [], [])
+        self.assertTrue(np.all(unmoved[2] == heading))
+
+    def test_sample_motion_straight(self):
+        x = np.zeros(200)
+        y = np.zeros(200)
+        heading = np.zeros(200)
+        new_x, new_y, new_heading = sample_motion(x, y, heading, 1.0, 0.0, .1)
+        self.assertEqual(new_x.shape, (200,))
+        self.assertTrue(abs(np.mean(new_x) - 0.1) < .01)
+        self.assertTrue(np.max(np.abs(new_y)) < .01)
+        self.assertTrue(abs(np.mean(new_heading)) < .01)
+
+    def test_sample_motion_per_particle(self):
+        x = np.zeros(200)
+        heading = np.zeros(200)
+        heading[100:] = math.pi/2
+        v = np.ones(200)
+        v[100:] = 2.0
+        new_x, new_y, _ = sample_motion(x, x, heading, v, 0.0, 1.0)
+        self.assertTrue(abs(np.mean(new_x[:100]) - 1.0) < .05)
+        self.assertTrue(abs(np.mean(new_y[100:]) - 2.0) < .05)
 
 class prktFilterParticleTest(unittest.TestCase):
     def test_initialization(self):
         particle = FilterParticle()
-        self.assertIsInstance(particle.state, Odometry)
-        self.assertIsInstance(particle.feature_set, dict)
-        self.assertIsInstance(particle.potential_features, dict)
-        self.assertIsInstance(particle.hypothesis_set, dict)
+        self.assertIsInstance(particle.state, Pose2D)
+        self.assertIsInstance(particle.feature_set, LandmarkMap)
+        self.assertIsInstance(particle.potential_features, LandmarkMap)
+        self.assertIsInstance(particle.hypothesis_set, LandmarkMap)
         self.assertEqual(particle.weight, 1)
         self.assertEqual(particle.next_id, 1)
 
+    def test_fork(self):
+        particle = FilterParticle()
+        feature = Feature()
+        particle.feature_set[1] = feature
+        child = particle.fork()
+        self.assertIs(child.get_feature_by_id(1), feature)
+
+        updated = child.mutable_feature(1)
+        self.assertIsNot(updated, feature)
+        self.assertIs(child.mutable_feature(1), updated)
+        self.assertIs(particle.get_feature_by_id(1), feature)
+
     def test_get_feature_by_id(self):
         particle = FilterParticle()
         f0 = Feature()
@@ -123,6 +367,145 @@ class prktFilterParticleTest(unittest.TestCase):
 
         self.assertEqual(result_bearing, 0.0)
 
+    def test_match_features_to_scan(self):
+        particle = FilterParticle()
+        particle.feature_set[1] = Feature(mean=np.array([1, 0, 10, 10, 10]))
+        particle.potential_features[-2] = Feature(
+            mean=np.array([0, 1, 200, 10, 10]))
+
+        near = Blob()
+        near.color.r = 10
+        near.color.g = 10
+        near.color.b = 10
+        left = Blob()
+        left.bearing = math.pi/2
+        left.color.r = 200
+        left.color.g = 10
+        left.color.b = 10
+        nothing = Blob()
+        nothing.bearing = math.pi
+
+        scan = VizScan()
+        scan.observes = [near, left, nothing]
+        result = particle.match_features_to_scan(scan)
+        self.assertEqual([pair[0] for pair in result], [1, -2, 0])
+        self.assertIs(result[1][1], left)
+
+    def test_match_features_to_scan_graph(self):
+        particle = FilterParticle()
+        particle.feature_set[1] = Feature(mean=np.array([1, 0, 10, 10, 10]))
+        particle.feature_set[2] = Feature(mean=np.array([0, 1, 200, 10, 10]))
+        particle.feature_set[3] = Feature(mean=np.array([-1, 0, 10, 200, 10]))
+
+        near = Blob()
+        near.color.r = 10
+        near.color.g = 10
+        near.color.b = 10
+        left = Blob()
+        left.bearing = math.pi/2
+        left.color.r = 200
+        left.color.g = 10
+        left.color.b = 10
+        behind = Blob()
+        behind.bearing = math.pi
+        behind.color.r = 10
+        behind.color.g = 200
+        behind.color.b = 10
+
+        scan = VizScan()
+        scan.observes = [near, left]
+        result = particle.match_features_to_scan(scan, 3)
+        self.assertEqual([pair[0] for pair in result], [1, 2])
+        self.assertEqual(particle.last_matches, [1, 2])
+        self.assertEqual(particle.covisibility.weight(1, 2), 1)
+
+        # 3 isn't connected to 1 or 2, so it comes from the full search
+        scan.observes = [near, behind]
+        result = particle.match_features_to_scan(scan, 3)
+        self.assertEqual([pair[0] for pair in result], [1, 3])
+        self.assertEqual(particle.covisibility.weight(1, 3), 1)
+
+    def test_graph_matches_cost_is_flat(self):
+        near = Blob()
+        near.color.r = near.color.g = near.color.b = 10
+        left = Blob()
+        left.bearing = math.pi/2
+        left.color.r = 200
+        left.color.g = left.color.b = 10
+
+        reads = []
+        for size in (200, 2000):
+            particle = FilterParticle()
+            particle.feature_set = CountingMap(index=GridIndex(),
+                color_index=GridIndex(math.sqrt(COLOR_GATE)))
+            particle.feature_set[1] = Feature(mean=np.array([1.0, 0, 10, 10,
+                10]))
+            particle.feature_set[2] = Feature(mean=np.array([0, 1.0, 200, 10,
+                10]))
+            generator = np.random.RandomState(2)
+            for id_ in range(3, size + 1):
+                x, y = generator.uniform(-50.0, 50.0, 2)
+                particle.feature_set[id_] = Feature(mean=np.array([x, y, 10,
+                    200, 10]))
+            particle.record_matches([1, 2])
+            # a landmark update after the map was last packed
+            particle.feature_set.arrays()
+            particle.feature_set.mutable(1).mean = np.array([1.0, 0.01, 10,
+                10, 10])
+
+            particle.feature_set.reads = 0
+            self.assertEqual(particle.graph_matches([near, left]), [1, 2])
+            reads.append(particle.feature_set.reads)
+        # only the neighborhood of the last matches is read, whatever the size
+        #   of the map
+        self.assertEqual(reads[0], reads[1])
+        self.assertTrue(reads[0] <= 2)
+
+    def test_match_features_to_scan_indexed(self):
+        generator = np.random.RandomState(5)
+        particle = FilterParticle(Pose2D(0.5, -0.5, 0.3))
+        colors = [(10, 10, 10), (200, 10, 10), (10, 200, 10)]
+        for id_ in range(1, 301):
+            x, y = generator.uniform(-15.0, 15.0, 2)
+            r, g, b = colors[id_ % 3]
+            particle.feature_set[id_] = Feature(mean=np.array([x, y, r, g, b]))
+
+        scan = VizScan()
+        for bearing in (-2.0, -0.4, 0.1, 1.3, 3.0):
+            blob = Blob()
+            blob.bearing = bearing
+            blob.color.r = 200
+            blob.color.g = 10
+            blob.color.b = 10
+            scan.observes.append(blob)
+
+        particle.spatial_index_min = 1
+        indexed = particle.match_features_to_scan(scan)
+        # color index only (a third of the map passes the color gate)
+        particle.spatial_index_min = 150
+        by_color = particle.match_features_to_scan(scan)
+        particle.spatial_index_min = 10**6
+        full = particle.match_features_to_scan(scan)
+        self.assertEqual([pair[0] for pair in indexed],
+            [pair[0] for pair in full])
+        self.assertEqual([pair[0] for pair in by_color],
+            [pair[0] for pair in full])
+        self.assertTrue(any(pair[0] != 0 for pair in full))
+
+    def test_max_range(self):
+        particle = FilterParticle(Pose2D(0.0, 0.0, 0.0))
+        particle.feature_set[1] = Feature(mean=np.array([10.0, 0, 200, 10,
+            10]))
+        blob = Blob()
+        blob.color.r = 200
+        blob.color.g = 10
+        blob.color.b = 10
+        _, log_matrix = particle.log_match_matrix([blob])
+        self.assertTrue(np.isfinite(log_matrix[0, 0]))
+        particle.max_range = 5.0
+        _, log_matrix = particle.log_match_matrix([blob])
+        self.assertEqual(log_matrix[0, 0], -np.inf)
+
     def test_prob_position_match(self):
         particle = FilterParticle()
 
@@ -422,6 +805,134 @@ class prktFilterParticleTest(unittest.TestCase):
         self.assertEqual(feature.mean[4], blob.color.b)
         self.assertEqual(blob.bearing, math.pi/4)
 
+class prktParticleStoreTest(unittest.TestCase):
+    def test_initialization(self):
+        store = ParticleStore([FilterParticle(), FilterParticle()])
+        self.assertEqual(len(store), 2)
+        self.assertIsInstance(store.x, np.ndarray)
+        self.assertEqual(store.log_weight.shape, (2,))
+
+    def test_view(self):
+        store = ParticleStore([FilterParticle(), FilterParticle()])
+        store.x[1] = 3.0
+        store.heading[1] = math.pi/2
+        store.log_weight[1] = math.log(0.5)
+        particle = store.view(1)
+        self.assertIs(particle, store.maps[1])
+        self.assertEqual(particle.state, Pose2D(3.0, 0.0, math.pi/2))
+        self.assertAlmostEqual(particle.weight, 0.5)
+
+    def test_select(self):
+        store = ParticleStore([FilterParticle(), FilterParticle()])
+        store.x[:] = [1.0, 2.0]
+        store.log_weight[:] = [float('-inf'), 0.0]
+        old_maps = list(store.maps)
+        store.select(np.array([1, 1]))
+        self.assertEqual(list(store.x), [2.0, 2.0])
+        self.assertEqual(list(store.log_weight), [0.0, 0.0])
+        self.assertIs(store.maps[0], old_maps[1])
+        self.assertIsNot(store.maps[1], old_maps[1])
+
+    def test_odometry(self):
+        store = ParticleStore([FilterParticle(), FilterParticle()])
+        store.y[0] = 2.0
+        store.heading[:] = [math.pi/2, -1.0]
+        messages = store.odometry()
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0].pose.pose.position.y, 2.0)
+        self.assertAlmostEqual(pose_of(messages[0]).heading, math.pi/2)
+        self.assertAlmostEqual(pose_of(messages[1]).heading, -1.0)
+
+    def test_weights_do_not_underflow(self):
+        store = ParticleStore([FilterParticle(), FilterParticle()])
+        store.log_weight[:] = [-2000.0, -2000.0 + math.log(3.0)]
+        weights = store.weights()
+        self.assertAlmostEqual(weights[0], 0.25)
+        self.assertAlmostEqual(weights[1], 0.75)
+
+class prktUtilsTest(unittest.TestCase):
+    def test_pose_of(self):
+        pose = Pose2D(1.0, 2.0, 0.5)
+        self.assertIs(pose_of(pose), pose)
+
+        odom = Odometry()
+        odom.pose.pose.position.x = 1.0
+        odom.pose.pose.orientation = heading_to_quaternion(0.5)
+        self.assertAlmostEqual(pose_of(odom).heading, 0.5)
+        self.assertEqual(pose_of(odom).x, 1.0)
+
+    def test_heading_quaternion_round_trip(self):
+        headings = np.array([0.0, 1.0, -2.0, math.pi - .01])
+        quats = headings_to_quaternions(headings)
+        self.assertEqual(quats.shape, (4, 4))
+        result = quaternions_to_headings(quats)
+        for expected, actual in zip(headings, result):
+            self.assertAlmostEqual(expected, actual)
+
+class prktLandmarkMapTest(unittest.TestCase):
+    def test_dict_behavior(self):
+        landmarks = LandmarkMap({1: 'a', 2: 'b'})
+        self.assertEqual(len(landmarks), 2)
+        landmarks[3] = 'c'
+        del landmarks[1]
+        self.assertEqual(sorted(landmarks.items()), [(2, 'b'), (3, 'c')])
+        self.assertFalse(1 in landmarks)
+        self.assertRaises(KeyError, lambda: landmarks[1])
+
+    def test_fork_is_independent(self):
+        parent = LandmarkMap(dict((i, Feature()) for i in range(0, 20)))
+        child = parent.fork()
+        del child[0]
+        child[20] = Feature()
+        parent[21] = Feature()
+        self.assertEqual(len(parent), 21)
+        self.assertEqual(len(child), 20)
+        self.assertTrue(0 in parent)
+        self.assertFalse(20 in parent)
+        self.assertFalse(21 in child)
+        self.assertIs(parent[5], child[5])
+
+    def test_position_index_follows_features(self):
+        parent = LandmarkMap(index=GridIndex(1.0))
+        parent[1] = Feature(mean=np.array([0.5, 0.5, 0, 0, 0]))
+        parent[2] = ('not', 'a feature')
+        self.assertTrue(1 in parent.position_index)
+        self.assertFalse(2 in parent.position_index)
+
+        child = parent.fork()
+        moved = child.mutable(1)
+        moved.mean = np.array([4.5, 4.5, 0, 0, 0])
+        child.reindex(1)
+        self.assertEqual(child.position_index.query_wedge(0.0, 0.0,
+            np.array([math.pi/4]), 0.1), set([1]))
+        self.assertEqual(parent.position_index.query_wedge(5.0, 5.0,
+            np.array([math.pi/4]), 0.1), set())
+
+        del child[1]
+        self.assertFalse(1 in child.position_index)
+        self.assertTrue(1 in parent.position_index)
+
+    def test_subset_arrays_after_update(self):
+        landmarks = LandmarkMap()
+        for id_ in range(1, 200):
+            landmarks[id_] = Feature(mean=np.array([id_, 0, 0, 0, 0],
+                dtype=float))
+        landmarks.arrays()
+        landmarks.mutable(5).mean = np.array([50.0, 0, 0, 0, 0])
+        # only the features asked for are packed, not the whole map
+        landmarks.arrays = None
+        ids, means, covars, _, _ = landmarks.subset_arrays([7, 5])
+        self.assertEqual(ids, [5, 7])
+        self.assertEqual(list(means[:, 0]), [50.0, 7.0])
+        self.assertEqual(covars.shape, (2, 5, 5))
+
+    def test_mutable_immutable_feature(self):
+        feature = Feature()
+        feature.__immutable__ = True
+        parent = LandmarkMap({1: feature})
+        child = parent.fork()
+        self.assertIs(child.mutable(1), feature)
+
 class prktFeatureTest(unittest.TestCase):
     def test_initialization(self):
         feature = Feature()
@@ -430,6 +941,31 @@ class prktFeatureTest(unittest.TestCase):
         self.assertIsInstance(feature.identity, np.ndarray)
         self.assertEqual(feature.update_count, 0)
 
+    def test_match_terms(self):
+        covar = np.identity(5)*2.0
+        feature = Feature(covar=covar)
+        terms = feature.match_terms()
+        self.assertIs(feature.match_terms(), terms)
+        inverses, log_dets = terms
+        self.assertTrue(np.allclose(inverses, np.identity(5)*0.5))
+        self.assertTrue(np.allclose(log_dets, [2.0*math.log(2.0),
+            3.0*math.log(2.0)]))
+        # the per-pair likelihood reuses the cached terms
+        blob = Blob()
+        particle = FilterParticle(Pose2D(-1.0, 0.0, 0.0))
+        self.assertTrue(np.isfinite(particle.log_probability_of_match(
+            particle.state, blob, feature)))
+        self.assertIs(feature.match_terms(), terms)
+
+        bigK = np.zeros((5, 4))
+        bigK[2, 1] = 0.5
+        bigH = np.zeros((4, 5))
+        bigH[1, 2] = 1.0
+        feature.update_covar(bigK, bigH)
+        self.assertIsNot(feature.match_terms(), terms)
+        self.assertAlmostEqual(feature.match_terms()[1][1], 2.0*math.log(2.0))
+        self.assertAlmostEqual(feature.match_terms()[0][2, 2], 1.0)
+
     def test_update_mean(self):
         # TODO(buckbaskin): I'm not sure how to test this
         pass
@@ -449,4 +985,8 @@ if __name__ == '__main__':
     rostest.rosrun('crispy_parakeet', 'test_prkt_FastSLAM', prktFastSLAMTest)
     rostest.rosrun('crispy_parakeet', 'test_prkt_Feature', prktFeatureTest)
     rostest.rosrun('crispy_parakeet', 'test_prkt_FilterParticle', prktFilterParticleTest)
+    rostest.rosrun('crispy_parakeet', 'test_prkt_ParticleStore', prktParticleStoreTest)
+    rostest.rosrun('crispy_parakeet', 'test_prkt_motion', prktMotionTest)
+    rostest.rosrun('crispy_parakeet', 'test_prkt_LandmarkMap', prktLandmarkMapTest)
+    rostest.rosrun('crispy_parakeet', 'test_prkt_utils', prktUtilsTest)
     
\ No newline at end of file
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+'''
+Tests for the resampling schemes
+'''
+
+import math
+import numpy as np
+import unittest
+
+from resampling import effective_sample_size, log_normalize, normalize
+from resampling import resample
+from resampling import residual_resample, SCHEMES
+from resampling import systematic_resample
+
+class ResamplingTest(unittest.TestCase):
+    def test_normalize(self):
+        weights = normalize(np.array([1.0, 3.0]))
+        self.assertEqual(list(weights), [0.25, 0.75])
+
+        weights = normalize(np.zeros(4))
+        self.assertEqual(list(weights), [0.25]*4)
+
+    def test_log_normalize(self):
+        log_weights = log_normalize(np.array([-1000.0, -1000.0]))
+        self.assertAlmostEqual(log_weights[0], math.log(0.5))
+
+        log_weights = log_normalize(np.array([float('-inf')]*4))
+        self.assertAlmostEqual(log_weights[2], math.log(0.25))
+
+    def test_effective_sample_size(self):
+        self.assertAlmostEqual(effective_sample_size(np.ones(10)), 10.0)
+        self.assertAlmostEqual(effective_sample_size(np.ones(10)*3.0), 10.0)
+        weights = np.zeros(10)
+        weights[3] = 1.0
+        self.assertAlmostEqual(effective_sample_size(weights), 1.0)
+
+    def test_all_schemes_keep_count(self):
+        weights = np.array([0.1, 0.2, 0.3, 0.4])
+        for name in SCHEMES:
+            indices = resample(weights, name)
+            self.assertEqual(len(indices), 4)
+            self.assertTrue(np.all(indices >= 0))
+            self.assertTrue(np.all(indices < 4))
+
+            indices = resample(weights, name, count=9)
+            self.assertEqual(len(indices), 9)
+
+    def test_zero_weights_never_chosen(self):
+        weights = np.array([0.0, 1.0, 0.0, 1.0, 0.0])
+        for name in SCHEMES:
+            indices = resample(weights, name, count=100)
+            self.assertEqual(set(indices), set([1, 3]))
+
+    def test_systematic_proportions(self):
+        weights = np.array([0.5, 0.25, 0.25])
+        indices = systematic_resample(weights, count=100)
+        self.assertEqual(np.sum(indices == 0), 50)
+        self.assertEqual(np.sum(indices == 1), 25)
+
+    def test_residual_deterministic_part(self):
+        weights = np.array([0.5, 0.5])
+        indices = residual_resample(weights)
+        self.assertEqual(sorted(indices), [0, 1])
+
+    def test_unknown_scheme(self):
+        self.assertRaises(KeyError, resample, np.ones(3), 'nope')
+
+if __name__ == '__main__':
+    import rostest
+    rostest.rosrun('crispy_parakeet', 'test_resampling', ResamplingTest)
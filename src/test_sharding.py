@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+'''
+Tests for running the measurement update in a pool of shard processes
+'''
+
+import numpy as np
+import unittest
+
+from particle_store import ParticleStore
+from prkt_core_v2 import FilterParticle, Feature, scan_likelihood
+from sharding import ShardPool, ShardSlot
+from viz_feature_sim.msg import Blob, VizScan
+
+QT = np.identity(4)*.1
+
+def make_scan():
+    scan = VizScan()
+    for bearing, color in ((0.0, 10), (1.2, 200)):
+        blob = Blob()
+        blob.bearing = bearing
+        blob.color.r = color
+        blob.color.g = 10
+        blob.color.b = 10
+        scan.observes.append(blob)
+    return scan
+
+def make_store(count):
+    first = FilterParticle()
+    first.load_priors([Feature(mean=np.array([1, 0, 10, 10, 10]))])
+    first.feature_set[first.next_id] = Feature(
+        mean=np.array([1, 2, 200, 10, 10]))
+    store = ParticleStore([first] + [first.fork() for _ in range(1, count)])
+    store.x[:] = np.linspace(0, .5, count)
+    store.y[:] = np.linspace(0, .2, count)
+    store.heading[:] = np.linspace(0, .1, count)
+    return store
+
+class ShardPoolTest(unittest.TestCase):
+    def test_matches_serial(self):
+        store = make_store(6)
+        particles = [store.maps[i].fork() for i in range(0, 6)]
+        for i, particle in enumerate(particles):
+            particle.state = store.state(i)
+        expected = scan_likelihood(particles, make_scan(), 1, QT)
+
+        pool = ShardPool(store, scan_likelihood, workers=2, capacity=10)
+        try:
+            self.assertEqual(len(pool), 2)
+            self.assertIsInstance(store.maps[0], ShardSlot)
+            self.assertEqual(sorted(set(slot.shard for slot in store.maps)),
+                [0, 1])
+            result = pool.observe(store, make_scan(), 1, QT)
+            self.assertTrue(np.allclose(result, expected))
+
+            # the updates stay in the shards
+            fetched = pool.fetch(store.maps, [5])[0]
+            self.assertTrue(np.allclose(fetched.get_feature_by_id(2).mean,
+                particles[5].get_feature_by_id(2).mean))
+        finally:
+            pool.close(store)
+        self.assertIsInstance(store.maps[0], FilterParticle)
+
+    def test_select_moves_ownership(self):
+        store = make_store(4)
+        pool = ShardPool(store, scan_likelihood, workers=2, capacity=6)
+        try:
+            pool.observe(store, make_scan(), 1, QT)
+            # within slack every particle stays with its parent's shard
+            pool.slack = 1.0
+            indices = np.array([3, 3, 0, 2, 3])
+            slots = pool.select(store.maps, indices)
+            store.select(indices)
+            store.maps = slots
+            self.assertEqual([slot.shard for slot in store.maps],
+                [1, 1, 0, 1, 1])
+            self.assertEqual(pool.moved, 0)
+            # the next scan still covers every particle
+            result = pool.observe(store, make_scan(), 1, QT)
+            self.assertEqual(result.shape, (5,))
+            self.assertTrue(np.all(np.isfinite(result)))
+            self.assertRaises(ValueError, pool.select, store.maps,
+                np.zeros(7, dtype=int))
+        finally:
+            pool.close(store)
+        self.assertEqual(len(store.maps), 5)
+        self.assertIsNot(store.maps[0], store.maps[1])
+        self.assertEqual(store.maps[0].get_feature_by_id(2).update_count, 4)
+
+    def test_select_rebalances(self):
+        store = make_store(4)
+        pool = ShardPool(store, scan_likelihood, workers=2, capacity=6)
+        try:
+            pool.observe(store, make_scan(), 1, QT)
+            # every new particle comes from shard 1
+            indices = np.array([2, 3, 3, 3, 3, 2])
+            slots = pool.select(store.maps, indices)
+            store.select(indices)
+            store.maps = slots
+            self.assertEqual(sorted(slot.shard for slot in store.maps),
+                [0, 0, 0, 1, 1, 1])
+            # the three copies of parent 3 that moved are sent once
+            self.assertEqual(pool.moved, 1)
+            result = pool.observe(store, make_scan(), 1, QT)
+            self.assertTrue(np.all(np.isfinite(result)))
+        finally:
+            pool.close(store)
+        self.assertEqual(len(store.maps), 6)
+        self.assertEqual(len(set(id(particle) for particle in store.maps)), 6)
+        self.assertEqual(store.maps[1].get_feature_by_id(2).update_count, 4)
+
+    def test_worker_error(self):
+        store = make_store(2)
+        pool = ShardPool(store, scan_likelihood, workers=1)
+        try:
+            self.assertRaises(RuntimeError, pool.observe, store, None, 1, QT)
+        finally:
+            pool.close()
+
+if __name__ == '__main__':
+    import rostest
+    rostest.rosrun('crispy_parakeet', 'test_sharding', ShardPoolTest)
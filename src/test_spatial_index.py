@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+'''
+Tests for the landmark spatial index
+'''
+
+import math
+import numpy as np
+import unittest
+
+from spatial_index import GridIndex
+
+class GridIndexTest(unittest.TestCase):
+    def test_insert_move_remove(self):
+        index = GridIndex(1.0)
+        index.insert(1, (0.5, 0.5))
+        index.insert(2, (0.7, 0.2))
+        index.insert(3, (-3.5, 2.0))
+        self.assertEqual(len(index), 3)
+        index.insert(2, (5.5, 5.5))
+        self.assertEqual(len(index), 3)
+        index.remove(1)
+        index.remove(1)
+        self.assertFalse(1 in index)
+        centers, cell_ids = index.cell_arrays()
+        self.assertEqual(sorted(sum(cell_ids, ())), [2, 3])
+        self.assertEqual(len(centers), 2)
+
+    def test_fork_is_independent(self):
+        parent = GridIndex(1.0)
+        parent.insert(1, (0.0, 0.0))
+        child = parent.fork()
+        child.insert(2, (1.0, 1.0))
+        parent.remove(1)
+        self.assertEqual(len(parent), 0)
+        self.assertEqual(len(child), 2)
+        self.assertTrue(1 in child)
+
+    def test_ball_is_conservative(self):
+        generator = np.random.RandomState(3)
+        colors = generator.uniform(0.0, 255.0, (400, 3))
+        radius = math.sqrt(300.0)
+        index = GridIndex(radius)
+        for id_, color in enumerate(colors):
+            index.insert(id_, color)
+
+        query = (120.0, 40.0, 200.0)
+        found = index.query_ball(query, radius)
+        distance = np.sum((colors - np.array(query))**2, axis=1)
+        inside = set(np.nonzero(distance <= 300.0)[0])
+        self.assertTrue(inside <= found)
+        self.assertTrue(len(found) < len(colors) / 10)
+
+    def test_wedge_is_conservative(self):
+        generator = np.random.RandomState(11)
+        points = generator.uniform(-20.0, 20.0, (500, 2))
+        index = GridIndex(1.5)
+        for id_, point in enumerate(points):
+            index.insert(id_, point)
+
+        x, y = 0.3, -1.2
+        directions = np.array([0.2, 2.5, -3.0])
+        half_angle = 0.5
+        found = index.query_wedge(x, y, directions, half_angle)
+
+        angles = np.arctan2(points[:, 1] - y, points[:, 0] - x)
+        offsets = angles[:, np.newaxis] - directions[np.newaxis, :]
+        offsets = np.abs(np.arctan2(np.sin(offsets), np.cos(offsets)))
+        inside = set(np.nonzero(np.any(offsets <= half_angle, axis=1))[0])
+
+        self.assertTrue(inside <= found)
+        # most of the map is outside of three 1 rad wedges
+        self.assertTrue(len(found) < len(points) * 0.75)
+
+    def test_wedge_with_range(self):
+        generator = np.random.RandomState(5)
+        points = generator.uniform(-100.0, 100.0, (20000, 2))
+        index = GridIndex(1.0)
+        for id_, point in enumerate(points):
+            index.insert(id_, point)
+
+        x, y = 3.0, -2.0
+        directions = np.array([0.4, -2.0])
+        half_angle = 0.5
+        max_range = 6.0
+        # only the cells around the wedges are looked at, not every occupied
+        #   cell
+        index.cell_arrays = None
+        found = index.query_wedge(x, y, directions, half_angle, max_range)
+
+        distance = np.hypot(points[:, 0] - x, points[:, 1] - y)
+        angles = np.arctan2(points[:, 1] - y, points[:, 0] - x)
+        offsets = angles[:, np.newaxis] - directions[np.newaxis, :]
+        offsets = np.abs(np.arctan2(np.sin(offsets), np.cos(offsets)))
+        inside = set(np.nonzero(np.any(offsets <= half_angle, axis=1) &
+            (distance <= max_range))[0])
+        self.assertTrue(inside <= found)
+        self.assertTrue(np.all(distance[sorted(found)] <= max_range + 2.0))
+
+if __name__ == '__main__':
+    import rostest
+    rostest.rosrun('crispy_parakeet', 'test_spatial_index', GridIndexTest)
@@ -1,6 +1,8 @@
 import rospy
 import math
+import numpy as np
 
+from collections import namedtuple
 from nav_msgs.msg import Odometry
 from geometry_msgs.msg import Twist, Quaternion
 from tf import transformations as tft
@@ -34,6 +36,48 @@ def heading_to_quaternion(heading):
     quaternion.w = quat[3]
     return quaternion
 
+# planar robot pose with a plain float heading, used inside the SLAM core
+#   instead of an Odometry message so that headings don't have to go through a
+#   quaternion
+Pose2D = namedtuple('Pose2D', ['x', 'y', 'heading'])
+
+def pose_of(state):
+    """
+    Get the planar pose of a state
+    input: Pose2D or nav_msgs.msg.Odometry
+    output: Pose2D
+    """
+    if isinstance(state, Pose2D):
+        return state
+    pose = state.pose.pose
+    return Pose2D(pose.position.x, pose.position.y,
+        quaternion_to_heading(pose.orientation))
+
+def headings_to_quaternions(headings):
+    """
+    Vectorized heading_to_quaternion for a rotation about z only
+    input: np.ndarray of headings in radians (M,)
+    output: np.ndarray of [x, y, z, w] quaternions (M, 4)
+    """
+    headings = np.asarray(headings, dtype=float)
+    quats = np.zeros((len(headings), 4))
+    quats[:, 2] = np.sin(headings / 2.0)
+    quats[:, 3] = np.cos(headings / 2.0)
+    return quats
+
+def quaternions_to_headings(quats):
+    """
+    Vectorized quaternion_to_heading (yaw)
+    input: np.ndarray of [x, y, z, w] quaternions (M, 4)
+    output: np.ndarray of headings in radians (M,)
+    """
+    quats = np.asarray(quats, dtype=float)
+    x = quats[:, 0]
+    y = quats[:, 1]
+    z = quats[:, 2]
+    w = quats[:, 3]
+    return np.arctan2(2.0*(w*z + x*y), 1.0 - 2.0*(y*y + z*z))
+
 def dot_product(vec1, vec2):
     """
     calcuates the dot product of two tuples/vectors a, b